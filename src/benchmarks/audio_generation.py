@@ -0,0 +1,91 @@
+""" Seconds per song of the audio-only generation and the agreement of the detected onsets with human beatmaps """
+
+import random
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import time
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from tensorflow import keras
+
+from benchmarks.compute import use_cpu_only, save_results
+from predict.api import load_action_index, save_generated_song
+from predict.compute import create_audio_streams, generate_beatmaps
+from predict.index import ActionIndex
+from process.api import load_datasets, create_song_list
+from process.compute import process_song_folder, create_ogg_paths, load_mfcc, detect_onsets
+from train.model import get_architecture_fn
+from train.sequence import BeatmapSequence
+from train.step import StepModel
+from utils.types import Config
+
+ONSET_TOLERANCE = 0.05  # in seconds
+
+
+def main():
+    use_cpu_only()
+    seed = 43
+    tf.random.set_seed(seed)
+    np.random.seed(seed)
+    random.seed(seed)
+
+    config = Config()
+    _, val, _ = load_datasets(config)
+    song_folders = create_song_list(config.dataset.beat_maps_folder)[:20]
+
+    # The speed does not depend on the weights, an untrained model avoids the training
+    seq = BeatmapSequence(df=val, is_train=False, config=config)
+    model = get_architecture_fn(config)(seq, False, config)
+    step_model = StepModel.from_model(keras.Model(model.inputs, model.outputs))
+    action_index = load_action_index(config)
+
+    results = []
+    with TemporaryDirectory() as output_folder:
+        for folder in song_folders:
+            result = {'song': Path(folder).name,
+                      **time_song(folder, output_folder, step_model, action_index, config),
+                      **onset_agreement(folder, config)}
+            print(f'{result["song"]:>24} | {result["total_seconds"]:6.2f} s | {result["onset_f1"]:.3f} onset F1')
+            results.append(result)
+
+    results = pd.DataFrame(results).set_index('song')
+    results.loc['mean'] = results.mean()
+    save_results(results, 'audio_generation_benchmark', config)
+
+
+def time_song(folder: str, output_folder: str, step_model: StepModel, action_index: ActionIndex,
+              config: Config) -> dict:
+    start = time()
+    streams = create_audio_streams(Path(folder), action_index, config, input_names=step_model.input_names)
+    preprocessed = time()
+    beatmap_dfs = generate_beatmaps(streams, step_model, action_index, config)
+    generated = time()
+    song_dfs = {difficulty: df for (_, difficulty, _), df in beatmap_dfs.items()}
+    save_generated_song(Path(folder), Path(output_folder), song_dfs, action_index, config)
+    saved = time()
+    return {
+        'beats': len(streams[0].beatmap_df),
+        'preprocessing_seconds': preprocessed - start,
+        'generation_seconds': generated - preprocessed,
+        'saving_seconds': saved - generated,
+        'total_seconds': saved - start,
+    }
+
+
+def onset_agreement(folder: str, config: Config) -> dict:
+    """ Precision and recall of the detected onsets against the beats of the human beatmaps """
+    onsets = detect_onsets(load_mfcc(create_ogg_paths([folder])[0], config, compute_missing=True), config)
+    human_df = process_song_folder(folder, config)
+    beats = np.unique(human_df.index.get_level_values('time').to_numpy())
+
+    distances = np.abs(onsets[:, None] - beats[None])
+    precision = np.mean(distances.min(axis=1) < ONSET_TOLERANCE)
+    recall = np.mean(distances.min(axis=0) < ONSET_TOLERANCE)
+    return {'onset_precision': precision, 'onset_recall': recall,
+            'onset_f1': 2 * precision * recall / max(precision + recall, 1e-9)}
+
+
+if __name__ == '__main__':
+    main()
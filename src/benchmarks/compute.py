@@ -0,0 +1,70 @@
+""" Functions used by multiple benchmarks """
+
+import kerastuner as kt
+import pandas as pd
+import tensorflow as tf
+
+from utils.types import Config, ModelType, DatasetConfig
+
+# Best found MLSTM architecture, see `experiments/hypersearch_model.py`
+MLSTM_HYPERPARAMETERS = {'connections_0': 2,
+                         'connections_1': 2,
+                         'connections_2': 2,
+                         'connections_3': 3,
+                         'connections_4': 1,
+                         'connections_5': 3,
+                         'connections_6': 2,
+                         'depth_0': 18,
+                         'depth_1': 23,
+                         'depth_2': 43,
+                         'depth_3': 13,
+                         'depth_4': 52,
+                         'depth_5': 5,
+                         'depth_6': 11,
+                         'dropout_0': 0.25612932926324405,
+                         'dropout_1': 0.1620424523625309,
+                         'dropout_2': 0.4720468723284278,
+                         'dropout_3': 0.43881829788147036,
+                         'dropout_4': 0.44741780640383355,
+                         'dropout_5': 0.3327191857714107,
+                         'dropout_6': 0.1367707920005909,
+                         'initial_learning_rate': 0.008,
+                         'label_smoothing': 0.13716631669361445,
+                         'lstm_layers': 3,
+                         'width_0': 16,
+                         'width_1': 9,
+                         'width_2': 15,
+                         'width_3': 16,
+                         'width_4': 5,
+                         'width_5': 11,
+                         'width_6': 4,
+                         }
+
+
+def use_cpu_only():
+    """ Has to be called before TF initializes the GPUs """
+    tf.config.set_visible_devices([], 'GPU')
+
+
+def create_mlstm_config(config: Config):
+    config.training.model_type = ModelType.TUNE_MLSTM
+    config.training.x_groups = [['prev_word_id', 'prev_word_vec'], DatasetConfig().categorical,
+                                DatasetConfig().audio, DatasetConfig().regression]
+    config.training.y_groups = [['word_id'], ]
+
+    hp = kt.HyperParameters()
+    for param, value in MLSTM_HYPERPARAMETERS.items():
+        hp.Fixed(param, value=value)
+    return config, hp
+
+
+def limit_snippets(df: pd.DataFrame, num_snippets: int, config: Config) -> pd.DataFrame:
+    """ Keep only the first `num_snippets` snippets, the rows of each snippet are contiguous """
+    return df.iloc[:num_snippets * config.beat_preprocessing.snippet_window_length]
+
+
+def save_results(results: pd.DataFrame, name: str, config: Config):
+    csv_file = config.base_data_folder / 'temp' / f'{name}.csv'
+    csv_file.parent.mkdir(parents=True, exist_ok=True)
+    results.to_csv(csv_file)
+    print(results.to_string())
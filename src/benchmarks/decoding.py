@@ -0,0 +1,72 @@
+""" Generated beats per second of the sampling (with top-k/top-p filtering) and of the beam search decoding """
+
+import random
+from pathlib import Path
+from time import time
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from tensorflow import keras
+
+from benchmarks.compute import use_cpu_only, save_results
+from predict.api import load_action_index
+from predict.compute import create_song_streams, generate_beatmaps, generate_beatmaps_with_beam_search
+from process.api import load_datasets, create_song_list
+from train.model import get_architecture_fn
+from train.sequence import BeatmapSequence
+from train.step import StepModel
+from utils.types import Config
+
+SAMPLING = [(0, 1.0), (30, 1.0), (0, 0.9)]  # (top_k, top_p)
+BEAM_WIDTHS = [1, 2, 4, 8]
+
+
+def main():
+    use_cpu_only()
+    seed = 43
+    tf.random.set_seed(seed)
+    np.random.seed(seed)
+    random.seed(seed)
+
+    config = Config()
+    _, val, _ = load_datasets(config)
+    song_folders = create_song_list(config.dataset.beat_maps_folder)[:4]
+
+    # The speed does not depend on the weights, an untrained model avoids the training
+    seq = BeatmapSequence(df=val, is_train=False, config=config)
+    model = get_architecture_fn(config)(seq, False, config)
+    step_model = StepModel.from_model(keras.Model(model.inputs, model.outputs))
+    action_index = load_action_index(config)
+
+    results = []
+    for top_k, top_p in SAMPLING:
+        config.generation.top_k, config.generation.top_p = top_k, top_p
+        beats_per_second = time_decoding(song_folders, generate_beatmaps, step_model, action_index, config)
+        print(f'\n sampling top_k={top_k:2} top_p={top_p:.1f} | {beats_per_second:8.1f} beats/s')
+        results.append({'decoding': f'sampling top_k={top_k} top_p={top_p}', 'beats_per_second': beats_per_second})
+
+    config.generation.top_k, config.generation.top_p = 0, 1.0
+    for beam_width in BEAM_WIDTHS:
+        config.generation.beam_width = beam_width
+        beats_per_second = time_decoding(song_folders, generate_beatmaps_with_beam_search, step_model,
+                                         action_index, config)
+        print(f'\n beam search width={beam_width:2}        | {beats_per_second:8.1f} beats/s')
+        results.append({'decoding': f'beam width={beam_width}', 'beats_per_second': beats_per_second})
+
+    results = pd.DataFrame(results).set_index('decoding')
+    save_results(results, 'decoding_benchmark', config)
+
+
+def time_decoding(song_folders, generate_fn, step_model, action_index, config: Config) -> float:
+    """ Generated beats per second of `generate_fn` over all difficulties of `song_folders` """
+    streams = sum([create_song_streams(Path(folder), action_index, config, input_names=step_model.input_names)
+                   for folder in song_folders], [])
+    start = time()
+    beatmap_dfs = generate_fn(streams, step_model, action_index, config)
+    elapsed = time() - start
+    return sum(len(df) for df in beatmap_dfs.values()) / elapsed
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+""" Load test of the generation service: throughput and latency with increasing numbers of concurrent clients """
+
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryDirectory
+from time import time
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from tensorflow import keras
+
+from benchmarks.compute import use_cpu_only, save_results
+from predict.client import GenerationClient
+from predict.server import serve
+from process.api import load_datasets, create_song_list
+from train.model import get_architecture_fn
+from train.sequence import BeatmapSequence
+from train.step import StepModel
+from utils.types import Config
+
+REQUESTS_PER_CLIENT = 4
+
+
+def main():
+    use_cpu_only()
+    seed = 43
+    tf.random.set_seed(seed)
+    np.random.seed(seed)
+    random.seed(seed)
+
+    config = Config()
+    _, val, _ = load_datasets(config)
+    song_folders = create_song_list(config.dataset.beat_maps_folder)[:8]
+
+    # Throughput does not depend on the weights, an untrained model avoids the training
+    seq = BeatmapSequence(df=val, is_train=False, config=config)
+    model = get_architecture_fn(config)(seq, False, config)
+    http_server = serve(StepModel.from_model(keras.Model(model.inputs, model.outputs)), config)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+
+    results = []
+    try:
+        with TemporaryDirectory() as output_folder:
+            for num_clients in [1, 4, 16]:
+                result = load_test(song_folders, output_folder, num_clients, config)
+                print(f'{num_clients:3} clients | {result["requests_per_second"]:6.3f} requests/s | '
+                      f'{result["mean_latency"]:6.2f} s mean latency | {result["max_queue_depth"]} max queue depth')
+                results.append({'clients': num_clients, **result})
+    finally:
+        http_server.shutdown()
+        http_server.generation_server.stop()
+
+    results = pd.DataFrame(results).set_index('clients')
+    save_results(results, 'generation_server_benchmark', config)
+
+
+def load_test(song_folders, output_folder, num_clients: int, config: Config) -> dict:
+    client = GenerationClient(config)
+    requests = [song_folders[i % len(song_folders)] for i in range(num_clients * REQUESTS_PER_CLIENT)]
+
+    queue_depths = []
+    done = threading.Event()
+
+    def poll_metrics():
+        while not done.wait(0.5):
+            queue_depths.append(client.metrics()['queue_depth'])
+
+    poller = threading.Thread(target=poll_metrics, daemon=True)
+    poller.start()
+    start = time()
+    with ThreadPoolExecutor(num_clients) as executor:
+        responses = list(executor.map(lambda folder: client.generate(folder, output_folder), requests))
+    elapsed = time() - start
+    done.set()
+    poller.join()
+
+    latencies = np.array([response['latency'] for response in responses])
+    metrics = client.metrics()
+    return {
+        'requests_per_second': len(requests) / elapsed,
+        'mean_latency': latencies.mean(),
+        'p90_latency': np.percentile(latencies, 90),
+        'max_queue_depth': max(queue_depths, default=0),
+        'server_beats_per_second': metrics['beats_per_second'],
+        'server_queue_wait_p90': metrics['queue_wait_p90'],
+    }
+
+
+if __name__ == '__main__':
+    main()
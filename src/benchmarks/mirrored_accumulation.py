@@ -0,0 +1,59 @@
+"""
+Check of the gradient accumulation under `MirroredStrategy` on two logical CPU devices.
+The optimizer step has to run outside of any control flow, otherwise the all-reduce fails.
+The weights after the same batches have to match the training on one device without accumulation.
+"""
+
+import random
+
+import numpy as np
+import tensorflow as tf
+
+from benchmarks.compute import use_cpu_only, limit_snippets
+from process.api import load_datasets
+from train.model import get_architecture_fn
+from train.sequence import BeatmapSequence
+from utils.types import Config
+
+
+def main():
+    use_cpu_only()
+    cpu = tf.config.list_physical_devices('CPU')[0]
+    tf.config.set_logical_device_configuration(cpu, [tf.config.LogicalDeviceConfiguration()] * 2)
+
+    steps = 3
+    config = Config()
+    train, _, _ = load_datasets(config)
+    train = limit_snippets(train, config.training.batch_size * steps, config)
+
+    reference = train_weights(train, 1, tf.distribute.OneDeviceStrategy('/cpu:0'), steps)
+    accumulated = train_weights(train, 2, tf.distribute.MirroredStrategy(['/cpu:0', '/cpu:1']), steps)
+
+    max_abs_diff = max(np.max(np.abs(a - b)) for a, b in zip(reference, accumulated))
+    print(f'{max_abs_diff:.2e} max abs weight diff')
+    assert max_abs_diff < 1e-4, 'Mirrored training with gradient accumulation differs from a single device'
+
+
+def train_weights(train, accumulation_steps: int, strategy: tf.distribute.Strategy, steps: int):
+    """ Weights after `steps` deterministic batches """
+    seed = 43
+    tf.random.set_seed(seed)
+    np.random.seed(seed)
+    random.seed(seed)
+
+    config = Config()
+    config.training.gradient_accumulation_steps = accumulation_steps
+    config.training.dropout = 0.0
+    config.training.mixup_alpha = 0.0
+    train_seq = BeatmapSequence(df=train, is_train=True, config=config)
+    with strategy.scope():
+        model = get_architecture_fn(config)(train_seq, False, config)
+    model.fit(train_seq, epochs=1, steps_per_epoch=steps, shuffle=False, verbose=2)
+
+    weights = [weight.copy() for weight in model.get_weights()]
+    tf.keras.backend.clear_session()
+    return weights
+
+
+if __name__ == '__main__':
+    main()
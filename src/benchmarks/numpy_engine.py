@@ -0,0 +1,109 @@
+"""
+Per beat latency and output parity of the NumPy engine, the exported step model and the Keras stateful model.
+The load time of the exported step model (`load_step_model` and its first step) is reported as well.
+"""
+
+import random
+from tempfile import TemporaryDirectory
+from time import time
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from tensorflow import keras
+
+from benchmarks.compute import use_cpu_only, save_results
+from predict.engine import NumpyStepEngine
+from process.api import load_datasets
+from train.model import get_architecture_fn
+from train.sequence import BeatmapSequence
+from train.step import export_step_model, load_step_model
+from utils.types import Config, ModelType
+
+TOLERANCE = 1e-4
+
+
+def main():
+    use_cpu_only()
+    seed = 43
+    tf.random.set_seed(seed)
+    np.random.seed(seed)
+    random.seed(seed)
+
+    config = Config()
+    _, val, _ = load_datasets(config)
+
+    results = []
+    for model_type in [ModelType.BASELINE, ModelType.DDC, ModelType.CUSTOM]:
+        config = Config()
+        config.training.model_type = model_type
+        config.training.AVS_proxy_ratio = 0  # only the architecture matters
+        for backend, ms_per_beat, max_abs_diff, load_seconds in compare_backends(val, config):
+            print(f'{model_type.name.lower():>10} | {backend:>16} | {ms_per_beat:7.3f} ms/beat | {max_abs_diff=:.2e}'
+                  f' | {load_seconds:6.3f} s load')
+            results.append({'model': model_type.name.lower(), 'backend': backend, 'ms_per_beat': ms_per_beat,
+                            'max_abs_diff': max_abs_diff, 'matches': max_abs_diff < TOLERANCE,
+                            'load_seconds': load_seconds})
+
+    results = pd.DataFrame(results).set_index(['model', 'backend'])
+    save_results(results, 'numpy_engine_benchmark', config)
+
+
+def compare_backends(df: pd.DataFrame, config: Config) -> List[Tuple[str, float, float, float]]:
+    seq = BeatmapSequence(df=df, is_train=False, config=config)
+    model = get_architecture_fn(config)(seq, False, config)
+    model = keras.Model(model.inputs, model.outputs)
+    stateful_model = get_architecture_fn(config)(seq, True, config)
+    stateful_model.set_weights(model.get_weights())
+
+    x, _ = seq[0]
+    beats = [{col: x[col][:1, i:i + 1] for col in model.input_names} for i in range(seq.snippet_size)]
+
+    def keras_step(beat):
+        return stateful_model.predict(beat)
+
+    with TemporaryDirectory() as folder:
+        export_step_model(model, folder)
+        start = time()
+        step_model = load_step_model(folder)
+        step_model(beats[0], step_model.zero_states(1))  # ready to generate
+        load_seconds = {'tf_step_model': time() - start}
+        backends = {
+            'keras_stateful': keras_step,
+            'tf_step_model': stateful_step(step_model),
+            'numpy_engine': stateful_step(NumpyStepEngine(model)),
+        }
+        results = {backend: run_beats(step, beats) for backend, step in backends.items()}
+
+    reference, _ = results['keras_stateful']
+    tf.keras.backend.clear_session()
+    return [(backend, elapsed / (len(beats) - 1) * 1000, max_abs_diff(reference, outputs),
+             load_seconds.get(backend, np.nan)) for backend, (outputs, elapsed) in results.items()]
+
+
+def stateful_step(step_model) -> Callable[[Dict[str, np.ndarray]], Dict[str, np.ndarray]]:
+    """ Keeps the explicit states between the calls, the same way as the stateful Keras model """
+    states = step_model.zero_states(1)
+
+    def step(beat):
+        nonlocal states
+        outputs, states = step_model(beat, states)
+        return outputs
+
+    return step
+
+
+def run_beats(step: Callable, beats: List[Dict[str, np.ndarray]]) -> Tuple[List[Dict[str, np.ndarray]], float]:
+    step(beats[0])  # tracing, buffer allocation
+    start = time()
+    outputs = [step(beat) for beat in beats[1:]]
+    return outputs, time() - start
+
+
+def max_abs_diff(reference: List[Dict[str, np.ndarray]], outputs: List[Dict[str, np.ndarray]]) -> float:
+    return max(np.max(np.abs(ref[col] - out[col])) for ref, out in zip(reference, outputs) for col in ref)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+""" Speed and parity of the prefix sum action velocities against the per beatmap pandas rolling means """
+
+from time import time
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.compute import save_results
+from process.api import load_datasets
+from utils.avd import compute_multiple_velocities
+from utils.types import Config
+
+WINDOWS = range(1, 33)
+
+
+def main():
+    config = Config()
+    train, _, _ = load_datasets(config)
+    beatmaps = [train.index.get_level_values(level) for level in ['name', 'difficulty']]
+    vec_df = pd.DataFrame(np.stack(train['word_vec'].to_numpy()),
+                          index=pd.MultiIndex.from_arrays(beatmaps, names=['name', 'difficulty']))
+
+    results = []
+    for num_beats in [10000, 100000]:
+        df = vec_df.iloc[:num_beats]
+        start = time()
+        velocities = compute_multiple_velocities(df, WINDOWS[0], WINDOWS[-1])
+        prefix_sum_seconds = time() - start
+
+        start = time()
+        reference = {window: df.groupby(['name', 'difficulty']).apply(lambda x: rolling_velocity(x, window))
+                     for window in WINDOWS}
+        pandas_seconds = time() - start
+
+        max_abs_diff = max(np.max(np.abs(np.sort(velocities[window]) - np.sort(reference[window].to_numpy())),
+                                  initial=0) for window in WINDOWS)
+        print(f'{num_beats:7} beats | {prefix_sum_seconds:7.3f} s prefix sums | {pandas_seconds:7.3f} s pandas | '
+              f'{max_abs_diff:.2e} max abs diff')
+        results.append({'beats': num_beats, 'prefix_sum_seconds': prefix_sum_seconds,
+                        'pandas_seconds': pandas_seconds, 'max_abs_diff': max_abs_diff})
+
+    results = pd.DataFrame(results).set_index('beats')
+    save_results(results, 'velocity_benchmark', config)
+
+
+def rolling_velocity(df: pd.DataFrame, window: int) -> pd.Series:
+    """ The previous single window implementation, as the reference """
+    means = df.rolling(window, win_type='boxcar').mean()
+    diff = means - means.shift(window)
+    return ((diff.dropna() ** 2).sum(axis=1)) ** (1 / 2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+""" CPU steps/sec of AVSModel training with and without the XLA compiled train step """
+
+import random
+from time import time
+from typing import Optional
+
+import kerastuner as kt
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from benchmarks.compute import use_cpu_only, create_mlstm_config, limit_snippets, save_results
+from process.api import load_datasets
+from train.model import get_architecture_fn
+from train.sequence import BeatmapSequence
+from utils.types import Config
+
+
+def main():
+    use_cpu_only()
+    seed = 43
+    tf.random.set_seed(seed)
+    np.random.seed(seed)
+    random.seed(seed)
+
+    warmup_steps, steps = 5, 50
+    config = Config()
+    train, _, _ = load_datasets(config)
+    train = limit_snippets(train, config.training.batch_size * (warmup_steps + steps), config)
+
+    configurations = {
+        'custom_model': (Config(), None),
+        'multi_lstm_tuning_model': create_mlstm_config(Config()),
+    }
+    results = []
+    for name, (config, hp) in configurations.items():
+        for jit_compile in [False, True]:
+            config.training.jit_compile = jit_compile
+            result = steps_per_second(train, config, hp, warmup_steps, steps)
+            print(f'{name:>24} | {jit_compile=} | {result:6.2f} steps/s')
+            results.append({'model': name, 'jit_compile': jit_compile, 'steps_per_second': result})
+
+    results = pd.DataFrame(results).set_index(['model', 'jit_compile'])
+    save_results(results, 'xla_step_benchmark', config)
+
+
+def steps_per_second(train: pd.DataFrame, config: Config, hp: Optional[kt.HyperParameters] = None,
+                     warmup_steps: int = 5, steps: int = 50) -> float:
+    train_seq = BeatmapSequence(df=train, is_train=True, config=config)
+    model = get_architecture_fn(config)(train_seq, False, config)
+    if hp is not None:
+        model = model(hp, use_avs_model=True)
+
+    model.fit(train_seq, epochs=1, steps_per_epoch=warmup_steps, verbose=0)  # tracing and compilation
+    steps = min(steps, len(train_seq))
+    start = time()
+    model.fit(train_seq, epochs=1, steps_per_epoch=steps, verbose=0)
+    elapsed = time() - start
+
+    tf.keras.backend.clear_session()
+    return steps / elapsed
+
+
+if __name__ == '__main__':
+    main()
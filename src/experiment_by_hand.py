@@ -1,24 +1,23 @@
 """"""
 
+import argparse
 import gc
 import random
 
 import numpy as np
 import tensorflow as tf
-import tensorflow_addons as tfa
-from tensorflow import keras
 
-from predict.api import generate_complete_beatmaps
+from predict.api import generate_multiple_complete_beatmaps
 from process.api import load_datasets, create_song_list, generate_datasets
-from train.callbacks import create_callbacks
-from train.metrics import Perplexity
+from train.callbacks import create_callbacks, restore_training_state
 from train.model import save_model, get_architecture_fn
 from train.sequence import BeatmapSequence
+from train.step import load_step_model
 from utils.functions import dataset_stats
 from utils.types import Config, Timer
 
 
-def main():
+def main(resume: bool = False):
     timer = Timer()
 
     seed = 43  # random, non-fine tuned seed
@@ -63,6 +62,8 @@ def main():
     # keras.mixed_precision.experimental.set_policy('mixed_float16')    # Undefined behavior with advanced models
     model_path = base_folder / 'temp'
     model_path.mkdir(parents=True, exist_ok=True)
+    if resume:  # continue the last run with the same config and dataset
+        config.training.checkpoint_folder = model_path / 'checkpoints'
 
     train = True
     if train:
@@ -70,11 +71,13 @@ def main():
         model.summary()
 
         callbacks = create_callbacks(train_seq, config)
+        initial_epoch = restore_training_state(model, train_seq, config)
 
         model.fit(train_seq,
                   validation_data=val_seq,
                   callbacks=callbacks,
                   epochs=400,
+                  initial_epoch=initial_epoch,
                   verbose=2,
                   workers=10,
                   max_queue_size=16,
@@ -84,13 +87,11 @@ def main():
         model.evaluate(test_seq)
         timer('Evaluated model', 5)
 
-        save_model(model, model_path, train_seq, config)
+        save_model(model, model_path)
         timer('Saved model', 5)
 
-    stateful_model = keras.models.load_model(model_path / 'stateful_model.keras',
-                                             custom_objects={'Perplexity': Perplexity, 'mish': tfa.activations.mish})
-    stateful_model.summary()
-    timer('Loaded stateful model', 5)
+    step_model = load_step_model(model_path / 'step_model')
+    timer('Loaded step model', 5)
 
     # Use generated action placement
     input_folder = base_folder / 'evaluation_dataset' / 'beat_sage'
@@ -102,12 +103,12 @@ def main():
     # input_folder = base_folder / 'dataset'
     # dirs = list(x for x in test.index.to_frame()["name"].unique()[:13])
 
-    for song_code in dirs:
-        beatmap_folder = input_folder / song_code
-        print(f'Working on {beatmap_folder.name}')
-        generate_complete_beatmaps(beatmap_folder, output_folder, stateful_model, config)
-        timer('Generated beatmaps', 5)
+    generate_multiple_complete_beatmaps([input_folder / song_code for song_code in dirs], output_folder,
+                                        step_model, config, model=model)
+    timer('Generated beatmaps', 5)
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resume', action='store_true', help='checkpoint the training and resume the last run')
+    main(parser.parse_args().resume)
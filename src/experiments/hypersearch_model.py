@@ -6,10 +6,10 @@ import tensorflow as tf
 from experiments.compute import init_test
 from predict.api import generate_complete_beatmaps
 from train.callbacks import create_callbacks
-from train.metrics import Perplexity
 from train.model import save_model, \
     get_architecture_fn
 from train.sequence import BeatmapSequence
+from train.step import load_step_model
 from utils.types import Config, ModelType
 
 
@@ -112,14 +112,13 @@ def main():
 
         model_path.mkdir(parents=True, exist_ok=True)
 
-        save_model(model, model_path, train_seq, config, hp=hp)
+        save_model(model, model_path)
         timer('Saved model', 5)
 
     if eval_model:
-        stateful_model = tf.keras.models.load_model(model_path / 'stateful_model.keras',
-                                                    custom_objects={'Perplexity': Perplexity})
+        step_model = load_step_model(model_path / 'step_model')
 
-        timer('Loaded stateful model', 5)
+        timer('Loaded step model', 5)
 
         input_folder = base_folder / 'dataset'
         output_folder = base_folder / 'testing' / 'generated_songs'
@@ -129,7 +128,7 @@ def main():
         for song_code in song_codes_to_gen:
             beatmap_folder = input_folder / song_code
             print(beatmap_folder)
-            generate_complete_beatmaps(beatmap_folder, output_folder, stateful_model, config)
+            generate_complete_beatmaps(beatmap_folder, output_folder, step_model, config)
             timer('Generated beatmaps', 5)
 
 
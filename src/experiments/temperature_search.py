@@ -1,30 +1,32 @@
 import random
-import shutil
 from copy import deepcopy
-from multiprocessing import Pool
-from typing import Tuple, Optional
+from dataclasses import replace
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple, Optional
 
 import kerastuner as kt
 import numpy as np
 import pandas as pd
 import tensorflow as tf
-import tensorflow_addons as tfa
-from bayes_opt import BayesianOptimization
+from bayes_opt import BayesianOptimization, UtilityFunction
 from bayes_opt import JSONLogger, Events
 from bayes_opt.util import load_logs
-from tensorflow import keras
 
 from experiments.compute import init_test
-from predict.api import generate_complete_beatmaps
-from process.api import load_datasets, create_song_list, songs2dataset
-from train.callbacks import create_callbacks
-from train.metrics import Perplexity
+from predict.api import generate_multiple_complete_beatmaps, load_action_index
+from predict.compute import GenerationStream, create_song_streams, generate_streams
+from train.callbacks import create_callbacks, restore_training_state
 from train.model import get_architecture_fn, save_model
 from train.sequence import BeatmapSequence
+from train.step import load_step_model
+from utils.avd import VelocityHistograms, VelocityTracker, load_reference_histograms
 from utils.types import Config, Timer, ModelType, DatasetConfig
 
+GRID_SIZE = 8  # temperatures of the initial grid, all generated in one pass
+BO_ROUNDS = 2
+BO_BATCH = 4  # temperatures proposed by each Bayesian optimization round
 
-def main():
+def main(resume: bool = False):
     base_folder, return_list, test, timer, train, val = init_test()
 
     seed = 43  # random, non-fine tuned seed
@@ -83,7 +85,8 @@ def main():
                     }
     for param, value in fixed_params.items():
         hp.Fixed(param, value=value)
-    find_temperature_and_generate(base_folder, train, val, test, model_path, configuration_name, deepcopy(config), hp)
+    find_temperature_and_generate(base_folder, train, val, test, model_path, configuration_name, deepcopy(config), hp,
+                                  resume=resume)
 
     # The best found temperature is ~0.71
     configuration_name = 'vec:id'
@@ -101,7 +104,8 @@ def main():
     config.training.x_groups = [['prev_word_id', ], DatasetConfig().categorical,
                                 DatasetConfig().audio, DatasetConfig().regression]
     config.training.y_groups = [['word_id'], ]
-    find_temperature_and_generate(base_folder, train, val, test, model_path, configuration_name, deepcopy(config))
+    find_temperature_and_generate(base_folder, train, val, test, model_path, configuration_name, deepcopy(config),
+                                  resume=resume)
 
     # The best found temperature is ~0.147
     configuration_name = 'vec:vec'
@@ -119,11 +123,12 @@ def main():
     config.training.x_groups = [['prev_word_vec', ], DatasetConfig().categorical,
                                 DatasetConfig().audio, DatasetConfig().regression]
     config.training.y_groups = [['word_vec'], ]
-    find_temperature_and_generate(base_folder, train, val, test, model_path, configuration_name, deepcopy(config))
+    find_temperature_and_generate(base_folder, train, val, test, model_path, configuration_name, deepcopy(config),
+                                  resume=resume)
 
 
 def find_temperature_and_generate(base_folder, train, val, test, model_path, test_name, config,
-                                  hp: Optional[kt.HyperParameters] = None):
+                                  hp: Optional[kt.HyperParameters] = None, resume: bool = False):
     timer = Timer()
 
     train_seq = BeatmapSequence(df=train, is_train=True, config=config)
@@ -134,11 +139,15 @@ def find_temperature_and_generate(base_folder, train, val, test, model_path, tes
     if hp is not None:
         model = model(hp, use_avs_model=True)
     model.summary()
+    if resume:  # continue the last run of this configuration
+        config.training.checkpoint_folder = model_path / 'checkpoints' / test_name
     callbacks = create_callbacks(train_seq, config)
+    initial_epoch = restore_training_state(model, train_seq, config)
     model.fit(train_seq,
               validation_data=val_seq,
               callbacks=callbacks,
               epochs=400,
+              initial_epoch=initial_epoch,
               verbose=2,
               workers=10,
               max_queue_size=16,
@@ -147,144 +156,96 @@ def find_temperature_and_generate(base_folder, train, val, test, model_path, tes
     timer('Trained model', 5)
     model.evaluate(test_seq)
     timer('Evaluated model', 5)
-    save_model(model, model_path, train_seq, config, hp)
+    save_model(model, model_path)
     timer('Saved model', 5)
 
-    stateful_model = keras.models.load_model(model_path / 'stateful_model.keras',
-                                             custom_objects={'Perplexity': Perplexity, 'mish': tfa.activations.mish})
-    stateful_model.summary()
-    timer('Loaded stateful model', 5)
+    step_model = load_step_model(model_path / 'step_model')
+    timer('Loaded step model', 5)
     storage_folder = base_folder / 'generated_dataset'
     train, val, test = load_datasets(storage_folder)
-    train_vec = get_vec_df(train)  # use train dataset to find good temperature
-    folder_name = 'deepsaber'
-    config.dataset.beat_maps_folder = base_folder / 'testing' / 'generated_songs'
-    config.dataset.storage_folder = base_folder / f'{folder_name}_datasets'
-    human_velocities = compute_multiple_velocities(train_vec.iloc[:100000])
+    human_histograms = load_reference_histograms(config)  # use train dataset to find good temperature
     input_folder = base_folder / 'dataset'
-    output_folder = config.dataset.beat_maps_folder
     timer = Timer()
     dirs = list(x for x in test.index.to_frame()["name"].unique()[:10])
     print(dirs)
 
-    def evaluate_temperature(temperature):
-        for out_file in output_folder.glob('*'):
-            if out_file.is_dir():
-                shutil.rmtree(out_file)
-
-        config.generation.temperature = temperature
-        for song_code in dirs:
-            beatmap_folder = input_folder / song_code
-            print(beatmap_folder)
-            generate_complete_beatmaps(beatmap_folder, output_folder, stateful_model, deepcopy(config))
-        timer('Generated beatmaps for all songs', 5)
-
-        generated_velocities = velocities_from_config(deepcopy(config))
-        distance = compute_avd_distance(human_velocities, generated_velocities)
-        return -distance  # we need to maximize
-
-    pbounds = {'temperature': (0.7, 3.0)}
-    optimizer = BayesianOptimization(
-        f=evaluate_temperature,
-        pbounds=pbounds,
-        random_state=43,
-    )
+    # The song inputs are processed once, every evaluated temperature generates its own copy of them
+    action_index = load_action_index(config)
+    song_streams = sum([create_song_streams(input_folder / song_code, action_index, config,
+                                            input_names=step_model.input_names) for song_code in dirs], [])
+    timer('Processed songs', 5)
+
+    def evaluate_temperatures(temperatures):
+        histograms = {temperature: human_histograms.empty_like() for temperature in temperatures}
+        streams = temperature_streams(song_streams, histograms)
+        search_config = deepcopy(config)
+        search_config.generation.batch_size = len(streams)  # all temperatures share every step call
+        generate_streams(streams, step_model, action_index, search_config)
+        timer(f'Generated beatmaps for {len(temperatures)} temperatures', 5)
+
+        return [human_histograms.distance(histograms[temperature]) for temperature in temperatures]
+
     logging_path = base_folder / f'logs/temperature_log_{test_name}.json'
-    if logging_path.exists():
-        optimizer = load_logs(optimizer, logs=str(logging_path))
-    logger = JSONLogger(path=str(logging_path))
-    optimizer.subscribe(Events.OPTIMIZATION_STEP, logger)
-    optimizer.maximize(
-        init_points=0,
-        n_iter=1,
-    )
-    print(f'{optimizer.max=}')
+    best_temperature = search_temperature(evaluate_temperatures, (0.7, 3.0), logging_path)
+    print(f'{best_temperature=}')
 
     input_folder = base_folder / 'evaluation_dataset' / 'beat_sage_expert'
     output_folder = base_folder / 'evaluation_dataset' / f'deepsaber_{test_name}'
     dirs = [x for x in input_folder.glob('*/') if x.is_dir()]
-    config.generation.temperature = optimizer.max['params']['temperature']
-
-    for song_code in dirs:
-        beatmap_folder = input_folder / song_code
-        print(f'Working on {beatmap_folder.name}')
-        generate_complete_beatmaps(beatmap_folder, output_folder, stateful_model, config)
-        timer('Generated beatmaps', 5)
-
-
-def load_datasets(storage_folder) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
-    return [pd.read_pickle(storage_folder / f'{phase}_beatmaps.pkl') for phase in
-            ['train', 'val', 'test']]
-
-
-def get_vec_df(df):
-    print(df.head(2))
-    nodup = df.droplevel(2)
-    nodup = nodup.loc[~nodup.index.duplicated()]
-
-    top = 900000  # 9000
-    return pd.DataFrame(np.array(nodup.word_vec.values.tolist())[:top], index=nodup.index[:top])
-
-
-def cosine_dist(a, b):
-    return 1 - np.sum(a * b, axis=-1) / (np.linalg.norm(a, axis=-1) * np.linalg.norm(b, axis=-1))
-
-
-def compute_velocity(df, window=7):
-    means = df.iloc[::].rolling(window, win_type='boxcar').mean(std=7, tau=7, sym=False)
-
-    #     velocity  = cosine_dist(means.values, means.shift(window).values)
-    diff = means - means.shift(window)
-    velocity = ((diff.dropna() ** 2).sum(axis=1)) ** (1 / 2)
-    return pd.Series(velocity).dropna()
+    config.generation.temperature = best_temperature
 
+    generate_multiple_complete_beatmaps(dirs, output_folder, step_model, config, action_index=action_index,
+                                        model=model)
+    timer('Generated beatmaps', 5)
 
-def compute_complete_velocity(ser, window):
-    return window, ser.groupby(['name', 'difficulty']).apply(lambda ser_: compute_velocity(ser_, window))
-
-
-def compute_multiple_velocities(df, from_window_size=1, to_window_size=32):
-    pool = Pool()
-    params = [(df, window) for window in range(from_window_size, to_window_size + 1)]
-
-    cached_train_v = dict(pool.starmap(compute_complete_velocity, params))
-    #     Single-core version for laptops, etc.
-    #     cached_train_v = dict(starmap(compute_complete_velocity, params))
-
-    pool.close()
-    pool.join()
-    return cached_train_v
 
+def search_temperature(evaluate_temperatures: Callable[[List[float]], List[float]], bounds: Tuple[float, float],
+                       logging_path: Path) -> float:
+    """
+    Temperature with the lowest AVD distance. `evaluate_temperatures` generates a whole batch of temperatures
+    in one pass: first a grid of `GRID_SIZE`, then `BO_ROUNDS` of `BO_BATCH` Bayesian optimization candidates
+    proposed by UCB with different exploration weights.
+    """
+    optimizer = BayesianOptimization(f=None, pbounds={'temperature': bounds}, random_state=43)
+    if logging_path.exists():
+        optimizer = load_logs(optimizer, logs=str(logging_path))
+    logger = JSONLogger(path=str(logging_path))
+    optimizer.subscribe(Events.OPTIMIZATION_STEP, logger)
 
-from scipy.stats import ks_2samp
+    def register(temperatures):
+        for temperature, distance in zip(temperatures, evaluate_temperatures(temperatures)):
+            optimizer.register(params={'temperature': temperature}, target=-distance)  # we need to maximize
 
+    if not optimizer.res:
+        register(list(np.linspace(*bounds, GRID_SIZE)))
+    for _ in range(BO_ROUNDS):
+        candidates = [optimizer.suggest(UtilityFunction(kind='ucb', kappa=kappa, xi=0.0))['temperature']
+                      for kappa in np.linspace(0.5, 5.0, BO_BATCH)]
+        register(sorted(set(candidates)))
 
-def compute_ks_statistic(window1, data1, window2, data2):
-    assert window1 == window2
-    stat = ks_2samp(data1, data2)[0]
-    return window1, stat
+    print(f'{optimizer.max=}')
+    return optimizer.max['params']['temperature']
 
 
-def compute_avd_distance(val_velocities, generated_velocities):
-    pool = Pool()
+def temperature_streams(song_streams: List[GenerationStream],
+                        histograms: Dict[float, VelocityHistograms]) -> List[GenerationStream]:
+    """ Copies of the song streams generated with each temperature, their velocities are counted in `histograms` """
+    streams = []
+    for temperature, temperature_histograms in histograms.items():
+        for stream in song_streams:
+            path, difficulty, _ = stream.stream_id
+            streams.append(replace(stream, stream_id=(path, difficulty, temperature), seq=deepcopy(stream.seq),
+                                   temperature=temperature, velocities=VelocityTracker(temperature_histograms)))
+    return streams
 
-    params = [(w1, d1, w2, d2) for (w1, d1), (w2, d2) in zip(val_velocities.items(), generated_velocities.items())]
-    res = dict(pool.starmap(compute_ks_statistic, params))
-    #     Single-core version for laptops, etc.
-    #     res = dict(starmap(compute_ks_statistic, params))
 
-    pool.close()
-    pool.join()
-    return pd.Series(res).mean()
+def load_datasets(storage_folder) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    return [pd.read_pickle(storage_folder / f'{phase}_beatmaps.pkl') for phase in
+            ['train', 'val', 'test']]
 
 
-def velocities_from_config(config: Config):
-    song_folders = create_song_list(config.dataset.beat_maps_folder)
-    df = songs2dataset(song_folders, config)
-    print(df.head(2))
-    df_vec = get_vec_df(df)
-    generated_velocities_ = compute_multiple_velocities(df_vec)
-    return generated_velocities_
+def cosine_dist(a, b):
+    return 1 - np.sum(a * b, axis=-1) / (np.linalg.norm(a, axis=-1) * np.linalg.norm(b, axis=-1))
 
 
 if __name__ == '__main__':
@@ -1,26 +1,115 @@
 from pathlib import Path
+from typing import Dict, List, Optional
 
 import gensim
+import pandas as pd
 from tensorflow.keras.models import Model
 
 from predict.compute import zip_folder, update_generated_metadata, save_generated_beatmaps, \
-    copy_folder_contents, create_beatmap_dfs
+    copy_folder_contents, df2beatmap, GenerationStream, create_song_streams, create_audio_streams, generate_beatmaps, \
+    generate_beatmaps_in_graph, generate_beatmaps_with_beam_search
+from predict.constraints import TransitionMask, corpus_transition_mask
+from predict.diagnostics import GenerationMetrics, run_metrics_path, plot_in_background
+from predict.graph_generation import GraphGenerator
+from predict.index import ActionIndex
+from process.api import load_datasets
+from train.step import StepModel
 from utils.functions import create_word_mapping
-from utils.types import Config
+from utils.types import Config, JSON
 
 
-def generate_complete_beatmaps(beatmap_folder: Path, output_folder: Path, stateful_model: Model, config: Config):
-    gen_folder = output_folder / f'{beatmap_folder.name}_generated'
-    gen_folder.mkdir(parents=True, exist_ok=True)
+def generate_complete_beatmaps(beatmap_folder: Path, output_folder: Path, step_model: StepModel, config: Config):
+    generate_multiple_complete_beatmaps([beatmap_folder], output_folder, step_model, config)
+
+
+def generate_multiple_complete_beatmaps(beatmap_folders: List[Path], output_folder: Path, step_model: StepModel,
+                                        config: Config, action_index: Optional[ActionIndex] = None,
+                                        audio_only: bool = False, model: Optional[Model] = None):
+    """
+    All difficulties of all songs are generated together, see `generate_beatmaps`.
+    `word_id` models run the whole generation in the graph with `config.generation.in_graph`,
+    which needs the Keras `model` itself, or are decoded by a beam search with `config.generation.beam_width` > 1.
+    With `audio_only` the songs need no beatmaps, the beats are detected in the audio.
+    """
+    action_index = action_index or load_action_index(config)
+    generator = None
+    if config.generation.in_graph:
+        if model is None:
+            raise ValueError('Generation in the graph (`config.generation.in_graph`) needs the Keras `model`')
+        generator = GraphGenerator(model, action_index, config)
+    input_names = step_model.input_names if generator is None else generator.model.input_names
+    create_streams = create_audio_streams if audio_only else create_song_streams
+
+    streams = sum([create_streams(beatmap_folder, action_index, config, input_names=input_names)
+                   for beatmap_folder in beatmap_folders], [])
+    print(f'\n\tGenerating {len(streams)} beatmaps of {len(beatmap_folders)} songs')
+    if generator is not None:
+        beatmap_dfs = generate_beatmaps_in_graph(streams, generator, action_index, config)
+    elif config.generation.beam_width > 1:
+        beatmap_dfs = generate_beatmaps_with_beam_search(streams, step_model, action_index, config)
+    else:
+        beatmap_dfs = generate_beatmaps(streams, step_model, action_index, config)
+
+    save_run_metrics(streams, action_index, config)
+
+    for beatmap_folder in beatmap_folders:
+        song_dfs = {difficulty: beatmap_df for (folder, difficulty, _), beatmap_df in beatmap_dfs.items()
+                    if folder == beatmap_folder}
+        save_generated_song(beatmap_folder, output_folder, song_dfs, action_index, config)
+
+
+def save_run_metrics(streams: List[GenerationStream], action_index: ActionIndex, config: Config):
+    """ Stores the velocities of the generated beatmaps, the histograms are plotted only on demand """
+    if config.generation.metrics_folder is None:
+        return
+    metrics = GenerationMetrics(config.dataset.avd_max_window)
+    for stream in streams:
+        metrics.add_stream(stream, action_index)
+    path = run_metrics_path(config)
+    metrics.save(path)
+    if config.generation.velocity_plots:
+        plot_in_background(metrics, path.with_suffix('.pdf'))
 
+
+def load_action_index(config: Config) -> ActionIndex:
     action_model = gensim.models.KeyedVectors.load(str(config.dataset.action_word_model_path))
-    word_id_dict = create_word_mapping(action_model)
+    action_index = ActionIndex(action_model, create_word_mapping(action_model), config,
+                               num_clusters=config.generation.action_clusters,
+                               num_probes=config.generation.action_probes)
+    if config.generation.playability_mask:
+        action_index.transition_mask = load_transition_mask(action_index, config)
+    return action_index
+
+
+def load_transition_mask(action_index: ActionIndex, config: Config) -> TransitionMask:
+    """ Loads the transition mask of the action vocabulary, creates it from the training dataset the first time """
+    path = config.dataset.transition_mask_path
+    if path.exists():
+        transition_mask = TransitionMask.load(path)
+        if transition_mask.num_words == len(action_index.id_vectors):
+            return transition_mask
+
+    train, _, _ = load_datasets(config)
+    transition_mask = corpus_transition_mask(train, action_index.word_attributes, config)
+    transition_mask.save(path)
+    return transition_mask
+
 
-    beatmap_dfs = create_beatmap_dfs(stateful_model, action_model, word_id_dict, beatmap_folder, config)
+def save_generated_song(beatmap_folder: Path, output_folder: Path, song_dfs: Dict[str, pd.DataFrame],
+                        action_index: ActionIndex, config: Config) -> Path:
+    """ Writes the generated difficulties of the song next to a copy of its folder, returns the zip file """
+    beatmaps = {difficulty: df2beatmap(df, action_index, config) for difficulty, df in song_dfs.items()}
+    return save_song_beatmaps(beatmap_folder, output_folder, beatmaps, config)
+
+
+def save_song_beatmaps(beatmap_folder: Path, output_folder: Path, beatmaps: Dict[str, JSON], config: Config) -> Path:
+    gen_folder = output_folder / f'{beatmap_folder.name}_generated'
+    gen_folder.mkdir(parents=True, exist_ok=True)
 
     copy_folder_contents(beatmap_folder, gen_folder)
-    save_generated_beatmaps(gen_folder, beatmap_dfs, action_model, word_id_dict, config)
+    save_generated_beatmaps(gen_folder, beatmaps)
 
     update_generated_metadata(gen_folder, beatmap_folder, config)
 
     zip_folder(gen_folder)
+    return (gen_folder / gen_folder.name).with_suffix('.zip')
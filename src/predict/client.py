@@ -0,0 +1,30 @@
+""" Client of the local generation service, see `predict.server` """
+import json
+from pathlib import Path
+from typing import Dict, Optional
+from urllib import request
+
+from utils.types import Config
+
+
+class GenerationClient:
+
+    def __init__(self, config: Config, timeout: float = 3600):
+        self.url = f'http://{config.generation.server_host}:{config.generation.server_port}'
+        self.timeout = timeout
+
+    def generate(self, song_folder: Path, output_folder: Path, temperature: Optional[float] = None,
+                 audio_only: bool = False) -> Dict:
+        """ Blocks until the song is generated, returns the zip file and the latency seen by the server """
+        content = {'song_folder': str(song_folder), 'output_folder': str(output_folder), 'audio_only': audio_only}
+        if temperature is not None:
+            content['temperature'] = temperature
+        return self.call('/generate', json.dumps(content).encode())
+
+    def metrics(self) -> Dict[str, float]:
+        return self.call('/metrics')
+
+    def call(self, path: str, data: Optional[bytes] = None) -> Dict:
+        headers = {'Content-Type': 'application/json'}
+        with request.urlopen(request.Request(self.url + path, data, headers), timeout=self.timeout) as response:
+            return json.loads(response.read())
@@ -1,21 +1,25 @@
 import json
+from copy import deepcopy
+from dataclasses import dataclass
 from functools import reduce
 from itertools import product
 from pathlib import Path
 from shutil import copy
 from time import time
-from typing import Dict, Tuple
+from typing import Dict, Tuple, Hashable, List, Optional
 from zipfile import ZipFile
 
-import gensim
 import numpy as np
 import pandas as pd
-from scipy.special import softmax
-from tensorflow.keras import Model
 
-from process.api import df_post_processing, normalize_columns
-from process.compute import process_song_folder
-from train.sequence import BeatmapSequence
+from predict.decoding import sample_ids, beam_search, ids2attributes
+from predict.graph_generation import GraphGenerator
+from predict.index import ActionIndex
+from predict.inputs import GenerationInputs, create_generation_inputs, song_inputs
+from predict.states import StreamStates
+from process.compute import process_song_folder, process_song_audio, add_multiindex
+from train.step import StepModel
+from utils.avd import VelocityTracker
 from utils.types import Config, JSON
 
 
@@ -42,57 +46,186 @@ def create_info(bpm):
     return info
 
 
-def generate_beatmap(beatmap_df: pd.DataFrame, seq: BeatmapSequence, stateful_model: Model,
-                     action_model: gensim.models.KeyedVectors,
-                     word_id_dict: Dict[str, int], config: Config):
-    most_recent = {col: seq[0][0][col][:, 0:1] for col in stateful_model.input_names}  # initial beat
-    output_names = [f'prev_{name}' for name in stateful_model.output_names]  # For TF 2.1 compatibility
-    reverse_word_id_dict = {val: key for key, val in word_id_dict.items()}
-
-    # Reset the whole seq.data columns except for the first action to prevent information leaking
-    for col in product(['', 'prev_'], ['word_id', 'word_vec'] + config.dataset.beat_elements):
-        seq.data[''.join(col)][:, 1:, :] = 0.0
+@dataclass
+class GenerationStream:
+    """ One independently generated beatmap, a row of the batched step calls """
+    stream_id: Hashable
+    beatmap_df: pd.DataFrame
+    seq: GenerationInputs
+    temperature: float
+    beat: int = 0  # the action of this beat is the input of the next step
+    velocities: Optional[VelocityTracker] = None  # AVD of the generated beats, see `utils.avd`
+
+    @property
+    def done(self) -> bool:
+        return self.beat >= len(self.beatmap_df) - 1
+
+
+def generate_beatmaps(streams: List[GenerationStream], step_model: StepModel, action_index: ActionIndex,
+                      config: Config) -> Dict[Hashable, pd.DataFrame]:
+    """
+    Generates all `streams` together, up to `config.generation.batch_size` of them share a single step call.
+    Streams of shorter songs retire early, the remaining ones continue in smaller batches.
+    """
+    generate_streams(streams, step_model, action_index, config)
+    return {stream.stream_id: finish_stream(stream, step_model.output_names, config) for stream in streams}
+
+
+def generate_streams(streams: List[GenerationStream], step_model: StepModel, action_index: ActionIndex,
+                     config: Config):
+    """ Generates the actions of `streams` into their inputs, see `generate_beatmaps` """
+    states = StreamStates(step_model.state_sizes)
+    step_inputs = {}
+    for stream in streams:
+        step_inputs[stream.stream_id] = start_stream(stream, step_model.input_names, config)
+        states.start(stream.stream_id)
 
     start = time()
-    total_len = len(beatmap_df) - 1
-    temperature = config.generation.temperature  # TODO: change toconfig.generation.temperature(0)
-    for i in range(len(beatmap_df) - 1):
+    total_len = max(len(stream.beatmap_df) for stream in streams) - 1
+    batch_size = max(1, config.generation.batch_size)
+    for i in range(total_len):
         elapsed = time() - start
         print(f'\r{i:4}: {int(elapsed):3} / ~{int(elapsed * total_len / (i + 1)):3} s', end='', flush=True)
-        pred = stateful_model.predict(most_recent)
+        active = [stream for stream in streams if not stream.done]
 
-        # word_vec to word_id prob
-        if 'word_vec' in stateful_model.output_names:
-            closest_words = action_model.similar_by_vector(pred['word_vec'].flatten(), topn=30, restrict_vocab=None)
+        for batch_start in range(0, len(active), batch_size):
+            step_streams(active[batch_start:batch_start + batch_size], step_inputs, states, step_model,
+                         action_index, config)
 
-            pred['word_id'] = np.zeros((1, 1, config.dataset.num_classes['word_id']))
-            for word, distance in closest_words:
-                pred['word_id'][:, :, word_id_dict[word]] = distance
 
-        update_next(i, pred, seq, temperature, config)
+def start_stream(stream: GenerationStream, input_names: List[str], config: Config) -> Dict[str, np.ndarray]:
+    """ Clears the generated columns of `stream` and returns its step inputs of the initial beat """
+    clear_generated_actions(stream.seq, config)
+    stream.beat = 0
+    step_inputs = create_step_inputs(stream.seq, input_names)
+    fill_step_inputs(step_inputs, stream.seq, 0)
+    return step_inputs
 
-        update_action_representations(i, action_model, seq, word_id_dict, pred, reverse_word_id_dict, config)
-
-        if set(stateful_model.output_names) >= set(config.dataset.beat_elements):
-            clip_next_to_closest_existing(i, action_model, seq, word_id_dict, config)
 
+def clear_generated_actions(seq: GenerationInputs, config: Config):
+    """ Resets the action columns except for the first action to prevent information leaking """
+    for col in product(['', 'prev_'], ['word_id', 'word_vec'] + config.dataset.beat_elements):
+        if ''.join(col) in seq.data:
+            seq.data[''.join(col)][:, 1:, :] = 0.0
+
+
+def step_streams(batch: List[GenerationStream], step_inputs: Dict[Hashable, Dict[str, np.ndarray]],
+                 states: StreamStates, step_model: StepModel, action_index: ActionIndex, config: Config):
+    """ Generates the next beat of each stream of `batch` with a single step call, the streams may be at any beat """
+    stream_ids = [stream.stream_id for stream in batch]
+    inputs = {col: np.concatenate([step_inputs[stream_id][col] for stream_id in stream_ids])
+              for col in step_model.input_names}
+    pred, new_states = step_model(inputs, states.batch(stream_ids))
+    states.update(stream_ids, new_states)
+
+    generate_next(batch, pred, step_model, action_index, config)
+    for stream in batch:
+        stream.beat += 1
         # get last action in the correct format
-        most_recent = {col: seq[0][0][col][:, i + 1:i + 2] for col in stateful_model.input_names}
+        fill_step_inputs(step_inputs[stream.stream_id], stream.seq, stream.beat)
+        if stream.velocities is not None:
+            track_velocities(stream, action_index)
+
+
+def track_velocities(stream: GenerationStream, action_index: ActionIndex):
+    """ Adds the actions of `stream` up to its current beat, which were not added yet, to its velocities """
+    word_ids = stream.seq.data['prev_word_id'][0, stream.velocities.num_beats:stream.beat + 1, 0].astype(int)
+    stream.velocities.add(action_index.id_vectors[word_ids])
+
+
+def generate_beatmaps_in_graph(streams: List[GenerationStream], generator: GraphGenerator,
+                               action_index: ActionIndex, config: Config) -> Dict[Hashable, pd.DataFrame]:
+    """ `generate_beatmaps` of `word_id` models, all streams are generated by a single `GraphGenerator` call """
+    for stream in streams:
+        clear_generated_actions(stream.seq, config)
+
+    word_ids = generator([stream.seq for stream in streams], [stream.temperature for stream in streams])
+    for stream, stream_word_ids in zip(streams, word_ids):
+        stream.seq.data['prev_word_id'][0, :, 0] = stream_word_ids
+        stream.seq.data['prev_word_vec'][0] = action_index.id_vectors[stream_word_ids]
+
+    return {stream.stream_id: finish_stream(stream, generator.model.output_names, config) for stream in streams}
+
+
+def generate_beatmaps_with_beam_search(streams: List[GenerationStream], step_model: StepModel,
+                                      action_index: ActionIndex, config: Config) -> Dict[Hashable, pd.DataFrame]:
+    """ `generate_beatmaps` of `word_id` models with the most probable actions, see `predict.decoding.beam_search` """
+    for stream in streams:
+        clear_generated_actions(stream.seq, config)
+
+    word_ids = beam_search([stream.seq for stream in streams], step_model, action_index, config)
+    for stream, stream_word_ids in zip(streams, word_ids):
+        first_attributes = [stream.seq.data[f'prev_{col}'][0, 0, 0] for col in action_index.beat_elements]
+        attributes = ids2attributes(stream_word_ids, np.array(first_attributes, dtype=int), action_index)
+        stream.seq.data['prev_word_id'][0, :, 0] = stream_word_ids
+        stream.seq.data['prev_word_vec'][0] = action_index.id_vectors[stream_word_ids]
+        for col, values in zip(action_index.beat_elements, attributes.T):
+            stream.seq.data[f'prev_{col}'][0, :, 0] = values
+
+    return {stream.stream_id: finish_stream(stream, step_model.output_names, config) for stream in streams}
 
-        # Experiment with moving temperature based on AVD distance. Needs further research
-        # temperature = responsive_temperature(seq, temperature, i)
 
-    save_velocity_hist(seq, config)
-    beatmap_df = predictions2df(beatmap_df, seq)
-    # beatmap_df = append_last_prediction(beatmap_df, most_recent)    # TODO: Remove if unnecessary
+def finish_stream(stream: GenerationStream, output_names: List[str], config: Config) -> pd.DataFrame:
+    beatmap_df = predictions2df(stream.beatmap_df, stream.seq)
+    # beatmap_df = append_last_prediction(beatmap_df, step_inputs)    # TODO: Remove if unnecessary
 
-    for col in stateful_model.output_names:
+    for col in output_names:
         beatmap_df[col] = beatmap_df[f'prev_{col}']
+    return beatmap_df[output_names]  # output only generated columns
+
+
+def generated_rows2df(stream: GenerationStream, output_names: List[str], start: int, end: int) -> pd.DataFrame:
+    """ `finish_stream` of the beats `start:end` of a stream still being generated """
+    beatmap_df = stream.beatmap_df.iloc[start:end].copy()
+    for col in output_names:
+        val = stream.seq.data[f'prev_{col}'][:, start:end]
+        beatmap_df[col] = np.split(val.flatten(), val.shape[1])
+    return beatmap_df.reset_index('name').drop(columns='name')
+
+
+def generate_next(batch: List[GenerationStream], pred: Dict[str, np.ndarray], step_model: StepModel,
+                  action_index: ActionIndex, config: Config):
+    """ Chooses the next action of each stream of `batch` from the batched step model prediction `pred` """
+    # word_vec to word_id prob
+    if 'word_vec' in step_model.output_names:
+        closest, similarities = action_index.query(pred['word_vec'][:, 0], k=30, restrict_vocab=None)
+
+        pred['word_id'] = np.zeros((len(batch), 1, len(action_index.id_vectors)))
+        np.put_along_axis(pred['word_id'][:, 0], action_index.word_ids[closest], similarities, axis=-1)
+
+    logit_mask = None
+    if action_index.transition_mask is not None:
+        prev_ids = [stream.seq.data['prev_word_id'][0, stream.beat, 0] for stream in batch]
+        logit_mask = action_index.transition_mask.logit_mask(prev_ids)
+
+    update_next(batch, pred, config, logit_mask)
+
+    for stream in batch:
+        update_action_representations(stream.beat, action_index, stream.seq, pred)
+
+        if set(step_model.output_names) >= set(config.dataset.beat_elements):
+            clip_next_to_closest_existing(stream.beat, action_index, stream.seq)
+
+        # Experiment with moving temperature based on AVD distance. Needs further research
+        # stream.temperature = responsive_temperature(stream.seq, stream.temperature, stream.beat)
+
+
+def create_step_inputs(seq: GenerationInputs, input_names) -> Dict[str, np.ndarray]:
+    """ Preallocated inputs of a single beat, refilled in place by `fill_step_inputs` """
+    return {col: np.zeros((seq.num_snippets, 1, seq.shapes[col][-1]), dtype='float32') for col in input_names}
 
-    return beatmap_df[stateful_model.output_names]  # output only generated columns
 
+def fill_step_inputs(step_inputs: Dict[str, np.ndarray], seq: GenerationInputs, i: int):
+    """ Direct slice of beat `i` in `seq.data`, one-hot encodes the categorical columns in place """
+    for col, val in step_inputs.items():
+        if col in seq.categorical_cols:
+            val.fill(0.0)
+            np.put_along_axis(val, seq.data[col][:, i:i + 1].astype(int), 1.0, axis=-1)
+        else:
+            val[:] = seq.data[col][:, i:i + 1]
 
-def responsive_temperature(seq: BeatmapSequence, temperature, i):
+
+def responsive_temperature(seq: GenerationInputs, temperature, i):
     window_size = 9
     new = seq.data['prev_word_vec'][:, i - window_size + 1:i + 1].mean(axis=1)
     old = seq.data['prev_word_vec'][:, i - window_size - window_size // 2:i - window_size // 2 + 1].mean(axis=1)
@@ -105,76 +238,40 @@ def responsive_temperature(seq: BeatmapSequence, temperature, i):
     return temperature
 
 
-def cosine_dist(a, b):
-    return 1 - np.sum(a * b, axis=-1) / (np.linalg.norm(a, axis=-1) * np.linalg.norm(b, axis=-1))
+def update_action_representations(i: int, action_index: ActionIndex, seq: GenerationInputs,
+                                  pred: Dict[str, np.ndarray]):
+    # update all representations, to make interesting models possible without data leaking.
+    if 'word_id' in pred.keys():  # `word_id` is the prefered action representation
+        word_id = int(seq.data['prev_word_id'][0, i + 1, 0])
+        seq.data['prev_word_vec'][:, i + 1] = action_index.id_vectors[word_id]
+        word_id2per_attribute(i, word_id, action_index, seq)
+    elif 'word_vec' in pred.keys():
+        word_id = action_index.closest_word_ids(seq.data['prev_word_vec'][:, i + 1])[0]
+        seq.data['prev_word_id'][:, i + 1] = word_id
+        word_id2per_attribute(i, word_id, action_index, seq)
+    else:
+        code = per_attribute2action_code(i, action_index, seq)
+        seq.data['prev_word_vec'][:, i + 1] = action_index.code_vectors[code]
+        seq.data['prev_word_id'][:, i + 1] = action_index.code_word_ids[code]
 
 
-def l2_dist(a, b):
-    diff = a - b
-    dist = ((diff.dropna() ** 2).sum(axis=1)) ** (1 / 2)
-    return dist
+def per_attribute2action_code(i: int, action_index: ActionIndex, seq: GenerationInputs) -> int:
+    attributes = [seq.data[f'prev_{col}'][0, i + 1, 0] for col in action_index.beat_elements]
+    return int(action_index.action_code(attributes))
 
 
-def save_velocity_hist(seq: BeatmapSequence, config: Config):
-    mean = pd.DataFrame(seq.data['prev_word_vec'][0]).rolling(7).mean()
-    velocity = l2_dist(mean, mean.shift(4))
-    # velocity = cosine_dist(mean.values, mean.shift(4).values)
-    ax = pd.Series(velocity).dropna().plot.hist(bins=24, figsize=(14, 6), density=True, alpha=0.5, )
-    ax.set_xlim(0, 5)
-    fig = ax.get_figure()
-    fig.savefig(config.base_data_folder / 'temp' / 'distribution.pdf')
+def clip_next_to_closest_existing(i: int, action_index: ActionIndex, seq: GenerationInputs):
+    word_id = action_index.code_word_ids[per_attribute2action_code(i, action_index, seq)]
+    seq.data['prev_word_id'][:, i + 1] = word_id
+    seq.data['prev_word_vec'][:, i + 1] = action_index.id_vectors[word_id]
 
+    word_id2per_attribute(i, word_id, action_index, seq)
 
-def update_action_representations(i: int, action_model: gensim.models.KeyedVectors, seq: BeatmapSequence,
-                                  word_id_dict: Dict[str, int], pred: Dict[str, np.ndarray],
-                                  reverse_word_id_dict: Dict[int, np.ndarray], config: Config):
-    # update all representations, to make interesting models possible without data leaking.
-    if 'word_id' in pred.keys():  # `word_id` is the prefered action representation
-        word_str = reverse_word_id_dict[int(seq.data['prev_word_id'][:, i + 1])]
-        seq.data['prev_word_vec'][:, i + 1] = action_model[word_str]
-        word_str2per_attribute(i, word_str, seq)
-    elif 'word_vec' in pred.keys():
-        closest_word_str = action_model.similar_by_vector(seq.data['prev_word_vec'][:, i + 1],
-                                                          topn=1, restrict_vocab=config.generation.restrict_vocab)[0][0]
-        seq.data['prev_word_id'][:, i + 1] = word_id_dict[closest_word_str]
-        word_str2per_attribute(i, closest_word_str, seq)
-    else:
-        prev_word = per_attribute2word_str(i, seq)
-        seq.data['prev_word_vec'][:, i + 1] = action_model[prev_word]
-        closest_word_str = action_model.similar_by_vector(seq.data['prev_word_vec'][:, i + 1],
-                                                          topn=1, restrict_vocab=config.generation.restrict_vocab)[0][0]
-        seq.data['prev_word_id'][:, i + 1] = word_id_dict[closest_word_str]
-
-
-def per_attribute2word_str(i: int, seq: BeatmapSequence):
-    word = []
-    for hand in 'lr':
-        word += [hand.upper()]
-        word += [np.argmax(seq.data[f'prev_{hand}_{name}'][:, i + 1], axis=-1).astype(str)[0] for name in
-                 ['lineLayer', 'lineIndex', 'cutDirection']]
-        word += ['_']
-    prev_word = ''.join(word[:-1])
-    return prev_word
-
-
-def clip_next_to_closest_existing(i: int, action_model: gensim.models.KeyedVectors, seq: BeatmapSequence,
-                                  word_id_dict: Dict[str, int], config: Config):
-    prev_word = per_attribute2word_str(i, seq)
-    closest_word_str = action_model.similar_by_vector(action_model[prev_word],
-                                                      topn=1, restrict_vocab=config.generation.restrict_vocab)[0][0]
-    seq.data['prev_word_id'][:, i + 1] = word_id_dict[closest_word_str]
-    seq.data['prev_word_vec'][:, i + 1] = action_model[closest_word_str]
-    closest_word_str = seq.data['prev_word']
-
-    word_str2per_attribute(i, closest_word_str, seq)
-
-
-def word_str2per_attribute(i: int, closest_word_str: str, seq: BeatmapSequence):
-    action_dim_values = *closest_word_str[1:4], *closest_word_str[-3:]  # extract first and last beat elements
-    for (hand, dim), chosen_index in zip(product('lr', ['lineLayer', 'lineIndex', 'cutDirection']),
-                                         action_dim_values):
-        col = f'prev_{hand}_{dim}'
-        if closest_word_str == 'UNK' or closest_word_str == 'MASK':
+
+def word_id2per_attribute(i: int, word_id: int, action_index: ActionIndex, seq: GenerationInputs):
+    for col, chosen_index in zip(action_index.beat_elements, action_index.word_attributes[word_id]):
+        col = f'prev_{col}'
+        if chosen_index < 0:  # UNK or MASK
             seq.data[col][:, i + 1] = seq.data[col][:, i]
         else:
             seq.data[col][:, i + 1] = chosen_index
@@ -188,27 +285,30 @@ def append_last_prediction(beatmap_df: pd.DataFrame, most_recent):
     return beatmap_df
 
 
-def predictions2df(beatmap_df: pd.DataFrame, seq: BeatmapSequence):
+def predictions2df(beatmap_df: pd.DataFrame, seq: GenerationInputs):
     for col, val in seq.data.items():
         beatmap_df[col] = np.split(val.flatten(), val.shape[1])
     beatmap_df = beatmap_df.reset_index('name').drop(columns='name')
     return beatmap_df
 
 
-# @numba.njit()
-def update_next(i: int, pred: Dict[str, np.ndarray], seq: BeatmapSequence, temperature, config: Config):
-    # for col, val in zip(output_names, pred):  # TF 2.1
+def update_next(batch: List[GenerationStream], pred: Dict[str, np.ndarray], config: Config,
+                logit_mask: Optional[np.ndarray] = None):
+    """
+    Samples the categorical outputs of all streams together, see `predict.decoding.sample_ids`.
+    `logit_mask` of the playability constraints applies to `word_id`.
+    """
+    temperatures = np.array([stream.temperature for stream in batch])
     for col, val in pred.items():  # TF 2.2+
         col = f'prev_{col}'
 
-        if col in seq.categorical_cols:
-            # with np.errstate(divide='ignore'):
-            val = np.log(val + 1e-9) / np.max([temperature, 1e-6])
-            val = softmax(val, axis=-1)
-            chosen_index = np.random.choice(np.arange(val.shape[-1]), p=val.flatten() / np.sum(val))  # categorical dist
-            seq.data[col][:, i + 1] = chosen_index
+        if col in batch[0].seq.categorical_cols:
+            values = sample_ids(val[:, 0], temperatures, config.generation.top_k, config.generation.top_p,
+                                logit_mask=logit_mask if col == 'prev_word_id' else None)
         else:  # regression cols
-            seq.data[col][:, i + 1] = val
+            values = val[:, 0]
+        for stream, value in zip(batch, values):
+            stream.seq.data[col][:, stream.beat + 1] = value
 
 
 def zip_folder(folder_path: Path):
@@ -220,8 +320,11 @@ def zip_folder(folder_path: Path):
 
 
 def update_generated_metadata(gen_folder: Path, beatmap_folder: Path, config: Config):
-    info_file: Path = [x for x in beatmap_folder.glob('*.dat') if x.name.lower() == 'info.dat'][0]
-    with open(info_file, 'r') as rf:
+    info_files = [x for x in beatmap_folder.glob('*.dat') if x.name.lower() == 'info.dat']
+    if not info_files:  # songs without beatmaps
+        create_generated_metadata(gen_folder, beatmap_folder, config)
+        return
+    with open(info_files[0], 'r') as rf:
         info = json.load(rf)
         difficulties = info['_difficultyBeatmapSets'][0]['_difficultyBeatmaps']
         info['_difficultyBeatmapSets'][0]['_difficultyBeatmaps'] = [x for x in difficulties if x['_difficulty']
@@ -236,11 +339,25 @@ def update_generated_metadata(gen_folder: Path, beatmap_folder: Path, config: Co
             json.dump(info, wf)
 
 
-def save_generated_beatmaps(gen_folder: Path, beatmap_dfs: Dict[str, pd.DataFrame],
-                            action_model: gensim.models.KeyedVectors,
-                            word_id_dict: Dict[str, int], config):
-    for difficulty, df in beatmap_dfs.items():
-        beatmap = df2beatmap(df, action_model, word_id_dict, config)
+def create_generated_metadata(gen_folder: Path, beatmap_folder: Path, config: Config):
+    info = create_info(60)
+    info['_songFilename'] = [x.name for x in beatmap_folder.glob('*.*gg')][0]
+    info['_difficultyBeatmapSets'] = [{
+        '_beatmapCharacteristicName': 'Standard',
+        '_difficultyBeatmaps': [{'_difficulty': difficulty,
+                                 '_difficultyRank': 2 * config.dataset.difficulty_mapping[difficulty] + 1,
+                                 '_beatmapFilename': f'{difficulty}.dat',
+                                 '_noteJumpMovementSpeed': 10,
+                                 '_noteJumpStartBeatOffset': 0}
+                                for difficulty in config.training.use_difficulties],
+    }]
+
+    with open(gen_folder / 'info.dat', 'w') as wf:
+        json.dump(info, wf)
+
+
+def save_generated_beatmaps(gen_folder: Path, beatmaps: Dict[str, JSON]):
+    for difficulty, beatmap in beatmaps.items():
         with open(gen_folder / f'{difficulty}.dat', 'w') as wf:
             json.dump(beatmap, wf)
 
@@ -251,55 +368,85 @@ def copy_folder_contents(in_folder: Path, out_folder: Path):
             copy(file, out_folder)
 
 
-def create_beatmap_dfs(stateful_model: Model, action_model: gensim.models.KeyedVectors,
-                       word_id_dict: Dict[str, int], path: Path, config: Config) -> Dict[str, pd.DataFrame]:
-    df = process_song_folder(str(path), config)
-    df = df_post_processing(df, config)
-    df = normalize_columns(df, config)
+def create_song_streams(path: Path, action_index: ActionIndex, config: Config,
+                        temperatures: Optional[List[float]] = None, stats: Optional[pd.DataFrame] = None,
+                        input_names: Optional[List[str]] = None) -> List[GenerationStream]:
+    """
+    A stream for each generated difficulty of the song and each of `temperatures`, identified by the triple.
+    Only `use_difficulties` are processed and only the model `input_names` (all `x_groups` if not given) computed,
+    see `predict.inputs`. Loaded normalization `stats` can be given to avoid reading them from the disk.
+    """
+    df = process_song_folder(str(path), config, difficulties=config.training.use_difficulties)
+    inputs = song_inputs(df, input_names or x_cols(config), action_index, load_stats(stats, config), config)
+    return inputs2streams(path, inputs, config, temperatures)
+
+
+def create_audio_streams(path: Path, action_index: ActionIndex, config: Config,
+                         temperatures: Optional[List[float]] = None, stats: Optional[pd.DataFrame] = None,
+                         input_names: Optional[List[str]] = None) -> List[GenerationStream]:
+    """ `create_song_streams` of a song without beatmaps, the beats are the onsets detected in its audio """
+    beats_df = process_song_audio(str(path), config)
+    stats = load_stats(stats, config)
+    inputs = {}
+    for difficulty in config.training.use_difficulties:
+        index_df = add_multiindex(pd.DataFrame(index=beats_df.index), difficulty, path.name)
+        seq = create_generation_inputs(beats_df, difficulty, None, input_names or x_cols(config), action_index,
+                                       stats, config)
+        inputs[difficulty] = (index_df, seq)
+    return inputs2streams(path, inputs, config, temperatures)
+
+
+def x_cols(config: Config) -> List[str]:
+    return sum([list(cols) for cols in config.training.x_groups], [])
 
-    config.beat_preprocessing.snippet_window_length = len(df)
-    config.training.batch_size = config.generation.batch_size
-    output = {}
 
-    for difficulty, sub_df in df.groupby('difficulty'):
-        if difficulty not in config.training.use_difficulties:
-            continue
-        print(f'\n\tGenerating {difficulty}')
-        seq = BeatmapSequence(df=sub_df, is_train=False, config=config)
+def load_stats(stats: Optional[pd.DataFrame], config: Config) -> pd.DataFrame:
+    return pd.read_pickle(config.dataset.normalization_stats_path) if stats is None else stats
 
-        # beatmap_df = sub_df.copy()    # bypass the generation
-        beatmap_df = generate_beatmap(sub_df.copy(), seq, stateful_model, action_model,
-                                      word_id_dict, config)
-        stateful_model.reset_states()
 
-        output[difficulty] = beatmap_df
-    return output
+def inputs2streams(path: Path, inputs: Dict[str, Tuple[pd.DataFrame, GenerationInputs]], config: Config,
+                   temperatures: Optional[List[float]] = None) -> List[GenerationStream]:
+    streams = []
+    for difficulty, (index_df, seq) in inputs.items():
+        for i, temperature in enumerate(temperatures or [config.generation.temperature]):
+            stream_seq = seq if i == 0 else deepcopy(seq)  # every stream writes its actions into the inputs
+            streams.append(GenerationStream((path, difficulty, temperature), index_df.copy(), stream_seq, temperature))
+    return streams
 
 
-def df2beatmap(df: pd.DataFrame, action_model: gensim.models.KeyedVectors,
-               word_id_dict: Dict[str, int], config: Config, bpm: int = 60, events: Tuple = ()) -> JSON:
-    beatmap = {
+def create_beatmap_dfs(step_model: StepModel, action_index: ActionIndex, path: Path,
+                       config: Config) -> Dict[str, pd.DataFrame]:
+    streams = create_song_streams(path, action_index, config, input_names=step_model.input_names)
+    print(f'\n\tGenerating {", ".join(stream.stream_id[1] for stream in streams)}')
+    beatmap_dfs = generate_beatmaps(streams, step_model, action_index, config)
+    return {difficulty: beatmap_df for (_, difficulty, _), beatmap_df in beatmap_dfs.items()}
+
+
+def df2beatmap(df: pd.DataFrame, action_index: ActionIndex, config: Config, bpm: int = 60,
+               events: Tuple = ()) -> JSON:
+    return create_beatmap(df2notes(df, action_index, config), events)
+
+
+def create_beatmap(notes: List[JSON], events: Tuple = ()) -> JSON:
+    return {
         '_version': '2.0.0',
         '_BPMChanges': [],
-        '_notes': [],
+        '_notes': notes,
         '_events': events,
     }
+
+
+def df2notes(df: pd.DataFrame, action_index: ActionIndex, config: Config) -> List[JSON]:
     df.index = df.index.to_frame()['time']  # only time from the multiindex is needed
-    inverse_word_id_dict = {val: key for key, val in word_id_dict.items()}
     if 'word_id' in df.columns:
         df['word_id'] = np.array(df['word_id'].to_list()).flatten()
         df = df.loc[df['word_id'] > 1]
-        word = df['word_id'].map(lambda word_id: inverse_word_id_dict[word_id])
-        beatmap['_notes'] += word_ser2json(word)
+        return word_id_ser2json(df['word_id'], action_index)
     elif 'word_vec' in df.columns:
-        word = df['word_vec'].map(lambda vec:
-                                  action_model.similar_by_vector(vec, topn=1,
-                                                                 restrict_vocab=config.generation.restrict_vocab)[0][0])
-        beatmap['_notes'] += word_ser2json(word)
+        word_ids = action_index.closest_word_ids(np.stack(df['word_vec'].map(np.ravel).to_numpy()))
+        return word_id_ser2json(pd.Series(word_ids, index=df.index), action_index)
     else:
-        beatmap['_notes'] += double_beat_element2json(df, config)
-
-    return beatmap
+        return double_beat_element2json(df, config)
 
 
 def double_beat_element2json(df: pd.DataFrame, config: Config):
@@ -334,14 +481,11 @@ def double_beat_element2json(df: pd.DataFrame, config: Config):
     return notes
 
 
-def word_ser2json(word: pd.Series) -> Dict:
-    word = word.str.split('_').explode()
-    df_t = pd.DataFrame(word.str.split('').tolist(),
-                        columns=['drop', 'hand', '_lineLayer', '_lineIndex', '_cutDirection', 'drop'], )
+def word_id_ser2json(word_id: pd.Series, action_index: ActionIndex) -> List[JSON]:
+    """ Notes of both hands of the actions `word_id` indexed by time, UNK and MASK have to be removed before """
+    attributes = action_index.word_attributes[word_id.to_numpy().astype(int)].reshape(-1, 3)  # left and right hand rows
+    df_t = pd.DataFrame(attributes, columns=['_lineLayer', '_lineIndex', '_cutDirection'])
 
-    df_t['_type'] = 0
-    df_t.loc[df_t['hand'] == 'R', '_type'] = 1
-    df_t = df_t.drop(columns=['hand', 'drop'])
-    df_t = df_t.astype(int)
-    df_t['_time'] = word.index
+    df_t['_type'] = np.tile([0, 1], len(word_id))
+    df_t['_time'] = np.repeat(word_id.index.to_numpy(), 2)
     return df_t.to_dict('records')
@@ -0,0 +1,96 @@
+"""
+Playability constraints of the generated actions, precomputed as a sparse `prev word_id x next word_id` mask.
+
+A transition is allowed when it passes the hand-written rules and it was seen in the training beatmaps.
+Previous actions with too few transitions in the corpus keep all transitions allowed by the rules.
+The sampler gathers the rows of the previous actions and adds them to the logits, see `TransitionMask.logit_mask`.
+"""
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from utils.types import Config
+
+DOT = 8  # `_cutDirection` of notes, which can be cut in any direction
+
+
+class TransitionMask:
+    """ Allowed transitions between actions, a sparse boolean matrix (num_words, num_words) """
+
+    def __init__(self, allowed: sparse.spmatrix):
+        self.allowed = sparse.csr_matrix(allowed, dtype=bool)
+
+    @property
+    def num_words(self) -> int:
+        return self.allowed.shape[0]
+
+    def logit_mask(self, prev_ids: np.ndarray) -> np.ndarray:
+        """ 0 for the allowed and -inf for the forbidden next actions of each of `prev_ids` (batch, num_words) """
+        allowed = self.allowed[np.asarray(prev_ids, dtype=int)].toarray()
+        return np.where(allowed, 0.0, -np.inf).astype('float32')
+
+    def save(self, path: Path):
+        sparse.save_npz(path, self.allowed)
+
+    @classmethod
+    def load(cls, path: Path) -> 'TransitionMask':
+        return cls(sparse.load_npz(path))
+
+
+def create_transition_mask(prev_word_ids: np.ndarray, word_ids: np.ndarray, word_attributes: np.ndarray,
+                           config: Config, chunk_size: int = 1024) -> TransitionMask:
+    """
+    Mask of the observed transitions `prev_word_ids` -> `word_ids` which pass `transition_rules`.
+    `word_attributes` is the `word_id` -> attributes table of `ActionIndex`, its rows define the vocabulary.
+    """
+    num_words = len(word_attributes)
+    counts = sparse.csr_matrix((np.ones(len(word_ids)), (prev_word_ids.astype(int), word_ids.astype(int))),
+                               shape=(num_words, num_words))
+    playable = playable_actions(word_attributes, config)
+
+    chunks = []
+    for start in range(0, num_words, chunk_size):  # limits the size of the dense rule matrix
+        rows = slice(start, start + chunk_size)
+        allowed = transition_rules(word_attributes[rows], word_attributes, config) & playable[None]
+        enough_data = np.asarray(counts[rows].sum(axis=1)).ravel() >= config.generation.mask_min_transitions
+        allowed[enough_data] &= counts[rows][enough_data].toarray() > 0
+        allowed[~allowed.any(axis=1)] = playable  # never leaves the sampler without a choice
+        chunks.append(sparse.csr_matrix(allowed))
+
+    return TransitionMask(sparse.vstack(chunks))
+
+
+def corpus_transition_mask(df: pd.DataFrame, word_attributes: np.ndarray, config: Config) -> TransitionMask:
+    """ `create_transition_mask` of the beatmaps in `df` with the `prev_word_id` and `word_id` columns """
+    return create_transition_mask(df['prev_word_id'].to_numpy(), df['word_id'].to_numpy(), word_attributes, config)
+
+
+def hand_columns(config: Config) -> List[List[int]]:
+    """ Indices of `lineLayer`, `lineIndex` and `cutDirection` of each hand in `config.dataset.beat_elements` """
+    return [[config.dataset.beat_elements.index(f'{hand}_{attribute}')
+             for attribute in ['lineLayer', 'lineIndex', 'cutDirection']] for hand in ['l', 'r']]
+
+
+def playable_actions(word_attributes: np.ndarray, config: Config) -> np.ndarray:
+    """
+    Actions which can be generated (num_words,): not MASK or UNK and the hands do not cut
+    the same note in different directions (a single hand action has both hands equal, see `merge_beat_elements`).
+    """
+    (l_layer, l_index, l_cut), (r_layer, r_index, r_cut) = word_attributes.T[hand_columns(config)]
+    same_position = (l_layer == r_layer) & (l_index == r_index)
+    return (word_attributes[:, 0] >= 0) & ~(same_position & (l_cut != r_cut))
+
+
+def transition_rules(prev_attributes: np.ndarray, next_attributes: np.ndarray, config: Config) -> np.ndarray:
+    """
+    Transitions allowed by the rules (num_prev, num_next): no hand swings twice in the same direction,
+    except for the dot notes. Previous MASK and UNK actions allow everything.
+    """
+    allowed = np.ones((len(prev_attributes), len(next_attributes)), dtype=bool)
+    for _, _, cut in hand_columns(config):
+        same_direction = prev_attributes[:, cut, None] == next_attributes[None, :, cut]
+        allowed &= ~(same_direction & (next_attributes[None, :, cut] != DOT))
+    return allowed
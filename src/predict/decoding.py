@@ -0,0 +1,154 @@
+"""
+Decoding of the action distributions predicted by the step models.
+
+`sample_ids` samples whole batches of distributions with temperature, top-k and top-p (nucleus) filtering.
+`beam_search` keeps `config.generation.beam_width` most probable action sequences of each beatmap,
+the recurrent states of the beams are reordered by gathering the rows of their parents.
+Both exclude the transitions forbidden by `ActionIndex.transition_mask` with a logit mask.
+"""
+from typing import List, Optional
+
+import numpy as np
+from scipy.special import softmax
+
+from predict.index import ActionIndex
+from predict.inputs import GenerationInputs
+from train.step import StepModel
+from utils.types import Config
+
+
+def sample_ids(probs: np.ndarray, temperatures: np.ndarray, top_k: int = 0, top_p: float = 1.0,
+               random_state: np.random.RandomState = np.random,
+               logit_mask: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Samples a class of each row of `probs` (batch, classes) after the temperature of the row is applied.
+    `top_k` > 0 keeps only the k most probable classes, `top_p` < 1 keeps the smallest set
+    of the most probable classes with the cumulative probability of `top_p`. The most probable class is always kept.
+    `logit_mask` (batch, classes) is added to the logits, -inf forbids a class.
+    """
+    logits = np.log(probs + 1e-9) / np.maximum(np.asarray(temperatures, dtype='float32'), 1e-6)[:, None]
+    if logit_mask is not None:
+        logits = logits + logit_mask
+    num_classes = logits.shape[-1]
+
+    if 0 < top_k < num_classes:  # only the top-k candidates are sorted
+        candidates = np.argpartition(-logits, top_k - 1, axis=-1)[:, :top_k]
+    else:
+        candidates = np.broadcast_to(np.arange(num_classes), logits.shape)
+    candidate_logits = np.take_along_axis(logits, candidates, axis=-1)
+    order = np.argsort(-candidate_logits, axis=-1)
+    candidates = np.take_along_axis(candidates, order, axis=-1)
+    sorted_probs = softmax(np.take_along_axis(candidate_logits, order, axis=-1), axis=-1)
+
+    if top_p < 1.0:
+        exclusive_cumsum = np.cumsum(sorted_probs, axis=-1) - sorted_probs
+        sorted_probs = np.where(exclusive_cumsum < top_p, sorted_probs, 0.0)
+    cumsum = np.cumsum(sorted_probs, axis=-1)
+    thresholds = random_state.random_sample(len(logits))[:, None] * cumsum[:, -1:]  # renormalized inverse CDF
+    chosen = np.minimum(np.sum(cumsum < thresholds, axis=-1), candidates.shape[-1] - 1)
+    return np.take_along_axis(candidates, chosen[:, None], axis=-1)[:, 0]
+
+
+def beam_search(seqs: List[GenerationInputs], step_model: StepModel, action_index: ActionIndex,
+                config: Config) -> List[np.ndarray]:
+    """
+    Most probable `word_id` sequence of each of `seqs` found by a beam search of `config.generation.beam_width`.
+    The action inputs of the beams (`prev_word_id`, `prev_word_vec` and the per attribute columns)
+    are created from their actions, the song inputs are shared by all beams of a beatmap.
+    All beams of up to `config.generation.batch_size` beatmaps share a single step call.
+    """
+    if 'word_id' not in step_model.output_names:
+        raise ValueError('Beam search needs a model with the `word_id` output')
+    beam_width = max(1, config.generation.beam_width)
+    seqs_per_call = max(1, config.generation.batch_size // beam_width)
+    lengths = [seq.data['prev_word_id'].shape[1] for seq in seqs]
+
+    beams = [BeamState(seq, beam_width, step_model, action_index) for seq in seqs]
+    for i in range(max(lengths) - 1):
+        active = [beam for beam, length in zip(beams, lengths) if i < length - 1]
+        for batch_start in range(0, len(active), seqs_per_call):
+            batch = active[batch_start:batch_start + seqs_per_call]
+            inputs = {col: np.concatenate([beam.inputs(i, col) for beam in batch])
+                      for col in step_model.input_names}
+            pred, new_states = step_model(inputs, [np.concatenate([beam.states[j] for beam in batch])
+                                                   for j in range(len(step_model.state_sizes))])
+            for row, beam in zip(range(0, len(batch) * beam_width, beam_width), batch):
+                rows = slice(row, row + beam_width)
+                beam.advance(pred['word_id'][rows, 0], [state[rows] for state in new_states])
+
+    return [beam.best_ids() for beam in beams]
+
+
+class BeamState:
+    """ Beams of a single beatmap: scores, recurrent states, current actions and backpointers """
+
+    def __init__(self, seq: GenerationInputs, beam_width: int, step_model: StepModel, action_index: ActionIndex):
+        self.seq = seq
+        self.beam_width = beam_width
+        self.action_index = action_index
+        self.states = step_model.zero_states(beam_width)
+        # only the first beam is alive at the start, the others would duplicate it
+        self.scores = np.full(beam_width, -np.inf)
+        self.scores[0] = 0.0
+        self.ids = np.full(beam_width, int(seq.data['prev_word_id'][0, 0, 0]))
+        self.attributes = np.tile([seq.data[f'prev_{col}'][0, 0, 0] for col in action_index.beat_elements],
+                                  (beam_width, 1)).astype(int)
+        self.parents, self.chosen = [], []  # backpointers of each beat
+
+    def inputs(self, i: int, col: str) -> np.ndarray:
+        """ Inputs of column `col` of beat `i` of all beams (beam_width, 1, width) """
+        if col == 'prev_word_id':
+            return one_hot(self.ids, self.seq.shapes[col][-1])
+        if col == 'prev_word_vec':
+            return self.action_index.id_vectors[self.ids][:, None]
+        if col.startswith('prev_') and col[len('prev_'):] in self.action_index.beat_elements:
+            attribute = self.action_index.beat_elements.index(col[len('prev_'):])
+            return one_hot(self.attributes[:, attribute], self.seq.shapes[col][-1])
+        val = self.seq.data[col][:, i:i + 1]
+        if col in self.seq.categorical_cols:
+            val = one_hot(val[:, 0, 0].astype(int), self.seq.shapes[col][-1])
+        return np.repeat(val, self.beam_width, axis=0)
+
+    def advance(self, probs: np.ndarray, states: List[np.ndarray]):
+        """ Keeps the `beam_width` best continuations of all beams, `probs` (beam_width, classes) """
+        log_probs = np.log(probs + 1e-9)
+        if self.action_index.transition_mask is not None:
+            log_probs = log_probs + self.action_index.transition_mask.logit_mask(self.ids)
+        scores = (self.scores[:, None] + log_probs).reshape(-1)
+        best = np.argpartition(-scores, self.beam_width - 1)[:self.beam_width]
+        best = best[np.argsort(-scores[best])]
+        parents, ids = np.divmod(best, probs.shape[-1])
+
+        self.scores = scores[best]
+        self.states = [state[parents] for state in states]  # per beam state reordering
+        new_attributes = self.action_index.word_attributes[ids]
+        self.attributes = np.where(new_attributes < 0, self.attributes[parents], new_attributes)  # UNK, MASK
+        self.ids = ids
+        self.parents.append(parents)
+        self.chosen.append(ids)
+
+    def best_ids(self) -> np.ndarray:
+        """ Action ids of all beats of the best beam, the first one is the given first action """
+        ids = np.zeros(len(self.chosen) + 1, dtype=int)
+        ids[0] = int(self.seq.data['prev_word_id'][0, 0, 0])
+        beam = 0  # beams are sorted by score
+        for i in reversed(range(len(self.chosen))):
+            ids[i + 1] = self.chosen[i][beam]
+            beam = self.parents[i][beam]
+        return ids
+
+
+def one_hot(ids: np.ndarray, num_classes: int) -> np.ndarray:
+    encoded = np.zeros((len(ids), 1, num_classes), dtype='float32')
+    encoded[np.arange(len(ids)), 0, ids] = 1.0
+    return encoded
+
+
+def ids2attributes(ids: np.ndarray, first_attributes: np.ndarray, action_index: ActionIndex) -> np.ndarray:
+    """ Attributes of the actions `ids`, UNK and MASK repeat the previous attributes as `word_id2per_attribute` """
+    attributes = action_index.word_attributes[ids].copy()
+    attributes[0] = np.where(attributes[0] < 0, first_attributes, attributes[0])
+    for i in np.flatnonzero(attributes[1:, 0] < 0) + 1:  # only the rare UNK and MASK actions
+        attributes[i] = attributes[i - 1]
+    return attributes
+
@@ -0,0 +1,76 @@
+"""
+Diagnostics of the generated beatmaps, collected as numeric arrays into a per-run store.
+
+The generation only computes the action velocities of the generated beatmaps (see `utils.avd`).
+Plots are optional: `plot_velocity_histograms` imports matplotlib only when called,
+`plot_in_background` renders them in a worker thread after the generation.
+"""
+import threading
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Dict
+
+import numpy as np
+
+from predict.compute import GenerationStream
+from predict.index import ActionIndex
+from utils.avd import multi_window_velocities
+from utils.types import Config
+
+
+class GenerationMetrics:
+    """ Velocities of each window size of each generated beatmap of one run, keyed by `song/difficulty/temperature` """
+
+    def __init__(self, max_window: int):
+        self.max_window = max_window
+        self.velocities: Dict[str, Dict[int, np.ndarray]] = {}
+
+    def add_stream(self, stream: GenerationStream, action_index: ActionIndex):
+        path, difficulty, temperature = stream.stream_id
+        word_ids = stream.seq.data['prev_word_id'][0, :, 0].astype(int)
+        self.velocities[f'{Path(path).name}/{difficulty}/{temperature}'] = multi_window_velocities(
+            action_index.id_vectors[word_ids], np.array([0]), range(1, self.max_window + 1))
+
+    def save(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        np.savez_compressed(path, **{f'{key}|{window}': values for key, velocities in self.velocities.items()
+                                     for window, values in velocities.items()})
+
+    @classmethod
+    def load(cls, path: Path) -> 'GenerationMetrics':
+        velocities = {}
+        with np.load(path) as data:
+            for name in data.files:
+                key, window = name.rsplit('|', 1)
+                velocities.setdefault(key, {})[int(window)] = data[name]
+        metrics = cls(max((max(windows) for windows in velocities.values()), default=0))
+        metrics.velocities = velocities
+        return metrics
+
+
+def run_metrics_path(config: Config) -> Path:
+    """ A new file in `config.generation.metrics_folder` for each run, the id keeps concurrent runs apart """
+    run_id = f'{datetime.now():%Y-%m-%d_%H-%M-%S}_{uuid.uuid4().hex[:8]}'
+    return config.generation.metrics_folder / f'{run_id}.npz'
+
+
+def plot_velocity_histograms(metrics: GenerationMetrics, path: Path, window: int = 7):
+    """ Velocity histograms of the window size `window` of all beatmaps of the run in one figure """
+    from matplotlib.figure import Figure  # without pyplot, the figure can be rendered in any thread
+
+    fig = Figure(figsize=(14, 6))
+    ax = fig.subplots()
+    for key, velocities in metrics.velocities.items():
+        if len(velocities.get(window, [])):
+            ax.hist(velocities[window], bins=24, density=True, alpha=0.5, label=key)
+    ax.set_xlim(0, 5)
+    ax.legend(fontsize='small')
+    fig.savefig(path)
+
+
+def plot_in_background(metrics: GenerationMetrics, path: Path, window: int = 7) -> threading.Thread:
+    """ Renders `plot_velocity_histograms` in a worker thread, which finishes even when the generation ends """
+    thread = threading.Thread(target=plot_velocity_histograms, args=(metrics, path, window), name='velocity_plots')
+    thread.start()
+    return thread
@@ -0,0 +1,157 @@
+"""
+Pure NumPy single beat step of the trained models, the TensorFlow counterpart is `train.step.model_step`.
+
+At batch size 1 the math of a few LSTM layers is tiny compared to the per-call overhead of TensorFlow,
+so generation on the CPU runs the extracted weights directly.
+"""
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+from scipy.special import expit, softmax
+from tensorflow import keras
+from tensorflow.keras.models import Model
+
+from train.layers import SampledSoftmax
+from train.step import layer_graph, state_sizes
+
+ACTIVATIONS: Dict[str, Callable[[np.ndarray], np.ndarray]] = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0),
+    'elu': lambda x: np.where(x > 0, x, np.expm1(np.minimum(x, 0))),
+    'tanh': np.tanh,
+    'sigmoid': expit,
+    'softmax': lambda x: softmax(x, axis=-1),
+    'mish': lambda x: x * np.tanh(np.logaddexp(0, x)),
+}
+
+IDENTITY_LAYERS = (keras.layers.Dropout, keras.layers.SpatialDropout1D)
+
+
+def get_activation(activation) -> Callable[[np.ndarray], np.ndarray]:
+    name = activation if isinstance(activation, str) else activation.__name__
+    if name not in ACTIVATIONS:
+        raise NotImplementedError(f'Activation {name} is not supported by the NumPy engine')
+    return ACTIVATIONS[name]
+
+
+class FusedLSTM:
+    """
+    LSTM cell with a single matmul for all gates: `[x, h] @ [kernel; recurrent_kernel]`.
+    Gates are in the Keras order (input, forget, cell, output), `h` and `c` are updated in place.
+    """
+
+    def __init__(self, layer: keras.layers.LSTM):
+        kernel, recurrent_kernel, bias = layer.cell.get_weights()
+        self.input_dim = kernel.shape[0]
+        self.units = layer.cell.units
+        self.kernel = np.concatenate([kernel, recurrent_kernel]).astype('float32')
+        self.bias = bias.astype('float32') if layer.cell.use_bias else np.zeros(4 * self.units, dtype='float32')
+        self.activation = get_activation(layer.cell.activation)
+        self.recurrent_activation = get_activation(layer.cell.recurrent_activation)
+        self.xh = np.zeros((0, self.input_dim + self.units), dtype='float32')
+        self.z = np.zeros((0, 4 * self.units), dtype='float32')
+
+    def __call__(self, x: np.ndarray, h: np.ndarray, c: np.ndarray) -> np.ndarray:
+        if self.xh.shape[0] != len(x):  # buffers are reallocated only when the batch size changes
+            self.xh = np.zeros((len(x), self.input_dim + self.units), dtype='float32')
+            self.z = np.zeros((len(x), 4 * self.units), dtype='float32')
+        units = self.units
+
+        self.xh[:, :self.input_dim] = x
+        self.xh[:, self.input_dim:] = h
+        np.matmul(self.xh, self.kernel, out=self.z)
+        self.z += self.bias
+
+        gates = self.recurrent_activation(self.z[:, :2 * units])
+        c *= gates[:, units:]
+        c += gates[:, :units] * self.activation(self.z[:, 2 * units:3 * units])
+        h[:] = self.recurrent_activation(self.z[:, 3 * units:]) * self.activation(c)
+        return h
+
+
+def compile_layer(layer: keras.layers.Layer) -> Callable[..., np.ndarray]:
+    """ NumPy function of a non-recurrent layer applied to a single beat, arrays have no time dimension """
+    if isinstance(layer, keras.layers.TimeDistributed):
+        return compile_layer(layer.layer)
+    if isinstance(layer, IDENTITY_LAYERS):
+        return lambda x: x
+    if isinstance(layer, keras.layers.Concatenate):
+        if layer.axis not in (-1, 2):
+            raise NotImplementedError(f'Concatenation along axis {layer.axis} is not supported by the NumPy engine')
+        return lambda *x: np.concatenate(x, axis=-1)
+    if isinstance(layer, keras.layers.Activation):
+        return get_activation(layer.activation)
+    if isinstance(layer, keras.layers.Dense):
+        weights = [w.astype('float32') for w in layer.get_weights()]
+        kernel, bias = weights[0], weights[1] if layer.use_bias else 0
+        activation = get_activation(layer.activation)
+        return lambda x: activation(x @ kernel + bias)
+    if isinstance(layer, SampledSoftmax):
+        kernel, bias = [w.astype('float32') for w in layer.get_weights()]
+        return lambda x: softmax(x @ kernel + bias, axis=-1)
+    if isinstance(layer, keras.layers.Conv1D):
+        if layer.padding != 'causal':
+            raise NotImplementedError(f'Conv1D with {layer.padding} padding is not supported by the NumPy engine')
+        # A single beat sees only the last kernel tap, the others fall into the causal zero padding
+        weights = [w.astype('float32') for w in layer.get_weights()]
+        kernel, bias = weights[0][-1], weights[1] if layer.use_bias else 0
+        activation = get_activation(layer.activation)
+        return lambda x: activation(x @ kernel + bias)
+    if isinstance(layer, keras.layers.BatchNormalization):
+        gamma = layer.gamma.numpy() if layer.scale else 1
+        beta = layer.beta.numpy() if layer.center else 0
+        scale = (gamma / np.sqrt(layer.moving_variance.numpy() + layer.epsilon)).astype('float32')
+        shift = (beta - layer.moving_mean.numpy() * scale).astype('float32')
+        return lambda x: x * scale + shift
+    raise NotImplementedError(f'Layer {layer.name} ({type(layer).__name__}) is not supported by the NumPy engine')
+
+
+class NumpyStepEngine:
+    """
+    Runs the single beat step of a trained `baseline_model`, `ddc_model` or `custom_model` with NumPy.
+    It has the interface of `train.step.StepModel`, so generation can use either of them.
+    """
+
+    def __init__(self, model: Model):
+        self.input_names = list(model.input_names)
+        self.output_names = list(model.output_names)
+        self.state_sizes = state_sizes(model)
+
+        self.ops = []  # (layer name, input names, function, index of the first state or None)
+        num_states = 0
+        for layer, inbound, _ in layer_graph(model):
+            input_names = [name for name, _, _ in inbound]
+            if isinstance(layer, keras.layers.LSTM) and layer.return_sequences:
+                self.ops.append((layer.name, input_names, FusedLSTM(layer), num_states))
+                num_states += 2
+            elif isinstance(layer, keras.layers.RNN):
+                raise NotImplementedError(f'{type(layer).__name__} is not supported by the NumPy engine')
+            else:
+                self.ops.append((layer.name, input_names, compile_layer(layer), None))
+
+        self.states = self.zero_states(1)  # working buffers of `step`
+
+    def zero_states(self, batch_size: int = 1) -> List[np.ndarray]:
+        return [np.zeros((batch_size, size), dtype='float32') for size in self.state_sizes]
+
+    def reset_states(self, batch_size: int = 1):
+        self.states = self.zero_states(batch_size)
+
+    def step(self, inputs: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+        """ Advances the internal states in place, the fastest way to generate a single stream """
+        tensors = {col: np.asarray(inputs[col], dtype='float32')[:, 0] for col in self.input_names}
+        for name, input_names, fn, state_index in self.ops:
+            if state_index is None:
+                tensors[name] = fn(*[tensors[input_name] for input_name in input_names])
+            else:
+                tensors[name] = fn(tensors[input_names[0]], *self.states[state_index:state_index + 2])
+        return {col: tensors[col][:, None].copy() for col in self.output_names}
+
+    def __call__(self, inputs: Dict[str, np.ndarray], states: List[np.ndarray]) \
+            -> Tuple[Dict[str, np.ndarray], List[np.ndarray]]:
+        if states and len(self.states[0]) != len(states[0]):
+            self.reset_states(len(states[0]))
+        for buffer, state in zip(self.states, states):
+            np.copyto(buffer, state)
+        outputs = self.step(inputs)
+        return outputs, [state.copy() for state in self.states]
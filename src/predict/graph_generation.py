@@ -0,0 +1,111 @@
+"""
+Autoregressive generation of `word_id` models with the whole loop in a single TensorFlow call.
+
+States, action inputs, sampling and the `prev_word_vec` embedding lookup stay in the graph,
+only the song inputs (audio, difficulty, rhythm) go in and the sampled action ids come out.
+"""
+from typing import List
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.models import Model
+
+from predict.index import ActionIndex
+from predict.inputs import GenerationInputs
+from train.step import model_step, state_sizes
+from utils.types import Config
+
+ACTION_INPUTS = ('prev_word_id', 'prev_word_vec')
+
+
+def sample_ids_tf(probs: tf.Tensor, temperature: tf.Tensor, top_k: tf.Tensor, top_p: tf.Tensor) -> tf.Tensor:
+    """
+    Samples a class of each row of `probs` (batch, classes) after the temperature is applied, the same way as
+    `predict.decoding.sample_ids`. `top_k` > 0 keeps only the k most probable classes,
+    `top_p` < 1 keeps the smallest set of the most probable classes with the cumulative probability of `top_p`.
+    """
+    logits = tf.math.log(probs + 1e-9) / tf.maximum(temperature, 1e-6)[:, None]
+
+    sorted_logits = tf.sort(logits, axis=-1, direction='DESCENDING')
+    num_classes = tf.shape(logits)[-1]
+    k = tf.where(top_k > 0, tf.minimum(top_k, num_classes), num_classes)
+    kth_logit = sorted_logits[:, k - 1:k]
+    sorted_probs = tf.nn.softmax(sorted_logits, axis=-1)
+    exclusive_cumsum = tf.cumsum(sorted_probs, axis=-1, exclusive=True)
+    # the most probable class is always kept
+    kept = tf.reduce_sum(tf.cast(exclusive_cumsum < top_p, tf.int32), axis=-1, keepdims=True)
+    top_p_logit = tf.where(top_p < 1.0, tf.gather(sorted_logits, tf.maximum(kept, 1) - 1, batch_dims=1),
+                           sorted_logits[:, -1:])
+
+    threshold = tf.maximum(kth_logit, top_p_logit)
+    logits = tf.where(logits < threshold, tf.fill(tf.shape(logits), -np.inf), logits)
+    return tf.random.categorical(logits, 1, dtype=tf.int32)[:, 0]
+
+
+class GraphGenerator:
+    """
+    Generates the `prev_word_id` sequences of whole songs with a `tf.while_loop` over `model_step`.
+    The action inputs of `model` may be only `prev_word_id` and `prev_word_vec`,
+    `word_vec` outputs are replaced by the embeddings of the sampled actions, see `update_action_representations`.
+    The playability constraints of `predict.constraints` are not supported.
+    """
+
+    def __init__(self, model: Model, action_index: ActionIndex, config: Config):
+        if config.generation.playability_mask:
+            raise ValueError('Generation in the graph does not support `config.generation.playability_mask`')
+        if 'word_id' not in model.output_names:
+            raise ValueError('Generation in the graph needs a model with the `word_id` output')
+        action_inputs = {col for col in model.input_names if col.startswith('prev_')}
+        if not action_inputs <= set(ACTION_INPUTS) or not set(model.output_names) <= {'word_id', 'word_vec'}:
+            raise ValueError(f'Generation in the graph supports only {ACTION_INPUTS} action inputs '
+                             f'and `word_id`, `word_vec` outputs')
+        self.model = model
+        self.config = config
+        self.song_input_names = [col for col in model.input_names if col not in ACTION_INPUTS]
+        self.num_classes = model.get_layer('word_id').output_shape[-1]
+
+        self.word_vectors = tf.constant(action_index.id_vectors)  # the same as `update_action_representations`
+
+        input_signature = [
+            {col: tf.TensorSpec([None, None, *tensor.shape[2:]], tf.float32, name=col)
+             for col, tensor in zip(model.input_names, model.inputs) if col in self.song_input_names},
+            tf.TensorSpec([None], tf.int32, name='first_ids'),
+            tf.TensorSpec([None], tf.float32, name='temperature'),
+            tf.TensorSpec([], tf.int32, name='top_k'),
+            tf.TensorSpec([], tf.float32, name='top_p'),
+        ]
+        self.generate = tf.function(self.generate_ids, input_signature=input_signature)
+
+    def generate_ids(self, song_inputs, first_ids, temperature, top_k, top_p) -> tf.Tensor:
+        """ Action ids of all beats (batch, beats), the first ones are `first_ids` """
+        length = tf.shape(song_inputs[self.song_input_names[0]])[1]
+        states = [tf.zeros([tf.shape(first_ids)[0], size]) for size in state_sizes(self.model)]
+        ids = tf.TensorArray(tf.int32, size=length).write(0, first_ids)
+
+        def step(i, prev_ids, states, ids):
+            inputs = {col: val[:, i:i + 1] for col, val in song_inputs.items()}
+            if 'prev_word_id' in self.model.input_names:
+                inputs['prev_word_id'] = tf.one_hot(prev_ids, self.num_classes)[:, None]
+            if 'prev_word_vec' in self.model.input_names:
+                inputs['prev_word_vec'] = tf.gather(self.word_vectors, prev_ids)[:, None]
+            outputs, states = model_step(self.model, inputs, states)
+            next_ids = sample_ids_tf(outputs['word_id'][:, 0], temperature, top_k, top_p)
+            return i + 1, next_ids, states, ids.write(i + 1, next_ids)
+
+        _, _, _, ids = tf.while_loop(lambda i, *_: i < length - 1, step, [0, first_ids, states, ids])
+        return tf.transpose(ids.stack())
+
+    def __call__(self, seqs: List[GenerationInputs], temperatures: List[float]) -> List[np.ndarray]:
+        """ Generated action ids of each song snippet `seqs[i].data` (`num_snippets` == 1), all in one call """
+        lengths = [seq.data['prev_word_id'].shape[1] for seq in seqs]
+        song_inputs = {col: np.zeros((len(seqs), max(lengths), seqs[0].shapes[col][-1]), dtype='float32')
+                       for col in self.song_input_names}
+        for row, seq in enumerate(seqs):  # shorter songs are padded, their ids past the end are dropped
+            x, _ = seq[0]
+            for col in self.song_input_names:
+                song_inputs[col][row, :lengths[row]] = x[col][0]
+
+        first_ids = np.array([seq.data['prev_word_id'][0, 0, 0] for seq in seqs], dtype='int32')
+        ids = self.generate(song_inputs, first_ids, np.array(temperatures, dtype='float32'),
+                            np.int32(self.config.generation.top_k), np.float32(self.config.generation.top_p))
+        return [row[:length] for row, length in zip(ids.numpy(), lengths)]
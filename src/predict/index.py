@@ -0,0 +1,141 @@
+"""
+Nearest neighbour search in the action embeddings, built once per loaded action model.
+
+Replaces the per beat gensim `similar_by_vector` calls, which normalize and scan the vocabulary every time.
+"""
+from functools import cached_property
+from typing import Dict, Optional, Tuple
+
+import gensim
+import numpy as np
+
+from predict.constraints import TransitionMask
+from utils.functions import attribute_sizes, create_word_attribute_table, create_attribute_word_table, \
+    action_code2word
+from utils.types import Config
+
+
+class ActionIndex:
+    """
+    Cosine similarity search over the FastText action embeddings, in the order of `action_model.index2word`
+    (sorted by frequency), so `restrict_vocab` keeps the most frequent actions the same way as gensim.
+    With `num_clusters` > 0 the approximate mode compares the queries only to the actions
+    of the `num_probes` closest clusters, which pays off only for large vocabularies.
+
+    It also holds the integer tables between `word_id`, the per attribute indices of `beat_elements`
+    and the packed action codes (see `y2action_code`), so generation does not convert actions through strings,
+    and optionally the `TransitionMask` applied by the sampler.
+    """
+
+    def __init__(self, action_model: gensim.models.KeyedVectors, word_id_dict: Dict[str, int], config: Config,
+                 num_clusters: int = 0, num_probes: int = 8):
+        self.action_model = action_model
+        self.restrict_vocab = config.generation.restrict_vocab
+        self.words = np.array(action_model.index2word)  # index -> word
+        self.word_ids = np.array([word_id_dict[word] for word in self.words])  # index -> word_id
+        self.word_id_dict = word_id_dict
+
+        vectors = action_model.vectors.astype('float32')
+        self.normed_vectors = vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+        # word_id -> embedding, FastText gives vectors also to MASK and UNK
+        self.reverse_word_id_dict = {val: key for key, val in word_id_dict.items()}
+        self.id_vectors = np.array([action_model[self.reverse_word_id_dict[word_id]]
+                                    for word_id in range(len(self.reverse_word_id_dict))], dtype='float32')
+
+        self.beat_elements = list(config.dataset.beat_elements)
+        self.attribute_sizes = attribute_sizes(config)
+        self.word_attributes = create_word_attribute_table(word_id_dict, config)  # word_id -> attributes
+        self.attribute_word_table = create_attribute_word_table(word_id_dict, config)  # code -> word_id or UNK
+        self.transition_mask: Optional[TransitionMask] = None  # allowed transitions of the generated actions
+
+        self.num_probes = num_probes
+        self.centroids = None
+        if num_clusters > 0:
+            self.build_clusters(num_clusters)
+
+    def build_clusters(self, num_clusters: int, iterations: int = 10):
+        """ Spherical k-means of the normalized embeddings """
+        random_state = np.random.RandomState(43)
+        num_clusters = min(num_clusters, len(self.normed_vectors))
+        centroids = self.normed_vectors[random_state.choice(len(self.normed_vectors), num_clusters, replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(self.normed_vectors @ centroids.T, axis=-1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, self.normed_vectors)
+            norms = np.linalg.norm(sums, axis=-1, keepdims=True)
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+        self.centroids = centroids
+        assignment = np.argmax(self.normed_vectors @ centroids.T, axis=-1)
+        self.cluster_members = [np.flatnonzero(assignment == cluster) for cluster in range(num_clusters)]
+
+    def query(self, vectors: np.ndarray, k: int = 1, restrict_vocab: Optional[int] = -1) \
+            -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Indices into `words`/`word_ids` of the `k` most similar actions of each of `vectors` (num, dim)
+        and their cosine similarities, both (num, k) sorted by decreasing similarity.
+        `restrict_vocab` == -1 uses the restriction of the index, `None` the whole vocabulary.
+        """
+        restrict_vocab = self.restrict_vocab if restrict_vocab == -1 else restrict_vocab
+        vectors = np.asarray(vectors, dtype='float32').reshape(-1, self.normed_vectors.shape[-1])
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+        candidates = self.normed_vectors[:restrict_vocab]
+        k = min(k, len(candidates))
+
+        if self.centroids is None:
+            return top_k(vectors @ candidates.T, k)
+
+        # The rows are grouped by the probed clusters, each cluster is compared to all rows probing it at once.
+        # The `k` best of each probed cluster are merged, the clusters are disjoint.
+        probes = top_k(vectors @ self.centroids.T, min(self.num_probes, len(self.centroids)))[0]
+        probe_indices = np.zeros((*probes.shape, k), dtype=int)
+        probe_similarities = np.full((*probes.shape, k), -np.inf, dtype='float32')
+        for cluster in np.unique(probes):
+            members = self.cluster_members[cluster]
+            members = members[members < len(candidates)]
+            if len(members) == 0:
+                continue
+            rows, probe = np.nonzero(probes == cluster)
+            member_indices, member_similarities = top_k(vectors[rows] @ candidates[members].T, min(k, len(members)))
+            probe_indices[rows, probe, :member_indices.shape[-1]] = members[member_indices]
+            probe_similarities[rows, probe, :member_indices.shape[-1]] = member_similarities
+
+        probe_indices = probe_indices.reshape(len(vectors), -1)
+        best, similarities = top_k(probe_similarities.reshape(len(vectors), -1), k)
+        indices = np.take_along_axis(probe_indices, best, axis=-1)
+
+        too_few = ~np.all(np.isfinite(similarities), axis=-1)  # too few candidates in the probed clusters
+        if np.any(too_few):
+            indices[too_few], similarities[too_few] = top_k(vectors[too_few] @ candidates.T, k)
+        return indices, similarities
+
+    def closest_word_ids(self, vectors: np.ndarray, restrict_vocab: Optional[int] = -1) -> np.ndarray:
+        return self.word_ids[self.query(vectors, 1, restrict_vocab)[0][:, 0]]
+
+    def closest_words(self, vectors: np.ndarray, restrict_vocab: Optional[int] = -1) -> np.ndarray:
+        return self.words[self.query(vectors, 1, restrict_vocab)[0][:, 0]]
+
+    def action_code(self, attributes: np.ndarray) -> np.ndarray:
+        """ Packed action codes of the attribute indices (..., len(beat_elements)) """
+        return np.ravel_multi_index(np.moveaxis(np.asarray(attributes, dtype=int), -1, 0), self.attribute_sizes)
+
+    @cached_property
+    def code_vectors(self) -> np.ndarray:
+        """ Action code -> FastText embedding, also of the attribute combinations outside the vocabulary """
+        codes = np.arange(np.prod(self.attribute_sizes))
+        return np.array(self.action_model[action_code2word(codes, self.attribute_sizes)], dtype='float32')
+
+    @cached_property
+    def code_word_ids(self) -> np.ndarray:
+        """ Action code -> `word_id` of the closest action in the restricted vocabulary """
+        chunk_size = 1024  # limits the size of the similarity matrix
+        return np.concatenate([self.closest_word_ids(self.code_vectors[start:start + chunk_size])
+                               for start in range(0, len(self.code_vectors), chunk_size)])
+
+
+def top_k(similarities: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """ Indices and values of the `k` largest `similarities` in each row, sorted in decreasing order """
+    indices = np.argpartition(-similarities, k - 1, axis=-1)[..., :k]
+    values = np.take_along_axis(similarities, indices, axis=-1)
+    order = np.argsort(-values, axis=-1)
+    return np.take_along_axis(indices, order, axis=-1), np.take_along_axis(values, order, axis=-1)
@@ -0,0 +1,98 @@
+"""
+Lean generation inputs of a single beatmap.
+
+Training ingest (`df_post_processing`, `normalize_columns`, `BeatmapSequence`) prepares every column of every
+difficulty. Generation needs only the song inputs of the model and the buffers of the generated actions,
+so they are computed directly as arrays of a single snippet.
+"""
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from predict.index import ActionIndex
+from utils.types import Config
+
+
+class GenerationInputs:
+    """
+    Stand-in for the `BeatmapSequence` of a generated beatmap, the parts used by the generation:
+    `data` of shape (1, beats, 1) for the categorical columns (class indices) and (1, beats, width) otherwise,
+    `categorical_cols`, `shapes` of the one-hot inputs and `num_snippets`.
+    """
+
+    def __init__(self, data: Dict[str, np.ndarray], num_classes: Dict[str, int], input_names: List[str]):
+        self.data = data
+        self.categorical_cols = set(num_classes)
+        self.input_names = input_names
+        self.num_snippets = 1
+        self.shapes = {col: (1, val.shape[1], num_classes.get(col, val.shape[-1])) for col, val in data.items()}
+
+    def __getitem__(self, idx) -> Tuple[Dict[str, np.ndarray], Dict[str, np.ndarray]]:
+        """ One-hot encoded model inputs of the whole beatmap, as `BeatmapSequence.__getitem__` without targets """
+        if idx != 0:
+            raise IndexError('Generation inputs have a single snippet')
+        x = {}
+        for col in self.input_names:
+            if col in self.categorical_cols:
+                x[col] = np.zeros(self.shapes[col], dtype='float32')
+                np.put_along_axis(x[col], self.data[col].astype(int), 1.0, axis=-1)
+            else:
+                x[col] = self.data[col]
+        return x, {}
+
+
+def create_generation_inputs(beats_df: pd.DataFrame, difficulty: str, first_action: Optional[np.ndarray],
+                             input_names: List[str], action_index: ActionIndex, stats: pd.DataFrame,
+                             config: Config) -> GenerationInputs:
+    """
+    Inputs of the `beats_df` (time, `mfcc`, `prev`, `next`, `part`) of one difficulty.
+    Only the song inputs in `input_names` are computed, all action columns are allocated as zeros
+    except for the first beat, which gets the attributes `first_action` (the beat before `beats_df`) or MASK.
+    """
+    num_beats = len(beats_df)
+    num_classes = {col: size for col, size in zip(config.dataset.beat_elements_previous_prediction,
+                                                  action_index.attribute_sizes)}
+    num_classes['prev_word_id'] = len(action_index.id_vectors)
+
+    data = {
+        col: np.zeros((1, num_beats, 1), dtype='float32') for col in config.dataset.beat_elements_previous_prediction
+    }
+    data['prev_word_id'] = np.zeros((1, num_beats, 1), dtype='float32')
+    data['prev_word_vec'] = np.zeros((1, num_beats, action_index.id_vectors.shape[-1]), dtype='float32')
+    if first_action is not None:
+        code = int(action_index.action_code(first_action))
+        for col, attribute in zip(config.dataset.beat_elements_previous_prediction, first_action):
+            data[col][0, 0] = attribute
+        data['prev_word_id'][0, 0] = action_index.attribute_word_table[code]
+        data['prev_word_vec'][0, 0] = action_index.code_vectors[code]
+
+    for col in input_names:
+        if col in data:
+            continue
+        if col == 'difficulty':
+            num_classes[col] = len(config.dataset.difficulty_mapping)
+            data[col] = np.full((1, num_beats, 1), config.dataset.difficulty_mapping[difficulty], dtype='float32')
+            continue
+        values = np.stack(beats_df[col].to_numpy()).astype('float32').reshape(num_beats, -1)
+        if col in config.dataset.cols_to_normalize:
+            values = (values - np.asarray(stats['mean'][col])) / (np.asarray(stats['std'][col]) + 1e-6)
+        data[col] = values[None]
+
+    return GenerationInputs(data, num_classes, input_names)
+
+
+def song_inputs(song_df: pd.DataFrame, input_names: List[str], action_index: ActionIndex, stats: pd.DataFrame,
+                config: Config) -> Dict[str, Tuple[pd.DataFrame, GenerationInputs]]:
+    """
+    Index frame of the generated beats and the inputs of each difficulty of `song_df` from `process_song_folder`.
+    The first beat of each difficulty is the first action given to the model, as in `add_previous_prediction`.
+    """
+    inputs = {}
+    for difficulty, beats_df in song_df.groupby(level='difficulty', sort=False):
+        first_action = beats_df[config.dataset.beat_elements].iloc[0].to_numpy(dtype=int)
+        beats_df = beats_df.iloc[1:].dropna()
+        inputs[difficulty] = (pd.DataFrame(index=beats_df.index),
+                              create_generation_inputs(beats_df, difficulty, first_action, input_names, action_index,
+                                                       stats, config))
+    return inputs
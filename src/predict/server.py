@@ -0,0 +1,257 @@
+"""
+Long-running local generation service.
+
+The step model, the action embeddings and the normalization stats are loaded once. Songs of concurrent requests
+are preprocessed by the request threads and their beatmaps join a single generation loop, which advances
+all active streams together in step calls of up to `config.generation.batch_size` streams,
+no matter at which beat each of them is.
+
+    POST /generate  {"song_folder": ..., "output_folder": ..., "temperature": optional, "audio_only": optional}
+    GET  /metrics   queue depth, active streams and latencies
+"""
+import itertools
+import json
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from queue import Queue, Empty
+from time import time
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from predict.api import load_action_index, save_generated_song
+from predict.compute import GenerationStream, create_song_streams, create_audio_streams, finish_stream, \
+    start_stream, step_streams
+from predict.states import StreamStates
+from train.step import StepModel, load_step_model
+from utils.types import Config
+
+LATENCY_WINDOW = 1000  # number of the last requests in the latency percentiles
+
+
+@dataclass
+class GenerationRequest:
+    request_id: int
+    song_folder: Path
+    output_folder: Path
+    streams: List[GenerationStream]
+    submitted: float = field(default_factory=time)
+    started: Optional[float] = None
+    beatmap_dfs: Dict[str, pd.DataFrame] = field(default_factory=dict)
+    result: Future = field(default_factory=Future)
+
+
+class GenerationServer:
+    """
+    Keeps the resources of `predict.api.generate_multiple_complete_beatmaps` warm-loaded and generates
+    the queued requests with dynamic batching of their beat steps. `submit` can be called from any thread.
+    """
+
+    def __init__(self, step_model: StepModel, config: Config):
+        self.step_model = step_model
+        self.config = config
+        self.action_index = load_action_index(config)
+        self.stats = pd.read_pickle(config.dataset.normalization_stats_path)
+
+        self.queue: Queue = Queue()
+        self.request_ids = itertools.count()
+        self.states = StreamStates(step_model.state_sizes)
+        self.step_inputs = {}
+        self.active: List[GenerationStream] = []
+        self.requests: Dict[int, GenerationRequest] = {}
+        self.writer = ThreadPoolExecutor(1)  # writing the results does not block the generation loop
+
+        self.metrics_lock = threading.Lock()
+        self.latencies = []  # (queue wait, total) of the finished requests
+        self.completed = 0
+        self.failed = 0
+        self.generated_beats = 0
+        self.started = time()
+
+        self.running = False
+        self.loop_thread = threading.Thread(target=self.generation_loop, name='generation_loop', daemon=True)
+
+    def start(self):
+        self.running = True
+        self.loop_thread.start()
+
+    def stop(self):
+        self.running = False
+        self.loop_thread.join()
+        self.writer.shutdown()
+
+    def submit(self, song_folder: Path, output_folder: Path, temperature: Optional[float] = None,
+               audio_only: bool = False) -> Future:
+        """ Preprocesses the song in the calling thread and queues its beatmaps, the future returns the zip file """
+        request_id = next(self.request_ids)
+        temperatures = None if temperature is None else [temperature]
+        create_streams = create_audio_streams if audio_only else create_song_streams
+        streams = create_streams(song_folder, self.action_index, self.config, temperatures, self.stats,
+                                 self.step_model.input_names)
+        for stream in streams:  # the same song can be requested multiple times
+            stream.stream_id = (request_id, *stream.stream_id)
+        request = GenerationRequest(request_id, song_folder, output_folder, streams)
+        self.queue.put(request)
+        return request.result
+
+    def admit(self):
+        """ Moves the queued requests to the active streams, waits for one if nothing is generated """
+        while True:
+            try:
+                request = self.queue.get(block=not self.active, timeout=0.1)
+            except Empty:
+                return
+            request.started = time()
+            self.requests[request.request_id] = request
+            for stream in request.streams:
+                self.step_inputs[stream.stream_id] = start_stream(stream, self.step_model.input_names, self.config)
+                self.states.start(stream.stream_id)
+                self.active.append(stream)
+            self.retire()  # songs with a single beat
+
+    def generation_loop(self):
+        batch_size = max(1, self.config.generation.batch_size)
+        while self.running:
+            self.admit()
+            if not self.active:
+                continue
+            active = list(self.active)  # `fail` rebinds `self.active` during the round
+            for batch_start in range(0, len(active), batch_size):
+                # streams of requests failed earlier in the round are skipped
+                batch = [stream for stream in active[batch_start:batch_start + batch_size]
+                         if stream.stream_id in self.step_inputs]
+                if not batch:
+                    continue
+                try:
+                    step_streams(batch, self.step_inputs, self.states, self.step_model, self.action_index,
+                                 self.config)
+                except Exception as e:  # fail the affected requests, keep serving the others
+                    for request_id in {stream.stream_id[0] for stream in batch} & self.requests.keys():
+                        self.fail(self.requests[request_id], e)
+                    continue
+                with self.metrics_lock:
+                    self.generated_beats += len(batch)
+            self.retire()
+
+    def retire(self):
+        """ Finishes the streams at the end of their songs, completed requests are written by `self.writer` """
+        for stream in [stream for stream in self.active if stream.done]:
+            self.remove_stream(stream)
+            request = self.requests[stream.stream_id[0]]
+            _, _, difficulty, _ = stream.stream_id
+            request.beatmap_dfs[difficulty] = finish_stream(stream, self.step_model.output_names, self.config)
+            if len(request.beatmap_dfs) == len(request.streams):
+                del self.requests[request.request_id]
+                self.writer.submit(self.complete, request)
+
+    def remove_stream(self, stream: GenerationStream):
+        self.active = [other for other in self.active if other.stream_id != stream.stream_id]
+        self.states.discard(stream.stream_id)
+        del self.step_inputs[stream.stream_id]
+
+    def complete(self, request: GenerationRequest):
+        try:
+            zip_file = save_generated_song(request.song_folder, request.output_folder, request.beatmap_dfs,
+                                           self.action_index, self.config)
+        except Exception as e:
+            self.set_failed(request, e)
+            return
+        with self.metrics_lock:
+            self.completed += 1
+            self.latencies.append((request.started - request.submitted, time() - request.submitted))
+            self.latencies = self.latencies[-LATENCY_WINDOW:]
+        request.result.set_result(zip_file)
+
+    def fail(self, request: GenerationRequest, exception: Exception):
+        """ Drops the remaining streams of the request, only in the generation loop """
+        for stream in [stream for stream in self.active if stream.stream_id[0] == request.request_id]:
+            self.remove_stream(stream)
+        del self.requests[request.request_id]
+        self.set_failed(request, exception)
+
+    def set_failed(self, request: GenerationRequest, exception: Exception):
+        with self.metrics_lock:
+            self.failed += 1
+        request.result.set_exception(exception)
+
+    def metrics(self) -> Dict[str, float]:
+        with self.metrics_lock:
+            latencies = np.array(self.latencies).reshape(-1, 2)
+            metrics = {
+                'queue_depth': self.queue.qsize(),
+                'active_requests': len(self.requests),
+                'active_streams': len(self.active),
+                'completed_requests': self.completed,
+                'failed_requests': self.failed,
+                'beats_per_second': self.generated_beats / (time() - self.started),
+            }
+        for name, values in [('queue_wait', latencies[:, 0]), ('latency', latencies[:, 1])]:
+            for percentile in [50, 90, 99]:
+                metrics[f'{name}_p{percentile}'] = float(np.percentile(values, percentile)) if len(values) else 0.0
+        return metrics
+
+
+def create_request_handler(server: GenerationServer):
+    class GenerationRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_json(404, {'error': f'Unknown path {self.path}'})
+                return
+            self.send_json(200, server.metrics())
+
+        def do_POST(self):
+            if self.path != '/generate':
+                self.send_json(404, {'error': f'Unknown path {self.path}'})
+                return
+            start = time()
+            try:
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                result = server.submit(Path(request['song_folder']), Path(request['output_folder']),
+                                       request.get('temperature'), request.get('audio_only', False))
+                zip_file = result.result()
+            except Exception as e:
+                self.send_json(500, {'error': repr(e)})
+                return
+            self.send_json(200, {'zip_file': str(zip_file), 'latency': time() - start})
+
+        def send_json(self, code: int, content: Dict):
+            body = json.dumps(content).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass  # the metrics replace the per request log
+
+    return GenerationRequestHandler
+
+
+def serve(step_model: StepModel, config: Config) -> ThreadingHTTPServer:
+    """ Starts the generation loop and returns the HTTP server, call `serve_forever` on it """
+    server = GenerationServer(step_model, config)
+    server.start()
+    http_server = ThreadingHTTPServer((config.generation.server_host, config.generation.server_port),
+                                      create_request_handler(server))
+    http_server.generation_server = server
+    return http_server
+
+
+def main():
+    config = Config()
+    step_model = load_step_model(config.base_data_folder / 'temp' / 'step_model')
+    http_server = serve(step_model, config)
+    print(f'Serving generation on http://{config.generation.server_host}:{config.generation.server_port}')
+    try:
+        http_server.serve_forever()
+    finally:
+        http_server.generation_server.stop()
+
+
+if __name__ == '__main__':
+    main()
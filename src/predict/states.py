@@ -0,0 +1,47 @@
+from typing import Dict, Hashable, Iterable, List
+
+import numpy as np
+
+
+class StreamStates:
+    """
+    Recurrent states of concurrently generated streams (songs, difficulties, branches), keyed by a stream id.
+    Every stream is one row of the batched states of the step model, see `train.step`,
+    so streams can be started, saved, restored, branched and discarded independently.
+    """
+
+    def __init__(self, state_sizes: List[int]):
+        self.state_sizes = state_sizes
+        self.streams: Dict[Hashable, List[np.ndarray]] = {}
+
+    def __contains__(self, stream_id: Hashable) -> bool:
+        return stream_id in self.streams
+
+    def __len__(self) -> int:
+        return len(self.streams)
+
+    def start(self, stream_id: Hashable):
+        self.streams[stream_id] = [np.zeros(size, dtype='float32') for size in self.state_sizes]
+
+    def batch(self, stream_ids: Iterable[Hashable]) -> List[np.ndarray]:
+        """ States of `stream_ids` stacked in the given order, ready for one step call """
+        stream_states = [self.streams[stream_id] for stream_id in stream_ids]
+        return [np.stack(states) for states in zip(*stream_states)]
+
+    def update(self, stream_ids: Iterable[Hashable], states: List[np.ndarray]):
+        """ Splits the new batched states returned by the step call back to `stream_ids` """
+        for row, stream_id in enumerate(stream_ids):
+            self.streams[stream_id] = [state[row] for state in states]
+
+    def save(self, stream_id: Hashable) -> List[np.ndarray]:
+        return [state.copy() for state in self.streams[stream_id]]
+
+    def restore(self, stream_id: Hashable, saved: List[np.ndarray]):
+        self.streams[stream_id] = [state.copy() for state in saved]
+
+    def branch(self, stream_id: Hashable, new_stream_id: Hashable):
+        """ The new stream continues from the current states of `stream_id` """
+        self.restore(new_stream_id, self.streams[stream_id])
+
+    def discard(self, stream_id: Hashable):
+        del self.streams[stream_id]
@@ -0,0 +1,157 @@
+"""
+Streaming generation: notes are available as soon as their beats are sampled.
+
+`generate_note_chunks` is a plain generator, the generation advances only when the next chunk is requested.
+`BeatmapStream` runs it in a background thread, at most `max_pending` chunks ahead of the consumer,
+and can be cancelled. Writing the beatmaps is an optional sink of the chunks, see `save_note_chunks`.
+"""
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from queue import Queue, Full, Empty
+from typing import Dict, Iterator, List, Optional
+
+from predict.api import load_action_index, save_song_beatmaps
+from predict.compute import GenerationStream, create_audio_streams, create_song_streams, create_beatmap, \
+    df2notes, generated_rows2df, start_stream, step_streams
+from predict.index import ActionIndex
+from predict.states import StreamStates
+from train.step import StepModel
+from utils.types import Config, JSON
+
+
+@dataclass
+class NoteChunk:
+    """ Notes of the beats from `time` to `end_time` (inclusive) of one generated difficulty, `last` ends it """
+    difficulty: str
+    time: float
+    end_time: float
+    notes: List[JSON]
+    last: bool
+
+
+def generate_note_chunks(streams: List[GenerationStream], step_model: StepModel, action_index: ActionIndex,
+                         config: Config, cancel: Optional[threading.Event] = None) -> Iterator[NoteChunk]:
+    """
+    Generates the `streams` as `generate_beatmaps` and yields the notes of every `config.generation.chunk_beats`
+    generated beats of each stream. Stops without finishing the streams when `cancel` is set.
+    """
+    # Chunks start at even beats, so `double_beat_element2json` alternates the hands the same way as for the whole df
+    chunk_beats = max(2, config.generation.chunk_beats + config.generation.chunk_beats % 2)
+    batch_size = max(1, config.generation.batch_size)
+    states = StreamStates(step_model.state_sizes)
+    step_inputs = {}
+    emitted = {}
+    for stream in streams:
+        step_inputs[stream.stream_id] = start_stream(stream, step_model.input_names, config)
+        states.start(stream.stream_id)
+        emitted[stream.stream_id] = 0
+
+    while True:
+        for stream in streams:
+            yield from stream_chunks(stream, emitted, chunk_beats, step_model.output_names, action_index, config)
+
+        active = [stream for stream in streams if not stream.done]
+        if not active or (cancel is not None and cancel.is_set()):
+            return
+        for batch_start in range(0, len(active), batch_size):
+            step_streams(active[batch_start:batch_start + batch_size], step_inputs, states, step_model,
+                         action_index, config)
+
+
+def stream_chunks(stream: GenerationStream, emitted: Dict, chunk_beats: int, output_names: List[str],
+                  action_index: ActionIndex, config: Config) -> Iterator[NoteChunk]:
+    """ Full chunks of the generated beats of `stream` which were not emitted yet, and the rest at its end """
+    generated = stream.beat + 1  # the action of each beat up to `stream.beat` is final
+    num_beats = len(stream.beatmap_df)
+    times = stream.beatmap_df.index.get_level_values('time')
+    _, difficulty, _ = stream.stream_id
+    while True:
+        start = emitted[stream.stream_id]
+        if generated - start < chunk_beats and not (stream.done and start < num_beats):
+            return
+        end = min(start + chunk_beats, generated)
+        notes = df2notes(generated_rows2df(stream, output_names, start, end), action_index, config)
+        emitted[stream.stream_id] = end
+        yield NoteChunk(difficulty, float(times[start]), float(times[end - 1]), notes, end == num_beats)
+
+
+class BeatmapStream:
+    """
+    Iterator of the `NoteChunk`s of `generate_note_chunks` produced in a background thread.
+    The producer blocks when `max_pending` chunks are not consumed yet, `cancel` stops it after the current beat.
+    Exceptions of the generation are raised by the iteration.
+    """
+    _end = object()
+
+    def __init__(self, chunks: Iterator[NoteChunk], cancel: threading.Event, max_pending: int):
+        self.cancel_event = cancel
+        self.queue: Queue = Queue(maxsize=max(1, max_pending))
+        self.thread = threading.Thread(target=self.produce, args=(chunks,), name='beatmap_stream', daemon=True)
+        self.thread.start()
+
+    def produce(self, chunks: Iterator[NoteChunk]):
+        try:
+            for chunk in chunks:
+                if not self.put(chunk):
+                    return
+        except Exception as e:
+            self.put(e)
+            return
+        self.put(self._end)
+
+    def put(self, item) -> bool:
+        """ Waits for a free place in the queue, gives up when cancelled """
+        while not self.cancel_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def cancel(self):
+        self.cancel_event.set()
+        self.thread.join()
+
+    def __iter__(self) -> Iterator[NoteChunk]:
+        while True:
+            try:
+                item = self.queue.get(timeout=0.1)
+            except Empty:
+                if self.cancel_event.is_set() and not self.thread.is_alive():
+                    return
+                continue
+            if item is self._end:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def __enter__(self) -> 'BeatmapStream':
+        return self
+
+    def __exit__(self, *args):
+        self.cancel()
+
+
+def stream_complete_beatmap(beatmap_folder: Path, step_model: StepModel, config: Config,
+                            action_index: Optional[ActionIndex] = None, audio_only: bool = False) -> BeatmapStream:
+    """ Streaming counterpart of `predict.api.generate_complete_beatmaps`, nothing is written to the disk """
+    action_index = action_index or load_action_index(config)
+    create_streams = create_audio_streams if audio_only else create_song_streams
+    streams = create_streams(beatmap_folder, action_index, config, input_names=step_model.input_names)
+
+    cancel = threading.Event()
+    chunks = generate_note_chunks(streams, step_model, action_index, config, cancel)
+    return BeatmapStream(chunks, cancel, config.generation.max_pending_chunks)
+
+
+def save_note_chunks(chunks: Iterator[NoteChunk], beatmap_folder: Path, output_folder: Path,
+                     config: Config) -> Path:
+    """ Sink writing the beatmaps of all consumed chunks as `predict.api.save_generated_song`, returns the zip file """
+    notes = {}
+    for chunk in chunks:
+        notes.setdefault(chunk.difficulty, []).extend(chunk.notes)
+    beatmaps = {difficulty: create_beatmap(difficulty_notes) for difficulty, difficulty_notes in notes.items()}
+    return save_song_beatmaps(beatmap_folder, output_folder, beatmaps, config)
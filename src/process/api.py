@@ -75,10 +75,12 @@ def songs2dataset(song_folders, config: Config) -> Optional[pd.DataFrame]:
     return df
 
 
-def df_post_processing(df, config):
-    if config.dataset.action_word_model_path.exists():
+def df_post_processing(df, config, action_model: Optional[gensim.models.KeyedVectors] = None):
+    """ `action_model` can be given by long-running callers to avoid reloading it """
+    if action_model is None and config.dataset.action_word_model_path.exists():
         action_model = gensim.models.KeyedVectors.load(str(config.dataset.action_word_model_path))
 
+    if action_model is not None:
         df['word_vec'] = np.vsplit(action_model[df['word'].values].astype('float16'), len(df))
         df['word_vec'] = df['word_vec'].map(lambda x: x[0])
 
@@ -146,8 +148,9 @@ def save_normalization_stats(df: pd.DataFrame, config: Config):
     return regression_cols
 
 
-def normalize_columns(df: pd.DataFrame, config: Config):
-    stats = pd.read_pickle(config.dataset.normalization_stats_path)
+def normalize_columns(df: pd.DataFrame, config: Config, stats: Optional[pd.DataFrame] = None):
+    if stats is None:
+        stats = pd.read_pickle(config.dataset.normalization_stats_path)
 
     for col in set(config.dataset.cols_to_normalize).intersection(df.columns):
         df[col] = df[col].apply(lambda x: (x - stats['mean'][col]) / (stats['std'][col] + 1e-6))
@@ -2,12 +2,14 @@ import json
 import os
 import signal
 from sys import stderr
+from typing import List, Optional
 
 import numba
 import numpy as np
 import pandas as pd
 import soundfile as sf
 import speechpy
+from scipy import ndimage
 from tensorflow.python.distribute.multi_process_lib import multiprocessing
 
 from utils.functions import progress
@@ -198,10 +200,10 @@ def path2beat_df(beatmap_path, info_path, config: Config) -> pd.DataFrame:
         return beatmap2beat_df(beatmap, info, config)
 
 
-def process_song_folder(folder, config: Config, order=(0, 1)):
+def process_song_folder(folder, config: Config, order=(0, 1), difficulties: Optional[List[str]] = None):
     """
     Return processed and concatenated dataframe of all songs in `folder`.
-    Returns `None` if an error occurs.
+    Returns `None` if an error occurs. Only `difficulties` are processed if given.
 
     Each beat is determined by multiindex of song name, difficulty and time (in seconds).
     Each beat contains information about:
@@ -228,7 +230,7 @@ def process_song_folder(folder, config: Config, order=(0, 1)):
         print(f'\n\t[process | process_song_folder] Skipped file {folder_name}  |  {folder}:\n\t\t{e}', file=stderr)
         return None
 
-    for difficulty in ['Easy', 'Normal', 'Hard', 'Expert', 'ExpertPlus']:
+    for difficulty in difficulties or ['Easy', 'Normal', 'Hard', 'Expert', 'ExpertPlus']:
         beatmap_path = [x for x in files if difficulty in x]
         if beatmap_path:
             try:
@@ -298,17 +300,26 @@ def path2mfcc_df(ogg_path, config: Config) -> pd.DataFrame:
     Generate MFCC audio representation for a given ogg file path.
     The representation computed depends on `config.audio_processing` setting.
     """
+    return mfcc2features(load_mfcc(ogg_path, config), config)
+
+
+def load_mfcc(ogg_path, config: Config, compute_missing: bool = False) -> pd.DataFrame:
+    """ Cached MFCC frames of the ogg file, computed and cached if `compute_missing` or not `use_cache` """
     cache_path = f'{".".join(ogg_path.split(".")[:-1])}.pkl'
 
     if os.path.exists(cache_path):
         df = pd.read_pickle(cache_path)
     else:
-        if config.audio_processing.use_cache:
+        if config.audio_processing.use_cache and not compute_missing:
             raise FileNotFoundError('Cache file not found')
         signal, samplerate = sf.read(ogg_path)
         df = audio2mfcc_df(signal, samplerate, config)
         df.to_pickle(cache_path)
+    return df
 
+
+def mfcc2features(df: pd.DataFrame, config: Config) -> pd.DataFrame:
+    """ The `mfcc` column of the beats from the cached MFCC frames """
     if config.audio_processing.use_temp_derrivatives:
         df = df.join(df.diff().fillna(0), rsuffix='_d')
 
@@ -352,6 +363,48 @@ def audio2mfcc_df(signal: np.ndarray, samplerate: int, config: Config) -> pd.Dat
     return pd.DataFrame(data=mfcc, index=index, dtype='float16')
 
 
+def onset_strength(mfcc: np.ndarray) -> np.ndarray:
+    """
+    Cepstral flux of the MFCC frames (frames, coefficients): the rectified increase of the standardized
+    coefficients between consecutive frames, summed over the coefficients
+    """
+    mfcc = mfcc.astype('float32')
+    mfcc = (mfcc - mfcc.mean(axis=0)) / (mfcc.std(axis=0) + 1e-6)
+    flux = np.maximum(np.diff(mfcc, axis=0, prepend=mfcc[:1]), 0).sum(axis=-1)
+    return ndimage.uniform_filter1d(flux, 3)
+
+
+def detect_onsets(mfcc_df: pd.DataFrame, config: Config) -> np.ndarray:
+    """
+    Times (in seconds) of the onsets in the cached MFCC frames, the local maxima of `onset_strength`
+    at least `onset_min_gap` apart which rise above the moving average by `onset_threshold` standard deviations.
+    """
+    audio_config = config.audio_processing
+    strength = onset_strength(mfcc_df.to_numpy())
+    gap = max(1, int(round(audio_config.onset_min_gap / audio_config.frame_stride)))
+    window = max(1, int(round(audio_config.onset_window / audio_config.frame_stride)))
+
+    is_peak = strength == ndimage.maximum_filter1d(strength, 2 * gap + 1)
+    is_peak &= strength > ndimage.uniform_filter1d(strength, window) + audio_config.onset_threshold * strength.std()
+    return mfcc_df.index.to_numpy()[is_peak]
+
+
+def process_song_audio(folder, config: Config, order=(0, 1)) -> pd.DataFrame:
+    """
+    Beats of a song without beatmaps, at the onsets detected in its audio,
+    with the same `mfcc`, `prev`, `next` and `part` columns as `process_song_folder`.
+    The MFCC cache is used for both the onsets and the features, it is created if missing.
+    """
+    progress(*order, config=config, name='Processing song audio')
+    ogg_path = create_ogg_paths([folder])[0]
+    mfcc = load_mfcc(ogg_path, config, compute_missing=True)
+
+    df = pd.DataFrame(index=pd.Index(np.around(detect_onsets(mfcc, config), 3), name='time'))
+    df = compute_time_cols(df)
+    df = join_closest_index(df, mfcc2features(mfcc, config), 'mfcc')
+    return df.dropna()
+
+
 def init_worker():
     signal.signal(signal.SIGTERM, signal.SIG_IGN)
 
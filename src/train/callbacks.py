@@ -1,6 +1,10 @@
+import hashlib
+import pickle
+from dataclasses import replace
 from datetime import datetime
 
 import numpy as np
+import tensorflow as tf
 from tensorflow import keras as K
 
 from train.sequence import BeatmapSequence, OnEpochEnd
@@ -9,18 +13,155 @@ from utils.types import Config
 
 def create_callbacks(train_seq: BeatmapSequence, config: Config):
     logdir = f'../data/logdir1/model_{datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}'
+    early_stopping = K.callbacks.EarlyStopping(monitor='val_avs_dist', min_delta=0.001, patience=7, verbose=0,
+                                               mode='auto', baseline=None, restore_best_weights=True)
     callbacks = [
         # K.callbacks.TensorBoard(logdir, histogram_freq=0),    # Slows auto search. Enable if experimenting by hand.
         # ForgivingEarlyStopping(monitor='val_avs_dist', max_forgiveness=0.003, patience=8, verbose=0, mode='auto',
         #                        baseline=None, restore_best_weights=True),
-        K.callbacks.EarlyStopping(monitor='val_avs_dist', min_delta=0.001, patience=7, verbose=0, mode='auto',
-                                  baseline=None, restore_best_weights=True),
+        early_stopping,
         OnEpochEnd([train_seq]),
     ]
+    if config.training.checkpoint_folder is not None:
+        callbacks.append(TrainingCheckpoint(train_seq, config, early_stopping))  # after the shuffle of `OnEpochEnd`
+    if config.training.avd_period > 0:
+        callbacks.insert(0, AVDCallback(config))  # `val_avd` has to be logged before the early stopping
 
     return callbacks
 
 
+class TrainingCheckpoint(K.callbacks.Callback):
+    """Periodically save everything needed to resume training into `config.training.checkpoint_folder`.
+
+    Model weights and optimizer state (including `optimizer.iterations`, which drives the learning rate schedule)
+    are saved as a `tf.train.Checkpoint`. The epoch, the shuffle order of the training sequence, the NumPy RNG
+    and the early stopping state with the best weights are pickled next to it.
+    Use `restore_training_state` before `model.fit` to resume.
+    """
+
+    def __init__(self, train_seq: BeatmapSequence, config: Config, early_stopping: K.callbacks.EarlyStopping = None):
+        super().__init__()
+        self.train_seq = train_seq
+        self.folder = config.training.checkpoint_folder
+        self.period = config.training.checkpoint_period
+        self.early_stopping = early_stopping
+        self.fingerprint = config_fingerprint(config)
+        self.manager = None
+
+    def on_train_begin(self, logs=None):
+        self.folder.mkdir(parents=True, exist_ok=True)
+        checkpoint = tf.train.Checkpoint(model=self.model, optimizer=self.model.optimizer)
+        self.manager = tf.train.CheckpointManager(checkpoint, str(self.folder), max_to_keep=2)
+
+        # `EarlyStopping.on_train_begin` resets its state, restore it afterwards
+        state = load_training_state(self.folder)
+        if state is not None and self.early_stopping is not None:
+            for attr, value in state['early_stopping'].items():
+                setattr(self.early_stopping, attr, value)
+
+    def on_epoch_end(self, epoch, logs=None):
+        if (epoch + 1) % self.period != 0:
+            return
+        self.manager.save(checkpoint_number=epoch + 1)
+
+        state = {'epoch': epoch + 1, 'sequence': self.train_seq.get_state(), 'early_stopping': {},
+                 'num_snippets': self.train_seq.num_snippets, 'config_fingerprint': self.fingerprint}
+        if self.early_stopping is not None:
+            state['early_stopping'] = {attr: getattr(self.early_stopping, attr)
+                                       for attr in ['wait', 'best', 'best_weights', 'stopped_epoch']}
+        temp_path = self.folder / 'training_state.pkl.tmp'
+        with open(temp_path, 'wb') as wf:
+            pickle.dump(state, wf)
+        temp_path.replace(self.folder / 'training_state.pkl')  # the last complete state survives interruption
+
+
+class AVDCallback(K.callbacks.Callback):
+    """
+    Every `config.training.avd_period` epochs generates `config.training.avd_songs` validation songs
+    with the current weights and logs `val_avd`, the AVD distance to the human beatmaps, see `utils.avd`.
+    """
+
+    def __init__(self, config: Config):
+        super().__init__()
+        self.config = config
+        self.step_model = None
+        self.action_index = None
+        self.reference = None
+        self.song_streams = []
+
+    def on_train_begin(self, logs=None):
+        # the generation stack is needed only with the callback, `train` does not depend on it otherwise
+        from predict.api import load_action_index
+        from predict.compute import create_song_streams
+        from process.api import load_datasets
+        from train.step import StepModel
+        from utils.avd import load_reference_histograms
+
+        self.step_model = StepModel.from_model(self.model)  # shares the weights of the trained model
+        self.action_index = load_action_index(self.config)
+        self.reference = load_reference_histograms(self.config)
+
+        _, val, _ = load_datasets(self.config)
+        val_names = val.index.get_level_values('name').unique()[:self.config.training.avd_songs]
+        self.song_streams = sum([create_song_streams(self.config.dataset.beat_maps_folder / name, self.action_index,
+                                                     self.config, input_names=self.step_model.input_names)
+                                 for name in val_names], [])
+
+    def on_epoch_end(self, epoch, logs=None):
+        if (epoch + 1) % self.config.training.avd_period != 0 or not self.song_streams:
+            return
+        from predict.compute import generate_streams
+        from utils.avd import VelocityTracker
+
+        histograms = self.reference.empty_like()
+        streams = [replace(stream, velocities=VelocityTracker(histograms)) for stream in self.song_streams]
+        generate_streams(streams, self.step_model, self.action_index, self.config)
+        if logs is not None:
+            logs['val_avd'] = self.reference.distance(histograms)
+
+
+def config_fingerprint(config: Config) -> str:
+    """ Hash of everything deciding the architecture and the training data, the checkpoint location excluded """
+    training = replace(config.training, checkpoint_folder=None, checkpoint_period=1)
+    content = repr((training, config.dataset.storage_folder, config.dataset.beat_elements))
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def load_training_state(folder):
+    state_path = folder / 'training_state.pkl'
+    if not state_path.exists():
+        return None
+    with open(state_path, 'rb') as rf:
+        return pickle.load(rf)
+
+
+def restore_training_state(model: K.Model, train_seq: BeatmapSequence, config: Config) -> int:
+    """
+    Restore model weights, optimizer, training sequence order and NumPy RNG from the last checkpoint.
+    Returns the epoch to continue from, use it as `initial_epoch` of `model.fit`.
+    """
+    if config.training.checkpoint_folder is None:
+        return 0
+    state = load_training_state(config.training.checkpoint_folder)
+    if state is None:
+        return 0
+    if state.get('config_fingerprint') != config_fingerprint(config):
+        raise ValueError(f'Checkpoint in {config.training.checkpoint_folder} was created with a different '
+                         f'training config or dataset, use another `checkpoint_folder` to train from scratch')
+    if state.get('num_snippets') != train_seq.num_snippets:
+        raise ValueError(f'Checkpoint in {config.training.checkpoint_folder} was created with '
+                         f'{state.get("num_snippets")} training snippets, the dataset has {train_seq.num_snippets}')
+
+    checkpoint = tf.train.Checkpoint(model=model, optimizer=model.optimizer)
+    # Optimizer slots are created lazily, their values are restored on the first training step
+    status = checkpoint.restore(str(config.training.checkpoint_folder / f'ckpt-{state["epoch"]}'))
+    status.assert_existing_objects_matched()  # a different architecture fails instead of a partial restore
+    train_seq.set_state(state['sequence'])
+    print(f'Resuming training from epoch {state["epoch"]}')
+
+    return state['epoch']
+
+
 class ForgivingEarlyStopping(K.callbacks.EarlyStopping):
     """Stop training when a monitored metric has worsen significantly (over `max_delta`).
 
@@ -0,0 +1,75 @@
+import tensorflow as tf
+from tensorflow.keras import layers
+
+
+class SampledSoftmax(layers.Layer):
+    """
+    Dense softmax output layer for large action vocabularies.
+
+    During training the layer returns its inputs unchanged and the loss is computed by `sampled_loss`
+    only over the classes present in the batch and `num_sampled` log-uniformly sampled classes.
+    Otherwise it computes the exact softmax over all `units` classes.
+    The weights have the same shapes and order as `TimeDistributed(Dense(units))`,
+    so they can be copied into the stateful generation model.
+    """
+
+    def __init__(self, units, num_sampled, label_smoothing=0.0, **kwargs):
+        super(SampledSoftmax, self).__init__(**kwargs)
+        self.units = units
+        self.num_sampled = num_sampled
+        self.label_smoothing = label_smoothing
+
+    def build(self, input_shape):
+        self.kernel = self.add_weight('kernel', shape=(input_shape[-1], self.units), initializer='glorot_uniform')
+        self.bias = self.add_weight('bias', shape=(self.units,), initializer='zeros')
+        super(SampledSoftmax, self).build(input_shape)
+
+    def call(self, inputs, training=None):
+        if training:
+            return inputs  # projected only to the sampled classes in `sampled_loss`
+        return tf.nn.softmax(tf.tensordot(inputs, self.kernel, axes=1) + self.bias)
+
+    def compute_output_shape(self, input_shape):
+        return input_shape[:-1].concatenate(self.units)
+
+    def sampled_loss(self, y_true, inputs):
+        """
+        Cross entropy over the classes with non-zero target in `y_true` and sampled negative classes.
+        Soft targets (mixup) are supported, label smoothing is spread over the candidate classes only.
+        The log-uniform sampler expects the classes to be sorted by decreasing frequency.
+        """
+        y_true = tf.reshape(tf.cast(y_true, inputs.dtype), [-1, self.units])
+        inputs = tf.reshape(inputs, [-1, inputs.shape[-1]])
+
+        true_classes = tf.where(tf.reduce_any(y_true > 0, axis=0))[:, 0]
+        sampled_classes, _, sampled_expected_count = tf.random.log_uniform_candidate_sampler(
+            true_classes=tf.zeros([1, 1], dtype=tf.int64), num_true=1, num_sampled=self.num_sampled,
+            unique=True, range_max=self.units)
+        candidates = tf.concat([true_classes, sampled_classes], axis=0)
+
+        # Correct the sampled logits for the sampling probability, remove accidentally sampled true classes
+        accidental_hits = tf.reduce_any(tf.equal(sampled_classes[:, None], true_classes[None, :]), axis=-1)
+        valid = tf.concat([tf.ones_like(true_classes, dtype=inputs.dtype),
+                           1 - tf.cast(accidental_hits, inputs.dtype)], axis=0)
+        correction = tf.concat([tf.zeros_like(true_classes, dtype=inputs.dtype),
+                                -tf.math.log(tf.cast(sampled_expected_count, inputs.dtype))], axis=0)
+        # the most negative logit which does not overflow when added to the logits, also in float16
+        correction = tf.where(valid > 0, correction, tf.constant(0.5 * inputs.dtype.min, dtype=inputs.dtype))
+
+        logits = tf.matmul(inputs, tf.gather(self.kernel, candidates, axis=1)) \
+                 + tf.gather(self.bias, candidates) + correction
+        targets = tf.concat([tf.gather(y_true, true_classes, axis=1),
+                             tf.zeros([tf.shape(y_true)[0], self.num_sampled], dtype=y_true.dtype)], axis=1)
+        targets = targets * (1 - self.label_smoothing) + self.label_smoothing * valid / tf.reduce_sum(valid)
+
+        loss = tf.nn.softmax_cross_entropy_with_logits(labels=targets, logits=logits)
+        return tf.reduce_mean(loss)
+
+    def get_config(self):
+        config = super(SampledSoftmax, self).get_config()
+        config.update({
+            'units': self.units,
+            'num_sampled': self.num_sampled,
+            'label_smoothing': self.label_smoothing,
+        })
+        return config
@@ -1,3 +1,4 @@
+import tensorflow as tf
 from tensorflow.python.keras.metrics import cosine_similarity, MeanMetricWrapper
 
 from train.losses import calculate_perplexity
@@ -21,6 +22,13 @@ def cosine_distance(*args, **kwards):
     return 1 - cosine_similarity(*args, **kwards)
 
 
+def ids_top_k_accuracy(y_true, y_pred, k=5):
+    """`y_true`: action ids, `y_pred`: action ids ordered by decreasing similarity"""
+    y_true = tf.expand_dims(tf.cast(y_true, 'int32'), axis=-1)
+    y_pred = tf.cast(y_pred[..., :k], 'int32')
+    return tf.cast(tf.reduce_any(tf.equal(y_true, y_pred), axis=-1), 'float32')
+
+
 class CosineDistance(MeanMetricWrapper):
 
     def __init__(self, name='cosine_distance', dtype=None, axis=-1):
@@ -38,3 +46,9 @@ class CosineDistance(MeanMetricWrapper):
 class Perplexity(MeanMetricWrapper):
     def __init__(self, name='perplexity', dtype=None):
         super(Perplexity, self).__init__(calculate_perplexity, name, dtype=dtype)
+
+
+class IdsTopKAccuracy(MeanMetricWrapper):
+    def __init__(self, k=5, name='top_k_accuracy', dtype=None):
+        """Accuracy of action ids found by the top-k search in `AVSModel.word_vec2top_k`."""
+        super(IdsTopKAccuracy, self).__init__(ids_top_k_accuracy, name, dtype=dtype, k=k)
@@ -1,6 +1,7 @@
 import logging
 import random
-from typing import List, Callable, Optional
+from pathlib import Path
+from typing import List, Callable
 
 import gensim
 import kerastuner as kt
@@ -13,16 +14,79 @@ from tensorflow.keras.models import Model
 from tensorflow.python.eager import backprop
 from tensorflow.python.keras.engine import data_adapter
 from tensorflow.python.keras.engine.training import _minimize
+from tensorflow.python.keras.mixed_precision.experimental.loss_scale_optimizer import LossScaleOptimizer
+from tensorflow.python.keras.utils import losses_utils
 from tensorflow.python.ops import embedding_ops
 
 from train import metrics
+from train.layers import SampledSoftmax
 from train.learning_rate_schedule import FlatCosAnnealSchedule
 from train.sequence import BeatmapSequence
-from utils.functions import y2action_word, create_word_mapping, name_generator
-from utils.types import Config, ModelType
+from train.step import export_step_model
+from utils.functions import y2action_code, create_word_mapping, name_generator, create_attribute_word_table
+from utils.types import Config, ModelType, OutputHead
+
+
+class GradientAccumulator:
+    """
+    Splits every batch into `steps` micro-batches, which go through the model one after another,
+    and applies the sum of their gradients as a single optimizer step, so only the activations
+    of one micro-batch are kept at a time. The micro-batches can differ in size, each gradient is weighted
+    by its share of the snippets of the batch. The optimizer step is unconditional, as in `_minimize`,
+    the all-reduce across replicas (and workers) can not run inside a control flow branch.
+    """
+
+    def __init__(self, variables: List[tf.Variable], steps: int):
+        self.variables = variables
+        self.steps = steps
+
+    def minimize(self, loss_fn, x, y, sample_weight, optimizer):
+        """
+        Gradients of `loss_fn(x, y, sample_weight)` -> (loss, y_pred) of each micro-batch, returns `y_pred`
+        of the whole batch
+        """
+        num_snippets = tf.shape(tf.nest.flatten(x)[0])[0]
+        accumulated = [tf.zeros(var.shape, var.dtype) for var in self.variables]
+        y_preds = []
+        for step in range(self.steps):
+            start, end = step * num_snippets // self.steps, (step + 1) * num_snippets // self.steps
+            micro_batch = tf.nest.map_structure(lambda data: None if data is None else data[start:end],
+                                                (x, y, sample_weight))
+            with tf.control_dependencies(accumulated):  # the next micro-batch starts after the previous one
+                with backprop.GradientTape() as tape:
+                    loss, y_pred = loss_fn(*micro_batch)
+                    if isinstance(optimizer, LossScaleOptimizer):
+                        loss = optimizer.get_scaled_loss(loss)
+            gradients = tape.gradient(loss, self.variables)
+            # Each micro-batch loss is a mean over its snippets
+            share = tf.cast(end - start, tf.float32) / tf.cast(num_snippets, tf.float32)
+            accumulated = [total if gradient is None else total + tf.convert_to_tensor(gradient) * tf.cast(
+                share, total.dtype) for total, gradient in zip(accumulated, gradients)]
+            y_preds.append(y_pred)
+
+        self.apply(accumulated, optimizer)
+        return tf.nest.map_structure(lambda *parts: tf.concat(parts, axis=0), *y_preds)
+
+    def apply(self, gradients, optimizer):
+        """ The same as `_minimize`, but with the accumulated gradients """
+        aggregate_outside_optimizer = getattr(optimizer, '_HAS_AGGREGATE_GRAD', False)
+        if aggregate_outside_optimizer:  # All-reduce across replicas (and workers)
+            gradients = optimizer._aggregate_gradients(zip(gradients, self.variables))
+        if isinstance(optimizer, LossScaleOptimizer):
+            gradients = optimizer.get_unscaled_gradients(gradients)
+        gradients = optimizer._clip_gradients(gradients)
+        if aggregate_outside_optimizer:
+            optimizer.apply_gradients(zip(gradients, self.variables), experimental_aggregate_gradients=False)
+        else:
+            optimizer.apply_gradients(zip(gradients, self.variables))
 
 
 def get_architecture_fn(config: Config) -> Callable[..., Model]:
+    if config.training.jit_compile and (config.training.AVS_proxy_ratio == 0
+                                        or config.training.model_type == ModelType.TUNE_BASELINE):
+        raise ValueError('`config.training.jit_compile` compiles only the `AVSModel` train step, '
+                         f'which is not used with {config.training.AVS_proxy_ratio=} '
+                         f'or {config.training.model_type=}')
     architecture = {
         ModelType.BASELINE: baseline_model,
         ModelType.DDC: ddc_model,
@@ -46,8 +110,8 @@ class AVSModel(Model):
 
     AVSModel computes action vector space related metrics from any
     of the 3 used action data input/output representation.
-    If per attribute enumeration is used, the model computes the action vectors
-    only on a subset of the validation data (controlled by `config.training.AVS_proxy_ratio`).
+    If per attribute enumeration is used, the attributes are packed into an action code
+    and mapped to the action embedding with a precomputed lookup table, entirely in graph.
 
     The reason to create AVS specific model instead of general model with metrics with multiple inputs
     is to avoid recomputing WordVec embeddings multiple times as their computation takes orders of magnitude
@@ -78,6 +142,30 @@ class AVSModel(Model):
         self.embeddings = tf.convert_to_tensor(np.concatenate([np.zeros((2, self.word_model.vectors.shape[-1])),
                                                                self.word_model.vectors]))  # 0: MASK, 1: UNK
         self.normed_embeddings = tf.nn.l2_normalize(self.embeddings, axis=-1)
+        self.attribute_word_table = tf.convert_to_tensor(create_attribute_word_table(self.word_id_dict, config))
+
+        # Closest action ids are found by a chunked top-k search instead of the full similarity matrix
+        self.use_top_k_search = self.config.training.AVS_top_k > 0 \
+                                and 'word_vec' in self.output_names and 'word_id' not in self.output_names
+        if self.use_top_k_search:
+            self.init_top_k_search()
+            self.id_metrics = {
+                'id_acc': metrics.IdsTopKAccuracy(k=1, name='acc'),
+                'id_top5': metrics.IdsTopKAccuracy(k=5, name='top5_acc'),
+            }
+
+        self.sampled_softmax_heads = {layer.name: layer for layer in self.layers if isinstance(layer, SampledSoftmax)}
+
+        # Every batch is split into `gradient_accumulation_steps` micro-batches
+        self.gradient_accumulator = None
+        if self.config.training.gradient_accumulation_steps > 1:
+            self.gradient_accumulator = GradientAccumulator(self.trainable_variables,
+                                                            self.config.training.gradient_accumulation_steps)
+
+        # XLA compiles the forward pass and its gradient, metrics and optimizer updates stay in the default graph
+        self.forward = lambda x: self(x, training=True)
+        if self.config.training.jit_compile:
+            self.forward = tf.function(self.forward, experimental_compile=True)
 
     @property
     def metrics(self) -> List:
@@ -88,16 +176,31 @@ class AVSModel(Model):
         data = data_adapter.expand_1d(data)
         x, y, sample_weight = data_adapter.unpack_x_y_sample_weight(data)
 
-        with backprop.GradientTape() as tape:
-            y_pred = self(x, training=True)
-            loss = self.compiled_loss(y, y_pred, sample_weight, regularization_losses=self.losses)
-        _minimize(self.distribute_strategy, tape, self.optimizer, loss,
-                  self.trainable_variables)
+        if self.gradient_accumulator is not None:
+            y_pred = self.gradient_accumulator.minimize(self.compute_loss, x, y, sample_weight, self.optimizer)
+        else:
+            with backprop.GradientTape() as tape:
+                loss, y_pred = self.compute_loss(x, y, sample_weight)
+            # All-reduces the gradients across replicas (and workers) before clipping and applying them
+            _minimize(self.distribute_strategy, tape, self.optimizer, loss,
+                      self.trainable_variables)
 
-        self.update_metrics(y_pred, y, sample_weight, train=True)
+        # Outputs of sampled softmax heads are not probabilities during training, see `SampledSoftmax`
+        y_full = {col: val for col, val in y.items() if col not in self.sampled_softmax_heads}
+        y_pred = {col: val for col, val in y_pred.items() if col not in self.sampled_softmax_heads}
+        self.update_metrics(y_pred, y_full, sample_weight, train=True)
 
         return self.get_metrics_dict()
 
+    def compute_loss(self, x, y, sample_weight):
+        y_pred = self.forward(x)
+        y_full = {col: val for col, val in y.items() if col not in self.sampled_softmax_heads}
+        loss = self.compiled_loss(y_full, y_pred, sample_weight, regularization_losses=self.losses)
+        for col, head in self.sampled_softmax_heads.items():
+            # Gradients are summed across replicas, compiled losses are scaled the same way by Keras
+            loss += losses_utils.scale_loss_for_distribution(head.sampled_loss(y[col], y_pred[col]))
+        return loss, y_pred
+
     def test_step(self, data):
         data = data_adapter.expand_1d(data)
         x, y, sample_weight = data_adapter.unpack_x_y_sample_weight(data)
@@ -120,9 +223,18 @@ class AVSModel(Model):
         """ Compute all possible action representations to enable all metrics """
         self.compiled_metrics.update_state(y, y_pred, sample_weight)
 
-        if 'word_vec' in y.keys() and 'word_id' not in y.keys():
-            y['word_id'] = self.word_vec2word(drop_batch(y['word_vec']))
-            y_pred['word_id'] = self.word_vec2word(drop_batch(y_pred['word_vec']))
+        # Training id metrics of a sampled head are skipped, they would need the full vocabulary projection
+        skip_ids = train and bool(self.sampled_softmax_heads)
+        if 'word_vec' in y.keys() and 'word_id' not in y.keys() and not skip_ids:
+            if self.use_top_k_search:
+                y_ids = self.word_vec2top_k(drop_batch(y['word_vec']), k=1)[:, 0]
+                y_pred_ids = self.word_vec2top_k(drop_batch(y_pred['word_vec']),
+                                                 k=max(5, self.config.training.AVS_top_k))
+                for metric in self.id_metrics.values():
+                    metric.update_state(y_ids, y_pred_ids)
+            else:
+                y['word_id'] = self.word_vec2word(drop_batch(y['word_vec']))
+                y_pred['word_id'] = self.word_vec2word(drop_batch(y_pred['word_vec']))
         elif ('word_id' in y.keys() or (set(y.keys()) >= set(self.config.dataset.beat_elements) and not train)) \
                 and 'word_vec' not in y.keys():
             y['word_vec'] = self.avs_embedding(y)
@@ -141,15 +253,6 @@ class AVSModel(Model):
         metrics = {m.name: m.result() for m in self.metrics}
         return metrics
 
-    def word2word_vec(self, word):
-        use_len = int(self.config.training.AVS_proxy_ratio * len(word)) + 1
-        use_word = word[:use_len]
-        try:
-            word_vec = self.word_model[use_word.flatten()]
-        except KeyError:  # Fallback for non-FastText based word embeddings
-            word_vec = np.zeros((np.dot(*use_word.shape), self.word_model.vectors.shape[-1]), dtype=np.float32)
-        return word_vec
-
     def word_vec2word(self, word_vec):
         normed_array = tf.nn.l2_normalize(word_vec, axis=-1)
         transposed = tf.transpose(self.normed_embeddings, [1, 0])
@@ -160,13 +263,49 @@ class AVSModel(Model):
         # closest_words = tf.linalg.normalize(x, ord=1, axis=-1)[0]        # we can achieve arbitrary perplexity
         # return closest_words
 
+    def init_top_k_search(self):
+        """ Split the normalized embeddings into equally sized chunks, padded rows are masked out """
+        search_size = self.normed_embeddings.shape[0]
+        if self.config.training.AVS_restrict_vocab and self.config.generation.restrict_vocab is not None:
+            search_size = min(search_size, self.config.generation.restrict_vocab + 2)  # 0: MASK, 1: UNK
+        chunk_size = min(self.config.training.AVS_chunk_size, search_size)
+        num_chunks = -(-search_size // chunk_size)
+        padding = num_chunks * chunk_size - search_size
+
+        embeddings = tf.pad(self.normed_embeddings[:search_size], [[0, padding], [0, 0]])
+        self.search_chunks = tf.reshape(embeddings, [num_chunks, chunk_size, -1])
+        mask = tf.pad(tf.zeros(search_size, dtype=embeddings.dtype), [[0, padding]], constant_values=-np.inf)
+        self.search_mask = tf.reshape(mask, [num_chunks, chunk_size])
+
+    def word_vec2top_k(self, word_vec, k):
+        """
+        Ids of the `k` most similar actions, ordered by cosine similarity.
+        Searches the vocabulary chunk by chunk, so the memory scales with the chunk size, not the vocabulary size.
+        """
+        normed_array = tf.cast(tf.nn.l2_normalize(word_vec, axis=-1), dtype=self.search_chunks.dtype)
+        num_chunks, chunk_size = self.search_chunks.shape[:2]
+        k = min(k, chunk_size)
+
+        def search_chunk(i, values, indices):
+            similarity = tf.matmul(normed_array, self.search_chunks[i], transpose_b=True) + self.search_mask[i]
+            chunk_values, chunk_indices = tf.math.top_k(similarity, k=k)
+            values, order = tf.math.top_k(tf.concat([values, chunk_values], axis=-1), k=k)
+            indices = tf.gather(tf.concat([indices, chunk_indices + i * chunk_size], axis=-1), order, batch_dims=1)
+            return i + 1, values, indices
+
+        size = tf.shape(normed_array)[0]
+        initial = (tf.constant(0),
+                   tf.fill([size, k], tf.constant(-np.inf, dtype=normed_array.dtype)),
+                   tf.zeros([size, k], dtype=tf.int32))
+        _, _, indices = tf.while_loop(lambda i, *_: i < num_chunks, search_chunk, initial)
+        return indices
+
     def avs_embedding(self, y):
         if 'word_id' in y:
             ids = tf.argmax(y['word_id'], axis=-1)
-            y_vec = embedding_ops.embedding_lookup_v2(self.embeddings, ids)
-        else:
-            y_word = y2action_word(y)
-            y_vec = tf.numpy_function(self.word2word_vec, [y_word], tf.float32)
+        else:  # per attribute enumeration
+            ids = tf.gather(self.attribute_word_table, y2action_code(y, self.config))
+        y_vec = embedding_ops.embedding_lookup_v2(self.embeddings, ids)
         return y_vec
 
 
@@ -188,8 +327,21 @@ def forgiving_concatenate(inputs, axis=-1, **kwargs):
     return keras.layers.Concatenate(axis=axis, **kwargs)(inputs)
 
 
+def uses_sampled_softmax(stateful, config: Config, use_avs_model: bool = True) -> bool:
+    """ Sampled softmax is trained by `AVSModel.train_step`, stateful models always use the full softmax """
+    return config.training.output_head == OutputHead.SAMPLED_SOFTMAX and use_avs_model \
+           and not stateful and config.training.AVS_proxy_ratio != 0
+
+
+def categorical_output(col, shape, x, sampled_softmax: bool, config: Config, label_smoothing=0.0):
+    if sampled_softmax and col == 'word_id':
+        return SampledSoftmax(shape, num_sampled=config.training.sampled_softmax_samples,
+                              label_smoothing=label_smoothing, name=col)(x)
+    return layers.TimeDistributed(layers.Dense(shape, activation='softmax'), name=col)(x)
+
+
 def baseline_model(seq: BeatmapSequence, stateful, config: Config) -> Model:
-    batch_size = config.generation.batch_size if stateful else None
+    batch_size = config.generation.stateful_batch_size if stateful else None
     names = name_generator('layer')
 
     inputs = {}
@@ -239,7 +391,7 @@ def baseline_model(seq: BeatmapSequence, stateful, config: Config) -> Model:
 
 
 def ddc_model(seq: BeatmapSequence, stateful, config: Config) -> Model:
-    batch_size = config.generation.batch_size if stateful else None
+    batch_size = config.generation.stateful_batch_size if stateful else None
     names = name_generator('layer')
 
     inputs = {}
@@ -261,10 +413,11 @@ def ddc_model(seq: BeatmapSequence, stateful, config: Config) -> Model:
 
     outputs = {}
     loss = {}
+    sampled_softmax = uses_sampled_softmax(stateful, config)
     for col in seq.y_cols:
         if col in seq.categorical_cols:
             shape = seq.shapes[col][-1]
-            outputs[col] = layers.TimeDistributed(layers.Dense(shape, activation='softmax'), name=col, )(x)
+            outputs[col] = categorical_output(col, shape, x, sampled_softmax, config)
             loss[col] = keras.losses.CategoricalCrossentropy()
         if col in seq.regression_cols:
             shape = seq.shapes[col][-1]
@@ -291,7 +444,7 @@ def ddc_model(seq: BeatmapSequence, stateful, config: Config) -> Model:
 
 
 def custom_model(seq: BeatmapSequence, stateful, config: Config) -> Model:
-    batch_size = config.generation.batch_size if stateful else None
+    batch_size = config.generation.stateful_batch_size if stateful else None
     names = name_generator('layer')
 
     inputs = {}
@@ -341,10 +494,11 @@ def custom_model(seq: BeatmapSequence, stateful, config: Config) -> Model:
 
     outputs = {}
     loss = {}
+    sampled_softmax = uses_sampled_softmax(stateful, config)
     for col in seq.y_cols:
         if col in seq.categorical_cols:
             shape = seq.shapes[col][-1]
-            outputs[col] = layers.TimeDistributed(layers.Dense(shape, activation='softmax'), name=col)(x)
+            outputs[col] = categorical_output(col, shape, x, sampled_softmax, config, config.training.label_smoothing)
             loss[col] = keras.losses.CategoricalCrossentropy(
                 label_smoothing=tf.cast(config.training.label_smoothing, 'float32'),
             )  # does not work well with mixed precision and stateful model
@@ -373,9 +527,10 @@ def custom_model(seq: BeatmapSequence, stateful, config: Config) -> Model:
         #     name="CyclicScheduler")
         # opt = keras.optimizers.Adam(learning_rate=lr_schedule)
 
-        lr_schedule = FlatCosAnnealSchedule(decay_start=len(seq) * 21 + 400,  # Give extra epochs to big batch_size
+        # Give extra epochs to big batch_size
+        lr_schedule = FlatCosAnnealSchedule(decay_start=seq.steps_per_epoch * 21 + 400,
                                             initial_learning_rate=config.training.initial_learning_rate,
-                                            decay_steps=len(seq) * 28 + 400,
+                                            decay_steps=seq.steps_per_epoch * 28 + 400,
                                             alpha=0.01, )
         # Ranger hyper params based on https://github.com/fastai/imagenette/blob/master/2020-01-train.md
         opt = tfa.optimizers.RectifiedAdam(learning_rate=lr_schedule,
@@ -395,7 +550,7 @@ def custom_model(seq: BeatmapSequence, stateful, config: Config) -> Model:
 
 def clstm_tuning_model(seq: BeatmapSequence, stateful, config: Config) -> Model:
     def build_model(hp: kt.HyperParameters, use_avs_model: bool = True):
-        batch_size = config.generation.batch_size if stateful else None
+        batch_size = config.generation.stateful_batch_size if stateful else None
         layer_names = name_generator('layer')
 
         inputs = {}
@@ -481,12 +636,14 @@ def clstm_tuning_model(seq: BeatmapSequence, stateful, config: Config) -> Model:
 
         outputs = {}
         loss = {}
+        sampled_softmax = uses_sampled_softmax(stateful, config)
         for col in seq.y_cols:
             if col in seq.categorical_cols:
                 shape = seq.shapes[col][-1]
-                outputs[col] = layers.TimeDistributed(layers.Dense(shape, activation='softmax'), name=col)(x)
+                label_smoothing = hp.Float('label_smoothing', 0.0, 0.6)
+                outputs[col] = categorical_output(col, shape, x, sampled_softmax, config, label_smoothing)
                 loss[col] = keras.losses.CategoricalCrossentropy(
-                    label_smoothing=tf.cast(hp.Float('label_smoothing', 0.0, 0.6), 'float32'),
+                    label_smoothing=tf.cast(label_smoothing, 'float32'),
                 )  # does not work well with mixed precision and stateful model
             if col in seq.regression_cols:
                 shape = seq.shapes[col][-1]
@@ -504,11 +661,11 @@ def clstm_tuning_model(seq: BeatmapSequence, stateful, config: Config) -> Model:
 
             decay_start_epoch = hp.Int('decay_start_epoch', 15, 40)
             decay_end_epoch = (decay_start_epoch * 4) // 3
-            lr_schedule = FlatCosAnnealSchedule(decay_start=len(seq) * decay_start_epoch,
+            lr_schedule = FlatCosAnnealSchedule(decay_start=seq.steps_per_epoch * decay_start_epoch,
                                                 # Give extra epochs to big batch_size
                                                 initial_learning_rate=hp.Choice('initial_learning_rate',
                                                                                 [3e-2, 1e-2, 8e-3]),
-                                                decay_steps=len(seq) * decay_end_epoch,
+                                                decay_steps=seq.steps_per_epoch * decay_end_epoch,
                                                 alpha=0.001, )
             # Ranger hyper params based on https://github.com/fastai/imagenette/blob/master/2020-01-train.md
             opt = tfa.optimizers.RectifiedAdam(learning_rate=lr_schedule,
@@ -530,7 +687,7 @@ def clstm_tuning_model(seq: BeatmapSequence, stateful, config: Config) -> Model:
 
 def multi_lstm_tuning_model(seq: BeatmapSequence, stateful, config: Config) -> Model:
     def build_model(hp: kt.HyperParameters, use_avs_model: bool = False):
-        batch_size = config.generation.batch_size if stateful else None
+        batch_size = config.generation.stateful_batch_size if stateful else None
         layer_names = name_generator('layer')
 
         inputs = {}
@@ -560,12 +717,14 @@ def multi_lstm_tuning_model(seq: BeatmapSequence, stateful, config: Config) -> M
         x = forgiving_concatenate(last_layer)
         outputs = {}
         loss = {}
+        sampled_softmax = uses_sampled_softmax(stateful, config, use_avs_model)
         for col in seq.y_cols:
             if col in seq.categorical_cols:
                 shape = seq.shapes[col][-1]
-                outputs[col] = layers.TimeDistributed(layers.Dense(shape, activation='softmax'), name=col)(x)
+                label_smoothing = hp.Float('label_smoothing', 0.0, 0.7)
+                outputs[col] = categorical_output(col, shape, x, sampled_softmax, config, label_smoothing)
                 loss[col] = keras.losses.CategoricalCrossentropy(
-                    label_smoothing=tf.cast(hp.Float('label_smoothing', 0.0, 0.7), 'float32'),
+                    label_smoothing=tf.cast(label_smoothing, 'float32'),
                 )  # does not work well with mixed precision and stateful model
             if col in seq.regression_cols:
                 shape = seq.shapes[col][-1]
@@ -581,13 +740,16 @@ def multi_lstm_tuning_model(seq: BeatmapSequence, stateful, config: Config) -> M
         else:
             if use_avs_model:
                 model = AVSModel(inputs=inputs, outputs=outputs, config=config)
+            elif config.training.jit_compile:
+                raise ValueError('`config.training.jit_compile` needs `use_avs_model=True`')
             else:
                 model = Model(inputs=inputs, outputs=outputs)
 
-            lr_schedule = FlatCosAnnealSchedule(decay_start=len(seq) * 30,  # Give extra epochs to big batch_size
+            # Give extra epochs to big batch_size
+            lr_schedule = FlatCosAnnealSchedule(decay_start=seq.steps_per_epoch * 30,
                                                 initial_learning_rate=hp.Choice('initial_learning_rate',
                                                                                 [3e-2, 1e-2, 8e-3, ]),
-                                                decay_steps=len(seq) * 40,
+                                                decay_steps=seq.steps_per_epoch * 40,
                                                 alpha=0.01, )
             # Ranger hyper params based on https://github.com/fastai/imagenette/blob/master/2020-01-train.md
             opt = tfa.optimizers.RectifiedAdam(learning_rate=lr_schedule,
@@ -608,8 +770,12 @@ def multi_lstm_tuning_model(seq: BeatmapSequence, stateful, config: Config) -> M
 
 
 def trivial_tuning_model(seq: BeatmapSequence, stateful, config: Config) -> Callable[..., Model]:
+    if config.training.output_head == OutputHead.SAMPLED_SOFTMAX:
+        raise ValueError(f'{config.training.output_head=} is not supported by {config.training.model_type=}, '
+                         f'it never uses `AVSModel`')
+
     def build_model(hp: kt.HyperParameters, use_avs_model: bool = False) -> Model:
-        batch_size = config.generation.batch_size if stateful else None
+        batch_size = config.generation.stateful_batch_size if stateful else None
         layer_names = name_generator('layer')
 
         inputs = {}
@@ -655,14 +821,11 @@ def trivial_tuning_model(seq: BeatmapSequence, stateful, config: Config) -> Call
     return build_model
 
 
-def save_model(model, model_path, train_seq, config, hp: Optional[kt.HyperParameters] = None):
-    keras.mixed_precision.experimental.set_policy('float32')
-    config.training.batch_size = 1
-    stateful_model = get_architecture_fn(config)(train_seq, True, config)
-    if hp is not None:
-        stateful_model = stateful_model(hp, use_avs_model=True)
+def save_model(model: Model, model_path: Path):
+    """
+    Saves the trained model and its single beat step for generation, see `train.step`.
+    Neither the architecture nor the global mixed precision policy are touched.
+    """
     plain_model = keras.Model(model.inputs, model.outputs)  # drops non-serializable metrics, etc.
-    stateful_model.set_weights(plain_model.get_weights())
     plain_model.save(model_path / 'model.keras')
-    stateful_model.save(model_path / 'stateful_model.keras')
-    return stateful_model
+    export_step_model(plain_model, model_path / 'step_model')
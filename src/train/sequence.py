@@ -30,11 +30,21 @@ class BeatmapSequence(Sequence):
         self.snippet_size = config.beat_preprocessing.snippet_window_length
         self.config = config
         self.is_train = is_train
+        self.accumulation_steps = config.training.gradient_accumulation_steps if is_train else 1
 
         self.init_data(df, config)
 
     def __len__(self):
-        return int(np.ceil(self.df_len / float(self.batch_size) / float(self.snippet_size)))
+        batches = int(np.ceil(self.df_len / float(self.batch_size) / float(self.snippet_size)))
+        last_batch_size = self.num_snippets - (batches - 1) * self.batch_size
+        if self.accumulation_steps > 1 and last_batch_size < self.accumulation_steps:
+            batches = max(1, batches - 1)  # every micro-batch of `GradientAccumulator` needs at least one snippet
+        return batches
+
+    @property
+    def steps_per_epoch(self):
+        """Number of optimizer steps per epoch"""
+        return len(self)
 
     def __getitem__(self, idx):
         data_dict = {}
@@ -65,6 +75,18 @@ class BeatmapSequence(Sequence):
         np.random.shuffle(new_order)
         for col in self.data:
             self.data[col] = self.data[col][new_order]
+        self.order = self.order[new_order]
+
+    def get_state(self):
+        """Shuffle order of the snippets and the global NumPy RNG state, to make training resumable"""
+        return {'order': self.order.copy(), 'random_state': np.random.get_state()}
+
+    def set_state(self, state):
+        restore_order = np.argsort(self.order)[state['order']]
+        for col in self.data:
+            self.data[col] = self.data[col][restore_order]
+        self.order = state['order']
+        np.random.set_state(state['random_state'])
 
     @cached_property
     def shapes(self):
@@ -77,6 +99,7 @@ class BeatmapSequence(Sequence):
     def init_data(self, df, config: Config):
         """Makes Sequence data representation re-inializable with a different Config"""
         self.num_snippets = max(1, len(df) // self.snippet_size)
+        self.order = np.arange(self.num_snippets)  # position of the snippets in `df`
         shape = self.num_snippets, min(len(df), self.snippet_size)
         # shape == (number of snippets, snippet size)
 
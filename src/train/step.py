@@ -0,0 +1,138 @@
+"""
+Single beat step of the trained models with explicit recurrent states.
+
+Generation advances a model one beat at a time. Instead of rebuilding the architecture with stateful LSTMs,
+the step runs the layers of the trained model directly and passes the LSTM states in and out explicitly.
+"""
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+from tensorflow.keras.models import Model
+
+
+def recurrent_layers(model: Model) -> List[keras.layers.RNN]:
+    return [layer for layer in model.layers if isinstance(layer, keras.layers.RNN)]
+
+
+def state_sizes(model: Model) -> List[int]:
+    """ Sizes of the explicit states of `model_step`, (h, c) for each LSTM layer in the order of `model.layers` """
+    return [size for layer in recurrent_layers(model) for size in tf.nest.flatten(layer.cell.state_size)]
+
+
+def layer_graph(model: Model) -> List[Tuple[keras.layers.Layer, List[Tuple[str, int, int]], Dict]]:
+    """
+    Non-input layers of the functional `model` in topological order,
+    each with the (layer name, node index, tensor index) keys of its inputs and its call kwargs.
+    """
+    graph = []
+    available = {(name, 0, 0) for name in model.input_names}
+    pending = [layer_config for layer_config in model.get_config()['layers']
+               if layer_config['class_name'] != 'InputLayer']
+    while pending:  # layers are usually sorted already, the loop only guards against a different order
+        not_ready = []
+        for layer_config in pending:
+            inbound = layer_config['inbound_nodes'][0]  # every layer is called only once in the architectures
+            keys = [tuple(node[:3]) for node in inbound]
+            if not available.issuperset(keys):
+                not_ready.append(layer_config)
+                continue
+            layer = model.get_layer(layer_config['name'])
+            kwargs = {key: val for key, val in inbound[0][3].items() if key != 'training'}
+            graph.append((layer, keys, kwargs))
+            available.add((layer.name, 0, 0))  # all layers of the architectures have a single output
+        if len(not_ready) == len(pending):
+            raise ValueError(f'Could not resolve inputs of layers {[config["name"] for config in not_ready]}')
+        pending = not_ready
+    return graph
+
+
+def model_step(model: Model, inputs: Dict[str, tf.Tensor], states: List[tf.Tensor]) \
+        -> Tuple[Dict[str, tf.Tensor], List[tf.Tensor]]:
+    """
+    Runs a single beat (time dimension of length 1) through the functional `model` in inference mode.
+    Recurrent layers are advanced by their cells, other layers are called as they are,
+    so causal convolutions see only the current beat, the same as in the stateful models.
+    """
+    state_slices, start = {}, 0
+    for layer in recurrent_layers(model):
+        num_states = len(tf.nest.flatten(layer.cell.state_size))
+        state_slices[layer.name] = slice(start, start + num_states)
+        start += num_states
+
+    new_states = list(states)
+    tensors = {(name, 0, 0): inputs[name] for name in model.input_names}
+    for layer, inbound, kwargs in layer_graph(model):
+        layer_inputs = [tensors[key] for key in inbound]
+        layer_inputs = layer_inputs[0] if len(layer_inputs) == 1 else layer_inputs
+
+        if layer.name in state_slices:
+            cell_states = new_states[state_slices[layer.name]]
+            output, cell_states = layer.cell(layer_inputs[:, 0], cell_states, training=False)
+            new_states[state_slices[layer.name]] = tf.nest.flatten(cell_states)
+            output = output[:, None] if layer.return_sequences else output
+        else:
+            output = layer(layer_inputs, training=False, **kwargs)
+
+        tensors[(layer.name, 0, 0)] = output
+
+    outputs = {name: tf.cast(tensors[(name, 0, 0)], tf.float32) for name in model.output_names}
+    return outputs, [tf.cast(state, tf.float32) for state in new_states]
+
+
+def create_step_module(model: Model) -> tf.Module:
+    """
+    `model_step` of `model` compiled once as `step(inputs, states) -> (outputs, new_states)` with a fixed
+    input signature, the explicit-state counterpart of every architecture, sharing the weights of `model`.
+    The batch size is not fixed, the states of each stream are simply rows of the `states` tensors.
+    """
+    module = tf.Module()
+    module.weights = list(model.weights)  # captured by `step`, have to be tracked to be saved
+
+    input_signature = [
+        {name: tf.TensorSpec([None, 1, *tensor.shape[2:]], tf.float32, name=name)
+         for name, tensor in zip(model.input_names, model.inputs)},
+        [tf.TensorSpec([None, size], tf.float32, name=f'state_{i}') for i, size in enumerate(state_sizes(model))],
+    ]
+    module.step = tf.function(lambda inputs, states: model_step(model, inputs, states),
+                              input_signature=input_signature)
+    return module
+
+
+def export_step_model(model: Model, folder: Path):
+    """ Saves the step of `create_step_module` as a single SavedModel """
+    tf.saved_model.save(create_step_module(model), str(folder))
+
+
+class StepModel:
+    """
+    Calls the step of `create_step_module`, either restored by `load_step_model` without the architecture
+    and Keras custom objects, or created from an in-memory model by `StepModel.from_model`.
+    """
+
+    def __init__(self, module: tf.Module):
+        self.module = module
+        concrete_step = module.step.get_concrete_function()
+        (input_spec, state_spec), _ = concrete_step.structured_input_signature
+        self.input_names = list(input_spec.keys())
+        self.output_names = list(concrete_step.structured_outputs[0].keys())
+        self.state_sizes = [spec.shape[-1] for spec in state_spec]
+
+    @staticmethod
+    def from_model(model: Model) -> 'StepModel':
+        return StepModel(create_step_module(model))
+
+    def zero_states(self, batch_size: int = 1) -> List[np.ndarray]:
+        return [np.zeros((batch_size, size), dtype='float32') for size in self.state_sizes]
+
+    def __call__(self, inputs: Dict[str, np.ndarray], states: List[np.ndarray]) \
+            -> Tuple[Dict[str, np.ndarray], List[np.ndarray]]:
+        inputs = {col: np.asarray(inputs[col], dtype='float32') for col in self.input_names}
+        outputs, states = self.module.step(inputs, states)
+        return {col: val.numpy() for col, val in outputs.items()}, [state.numpy() for state in states]
+
+
+def load_step_model(folder: Path) -> StepModel:
+    return StepModel(tf.saved_model.load(str(folder)))
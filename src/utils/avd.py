@@ -0,0 +1,184 @@
+"""
+AVD (action velocity distribution) metric of generated beatmaps.
+
+The velocity of window size w at beat j is the L2 distance between the mean action vectors of the beats
+(j - 2w, j - w] and (j - w, j]. AVD compares the distributions of the velocities of the generated beatmaps
+to the human ones for each window size 1..`max_window` and averages the distances.
+
+The distributions are fixed-bin histograms: the human reference is computed once from the training dataset
+and persisted, the generated side is updated as the beats come, see `VelocityTracker`.
+KS and Wasserstein distances are computed from the cumulative histograms.
+"""
+from pathlib import Path
+from typing import Dict, Iterable
+
+import numpy as np
+import pandas as pd
+
+from process.api import load_datasets
+from utils.types import Config
+
+
+def multi_window_velocities(vectors: np.ndarray, group_starts: np.ndarray, windows: Iterable[int]) \
+        -> Dict[int, np.ndarray]:
+    """
+    Velocities of each of `windows` of action `vectors` (beats, dim), the beatmaps are contiguous
+    and start at `group_starts`. All window means come from a single prefix sum,
+    mean[j] = (cumsum[j + 1] - cumsum[j + 1 - window]) / window, and only windows inside a beatmap are kept.
+    """
+    cumsum = np.concatenate([np.zeros((1, vectors.shape[-1])), np.cumsum(vectors, axis=0)])
+    group_lengths = np.diff(np.append(group_starts, len(vectors)))
+    beat_group_start = np.repeat(group_starts, group_lengths)
+    ends = np.arange(1, len(vectors) + 1)  # exclusive end of the second window of each beat
+
+    velocities = {}
+    for window in windows:
+        valid = ends - 2 * window >= beat_group_start
+        end = ends[valid]
+        diff = (cumsum[end] - 2 * cumsum[end - window] + cumsum[end - 2 * window]) / window
+        velocities[window] = np.sqrt(np.sum(diff ** 2, axis=-1))
+    return velocities
+
+
+def compute_multiple_velocities(df: pd.DataFrame, from_window_size=1, to_window_size=32) -> Dict[int, np.ndarray]:
+    """ Velocities of the action vectors (columns) of each beatmap (`name`, `difficulty`) of `df` """
+    return beatmap_velocities(df.to_numpy(dtype='float64'), df.index, range(from_window_size, to_window_size + 1))
+
+
+def beatmap_velocities(vectors: np.ndarray, index: pd.MultiIndex, windows: Iterable[int]) -> Dict[int, np.ndarray]:
+    """ `multi_window_velocities` of the beats of `vectors` in any order, `index` has `name` and `difficulty` """
+    beatmaps = pd.MultiIndex.from_arrays([index.get_level_values('name'), index.get_level_values('difficulty')])
+    codes, _ = beatmaps.factorize()
+    order = np.argsort(codes, kind='stable')  # contiguous beatmaps in the order of their beats
+    group_starts = np.flatnonzero(np.diff(codes[order], prepend=-1))
+    return multi_window_velocities(vectors[order], group_starts, windows)
+
+
+class VelocityHistograms:
+    """
+    Histograms of the velocities of window sizes 1..`max_window` (rows), `bins` bins from 0 to `max_velocity`
+    of each window. Larger velocities fall into the last bin.
+    """
+
+    def __init__(self, max_velocity: np.ndarray, counts: np.ndarray):
+        self.max_velocity = np.asarray(max_velocity, dtype='float64')
+        self.counts = counts
+
+    @classmethod
+    def empty(cls, max_velocity: np.ndarray, bins: int) -> 'VelocityHistograms':
+        return cls(max_velocity, np.zeros((len(max_velocity), bins), dtype=np.int64))
+
+    @classmethod
+    def from_velocities(cls, velocities: Dict[int, np.ndarray], bins: int,
+                        headroom: float = 1.5) -> 'VelocityHistograms':
+        """ Histograms of the reference `velocities`, the bins cover `headroom` times their maximum """
+        max_velocity = np.array([headroom * np.max(velocities[window], initial=1e-6)
+                                 for window in range(1, len(velocities) + 1)])
+        histograms = cls.empty(max_velocity, bins)
+        histograms.update(velocities)
+        return histograms
+
+    @property
+    def max_window(self) -> int:
+        return len(self.max_velocity)
+
+    @property
+    def bins(self) -> int:
+        return self.counts.shape[-1]
+
+    def empty_like(self) -> 'VelocityHistograms':
+        return VelocityHistograms.empty(self.max_velocity, self.bins)
+
+    def add(self, windows: np.ndarray, velocities: np.ndarray):
+        """ Counts `velocities` of the window sizes `windows`, both flat arrays of the same length """
+        rows = np.asarray(windows) - 1
+        bins = np.minimum((velocities / self.max_velocity[rows] * self.bins).astype(int), self.bins - 1)
+        np.add.at(self.counts, (rows, bins), 1)
+
+    def update(self, velocities: Dict[int, np.ndarray]):
+        for window, values in velocities.items():
+            if window <= self.max_window:
+                self.add(np.full(len(values), window), values)
+
+    def cdf(self) -> np.ndarray:
+        with np.errstate(invalid='ignore'):
+            return np.cumsum(self.counts, axis=-1) / np.sum(self.counts, axis=-1, keepdims=True)
+
+    def ks_distance(self, other: 'VelocityHistograms') -> np.ndarray:
+        """ Kolmogorov-Smirnov statistic of each window size, NaN where a histogram is empty """
+        return np.max(np.abs(self.cdf() - other.cdf()), axis=-1)
+
+    def wasserstein_distance(self, other: 'VelocityHistograms') -> np.ndarray:
+        """ Earth mover's distance of each window size in velocity units, NaN where a histogram is empty """
+        return np.sum(np.abs(self.cdf() - other.cdf()), axis=-1) * self.max_velocity / self.bins
+
+    def distance(self, other: 'VelocityHistograms', metric: str = 'ks') -> float:
+        """ AVD: the mean distance over the window sizes with velocities in both histograms """
+        distances = self.ks_distance(other) if metric == 'ks' else self.wasserstein_distance(other)
+        return float(np.nanmean(distances)) if np.any(np.isfinite(distances)) else np.nan
+
+    def save(self, path: Path):
+        np.savez(path, max_velocity=self.max_velocity, counts=self.counts)
+
+    @classmethod
+    def load(cls, path: Path) -> 'VelocityHistograms':
+        with np.load(path) as data:
+            return cls(data['max_velocity'], data['counts'])
+
+
+class VelocityTracker:
+    """
+    Velocities of one beatmap as its action vectors are generated, counted into the shared `histograms`.
+    Only the prefix sums of the last 2 * `max_window` beats are kept.
+    """
+
+    def __init__(self, histograms: VelocityHistograms, chunk_size: int = 256):
+        self.histograms = histograms
+        self.windows = np.arange(1, histograms.max_window + 1)
+        self.chunk_size = chunk_size  # limits the size of the (beats, windows, dim) differences
+        self.cumsum = None  # prefix sums of the beats `self.start` .. `self.start + len(self.cumsum) - 1`
+        self.start = 0
+        self.num_beats = 0
+
+    def add(self, vectors: np.ndarray):
+        """ Appends the action `vectors` (beats, dim) of the next beats """
+        for chunk_start in range(0, len(vectors), self.chunk_size):
+            self.add_chunk(np.asarray(vectors[chunk_start:chunk_start + self.chunk_size], dtype='float64'))
+        self.num_beats += len(vectors)
+
+    def add_chunk(self, vectors: np.ndarray):
+        if self.cumsum is None:
+            self.cumsum = np.zeros((1, vectors.shape[-1]))
+        cumsum = np.concatenate([self.cumsum, self.cumsum[-1] + np.cumsum(vectors, axis=0)])
+
+        # exclusive ends of the second windows of the new beats, relative to `self.start`
+        ends = np.arange(len(self.cumsum), len(cumsum))[:, None]
+        valid = ends + self.start - 2 * self.windows[None] >= 0
+        ends, windows = np.broadcast_to(ends, valid.shape)[valid], np.broadcast_to(self.windows, valid.shape)[valid]
+        diff = (cumsum[ends] - 2 * cumsum[ends - windows] + cumsum[ends - 2 * windows]) / windows[:, None]
+        self.histograms.add(windows, np.sqrt(np.sum(diff ** 2, axis=-1)))
+
+        keep = 2 * self.histograms.max_window + 1
+        self.start += max(0, len(cumsum) - keep)
+        self.cumsum = cumsum[-keep:]
+
+
+def dataset_velocities(df: pd.DataFrame, max_window: int) -> Dict[int, np.ndarray]:
+    """ Velocities of the `word_vec` actions of each beatmap of a dataset """
+    return beatmap_velocities(np.stack(df['word_vec'].to_numpy()).astype('float64'), df.index,
+                              range(1, max_window + 1))
+
+
+def load_reference_histograms(config: Config) -> VelocityHistograms:
+    """ Velocity histograms of the human beatmaps, created from the training dataset the first time """
+    path = config.dataset.avd_reference_path
+    if path.exists():
+        reference = VelocityHistograms.load(path)
+        if reference.max_window == config.dataset.avd_max_window and reference.bins == config.dataset.avd_bins:
+            return reference
+
+    train, _, _ = load_datasets(config)
+    reference = VelocityHistograms.from_velocities(dataset_velocities(train, config.dataset.avd_max_window),
+                                                   config.dataset.avd_bins)
+    reference.save(path)
+    return reference
@@ -1,4 +1,5 @@
-from typing import Dict
+import re
+from typing import Dict, List
 
 import numpy as np
 import pandas as pd
@@ -27,20 +28,68 @@ def check_consistency(df: pd.DataFrame):
     return True
 
 
-def y2action_word(y: Dict[str, tf.TensorArray]):
+def y2action_code(y: Dict[str, tf.Tensor], config: Config):
     """
-    Converts dictionary of action one-hot vectors into a action word representation
-    Example output element: L000_R001
+    Converts dictionary of per attribute one-hot vectors into a packed integer action code.
+    The code of one hand is `(lineLayer * 4 + lineIndex) * 9 + cutDirection`,
+    the action code is `left_code * 108 + right_code`.
+    Example: L000_R001 -> 1
     """
-    word = []
+    code = tf.zeros_like(tf.argmax(y[config.dataset.beat_elements[0]], axis=-1))
 
-    for hand in 'lr':
-        word += [hand.upper()]
-        word += [tf.strings.as_string(tf.argmax(y[f'{hand}_{name}'], axis=-1)) for name in
-                 ['lineLayer', 'lineIndex', 'cutDirection']]
-        word += ['_']
+    for col in config.dataset.beat_elements:
+        num_classes = [num for ending, num in config.dataset.num_classes.items() if col.endswith(ending)][0]
+        code = code * num_classes + tf.argmax(y[col], axis=-1)
 
-    return tf.strings.join(word[:-1])
+    return code
+
+
+def attribute_sizes(config: Config) -> List[int]:
+    """ Number of classes of each of `config.dataset.beat_elements` """
+    return [[num for ending, num in config.dataset.num_classes.items() if col.endswith(ending)][0]
+            for col in config.dataset.beat_elements]
+
+
+def create_word_attribute_table(word_id_dict: Dict[str, int], config: Config) -> np.ndarray:
+    """
+    Lookup table from `word_id` to the attribute indices (num_words, len(beat_elements)) in the order
+    of `config.dataset.beat_elements`. Example: L012_R238 -> [0, 1, 2, 2, 3, 8].
+    Words which are not valid actions (MASK, UNK) have all attributes -1.
+    """
+    sizes = attribute_sizes(config)
+    table = np.full((max(word_id_dict.values()) + 1, len(sizes)), -1, dtype=np.int64)
+
+    for word, word_id in word_id_dict.items():
+        match = re.fullmatch(r'L(\d)(\d)(\d)_R(\d)(\d)(\d)', word)
+        if match is None:
+            continue
+        attributes = [int(x) for x in match.groups()]
+        if all(value < size for value, size in zip(attributes, sizes)):
+            table[word_id] = attributes
+
+    return table
+
+
+def create_attribute_word_table(word_id_dict: Dict[str, int], config: Config) -> np.ndarray:
+    """
+    Dense lookup table from the packed action code (see `y2action_code`) to `word_id`.
+    Actions without an exact counterpart in the vocabulary map to UNK.
+    """
+    sizes = attribute_sizes(config)
+    table = np.full(np.prod(sizes), word_id_dict['UNK'], dtype=np.int64)
+
+    word_attributes = create_word_attribute_table(word_id_dict, config)
+    word_ids = np.flatnonzero(word_attributes[:, 0] >= 0)
+    table[np.ravel_multi_index(word_attributes[word_ids].T, sizes)] = word_ids
+
+    return table
+
+
+def action_code2word(codes: np.ndarray, sizes: List[int]) -> List[str]:
+    """ Words of the packed action codes with the `attribute_sizes`, needed only for the FastText embeddings """
+    attributes = np.stack(np.unravel_index(codes, sizes), axis=-1)
+    return [f'L{l_layer}{l_index}{l_cut}_R{r_layer}{r_index}{r_cut}'
+            for l_layer, l_index, l_cut, r_layer, r_index, r_cut in attributes]
 
 
 def create_word_mapping(action_model):
@@ -1,7 +1,7 @@
 from dataclasses import dataclass, field
 from enum import Enum, auto
 from time import time
-from typing import Tuple, Dict
+from typing import Tuple, Dict, Optional
 from typing import Union, Mapping, List
 
 import gensim
@@ -22,6 +22,11 @@ class ModelType(Enum):
     TUNE_MLSTM = auto()
 
 
+class OutputHead(Enum):
+    SOFTMAX = auto()
+    SAMPLED_SOFTMAX = auto()  # only for training, evaluation and generation use the full softmax
+
+
 @dataclass
 class AudioProcessingConfig:
     num_cepstral: int = 13
@@ -32,6 +37,9 @@ class AudioProcessingConfig:
     use_temp_derrivatives: float = True  # TODO: Change to correct defaults
     use_cache: bool = True
     signal_max_length: float = 2.5e7  # in samples
+    onset_min_gap: float = 0.1  # in seconds, beats of songs without beatmaps, see `process.compute.detect_onsets`
+    onset_window: float = 1.0  # in seconds, moving average of the onset strength
+    onset_threshold: float = 0.5  # in standard deviations of the onset strength above the moving average
 
 
 @dataclass
@@ -57,6 +65,10 @@ class DatasetConfig:
     storage_folder: Path = ROOT_DIR / 'data/generated_dataset'
     action_word_model_path: Path = storage_folder / 'fasttext.model'  # gensim FastText.KeyedVectors class
     normalization_stats_path: Path = storage_folder / 'col_stats.pkl'
+    transition_mask_path: Path = storage_folder / 'transition_mask.npz'  # see `predict.constraints`
+    avd_reference_path: Path = storage_folder / 'avd_reference.npz'  # human velocity histograms, see `utils.avd`
+    avd_max_window: int = 32  # AVD compares the velocities of the window sizes 1..`avd_max_window`
+    avd_bins: int = 512
     cols_to_normalize: Tuple = ('mfcc', 'prev', 'next', 'part',)
     difficulty_mapping: Dict = field(
         default_factory=lambda: {d: enum for enum, d in enumerate(['Easy', 'Normal', 'Hard', 'Expert', 'ExpertPlus'])})
@@ -103,12 +115,22 @@ class TrainingConfig:
     dropout: float = 0.4
     initial_learning_rate: float = 9e-3  # 8e-3 default
     data_split: Tuple = (0.0, 0.8, 0.9, 0.99,)
-    AVS_proxy_ratio: float = 0.2  # Fraction of songs to compute AVS cosine similarity
-    # if word reconstruction has to be used
+    AVS_proxy_ratio: float = 0.2  # `AVS_proxy_ratio` == 0 => AVSModel is not used
+    AVS_top_k: int = 0  # `AVS_top_k` == 0 => `word_vec` outputs are compared to the whole vocabulary at once
+    AVS_chunk_size: int = 4096  # vocabulary chunk size of the top-k search
+    AVS_restrict_vocab: bool = False  # top-k search only in `config.generation.restrict_vocab` actions
     batch_size: float = 128
+    gradient_accumulation_steps: int = 1  # micro-batches per optimizer step, `batch_size` stays the effective one
     label_smoothing: float = 0.5
     mixup_alpha: float = 0.5  # `mixup_alpha` == 0 => mixup is not used
     l2_regularization: float = 0.0
+    output_head: OutputHead = OutputHead.SOFTMAX  # output layer of `word_id`
+    sampled_softmax_samples: int = 1024  # negative classes per training step of the sampled softmax
+    jit_compile: bool = False  # XLA-compile the forward pass (and its gradient) of the AVSModel train step
+    checkpoint_folder: Optional[Path] = None  # `None` => training is not checkpointed and can not be resumed
+    checkpoint_period: int = 1  # in epochs
+    avd_period: int = 0  # in epochs, logs `val_avd` of generated validation songs, 0 == off, see `AVDCallback`
+    avd_songs: int = 4
     use_difficulties: List = field(
         default_factory=lambda: ['Normal', 'Hard', 'Expert', ])
     categorical_groups: List = field(
@@ -139,8 +161,23 @@ class TrainingConfig:
 @dataclass
 class GenerationConfig:
     temperature: int = 0.7  # different models need different temperatures, for more see `temperature_search.py`
-    batch_size: int = 1  # only 1 for now, will allow to generate multiple maps at once later
+    batch_size: int = 16  # beatmaps (difficulties, songs, temperatures) generated by a single step call
+    stateful_batch_size: int = 1  # input batch of the stateful architectures, only 1 for now, see `train.step`
     restrict_vocab: int = 500  # use only the first # actions. `None` == use all
+    top_k: int = 0  # sample only from the k most probable actions, 0 == all, see `predict.graph_generation`
+    top_p: float = 1.0  # sample only from the most probable actions with this cumulative probability
+    action_clusters: int = 0  # approximate closest action search in this many clusters, 0 == exact, see `ActionIndex`
+    action_probes: int = 8  # clusters searched for each query in the approximate mode
+    in_graph: bool = False  # generate `word_id` models in a single TF call, see `predict.graph_generation`
+    beam_width: int = 1  # most probable actions of `word_id` models by a beam search, 1 == sampling
+    playability_mask: bool = False  # sample `word_id` only from the allowed transitions, see `predict.constraints`
+    mask_min_transitions: int = 10  # actions seen fewer times in the training data are constrained only by the rules
+    metrics_folder: Optional[Path] = ROOT_DIR / 'data/temp/generation_metrics'  # `None` => metrics are not stored
+    velocity_plots: bool = False  # plot the velocities of each run in the background, see `predict.diagnostics`
+    chunk_beats: int = 16  # beats of a chunk of streamed notes, see `predict.streaming`
+    max_pending_chunks: int = 8  # streamed chunks generated ahead of the consumer
+    server_host: str = '127.0.0.1'  # local generation service, see `predict.server`
+    server_port: int = 8123
 
 
 @dataclass